@@ -1,59 +1,93 @@
 import os
+import time
+import asyncio
 import subprocess
 import tempfile
 import json
 import requests
+from typing import Callable
 from uuid import uuid4
-from google.cloud import speech, storage
-from google.oauth2 import service_account
-from google.oauth2.credentials import Credentials as OAuth2Credentials
 
 from dotenv import load_dotenv
 
+from storage import storage_for, upload_cancellable
+from process_runner import run_process
+from smart_render import smart_burn_captions
+from workspace import workspace_manager
+from job_store import checkpoint_reached, record_checkpoint
+from ffmpeg_planner import DEFAULT_VIDEO_ENCODERS
+from encode_tuner import EncodeProfile, tune_source, describe_tuning, x264_options
+
 load_dotenv()
 
+# How often to check on a long-running Speech-to-Text operation, and for how long
+STT_POLL_INTERVAL_SECONDS = float(os.getenv("STT_POLL_INTERVAL_SECONDS", "2"))
+STT_TIMEOUT_SECONDS = float(os.getenv("STT_TIMEOUT_SECONDS", "300"))
 
-class GCSStorageManagerJWT:
-    def __init__(self, bucket_name: str, token: str):
-        self.bucket_name = bucket_name
-        # Create OAuth2 credentials from access token
-        credentials = OAuth2Credentials(token=token)
-        
-        self.client = storage.Client(
-            credentials=credentials, 
-            project=os.getenv("GCP_PROJECT_ID")
-        )
-        self.bucket = self.client.bucket(bucket_name)
-
-    def uri_to_url(self, uri: str) -> str:
-        if not uri.startswith("gs://"):
-            raise ValueError("Invalid GCS URI")
-        parts = uri[5:].split("/", 1)
-        bucket_name = parts[0]
-        blob_name = parts[1] if len(parts) > 1 else ""
-        return f"https://storage.googleapis.com/{bucket_name}/{blob_name}"
-
-    def upload(self, local_path: str, remote_path: str):
-        print(f"[GCS] Starting upload: {local_path} -> gs://{self.bucket_name}/{remote_path}")
-        blob = self.bucket.blob(remote_path)
-        blob.upload_from_filename(local_path)
-        uri = f'gs://{self.bucket_name}/{remote_path}'
-        print(f"[GCS] Upload completed. File URL: {self.uri_to_url(uri)}")
-        return uri
-
-    def download_to_tempfile(self, uri: str):
-        print(f"[GCS] Starting download from: {uri}")
-        blob = self.bucket.blob(uri.replace(f"gs://{self.bucket_name}/", ""))
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        blob.download_to_filename(temp_file.name)
-        print(f"[GCS] Download completed to temporary file: {temp_file.name}")
-        return temp_file
+# Offline runs: replay a recorded LongRunningRecognizeResponse (JSON) instead of calling Speech-to-Text,
+# and use the stub translator ("stub" returns the text unchanged) instead of DeepL
+STT_REPLAY_FIXTURE = os.getenv("STT_REPLAY_FIXTURE")
+TRANSLATION_BACKEND = os.getenv("TRANSLATION_BACKEND", "deepl")
+
+# Subtitle codec per output container for caption_mode="soft" (a muxed track instead of burned-in text)
+SOFT_SUBTITLE_CODECS = {
+    "mp4": "mov_text",
+    "m4v": "mov_text",
+    "mov": "mov_text",
+    "mkv": "srt",
+    "webm": "webvtt",
+}
+
+
+def speech_api():
+    """
+    The google.cloud.speech module. It pulls in the whole gRPC/protobuf stack, so it is
+    imported on first use rather than at startup (see warm_up_clients in main.py).
+    """
+    from google.cloud import speech
+    return speech
+
+
+class _CompletedOperation:
+    """Minimal stand-in for a finished long-running operation."""
+
+    def __init__(self, response):
+        self.response = response
+
+    def done(self):
+        return True
+
+    def cancel(self):
+        return False
+
+    def result(self, timeout=None):
+        return self.response
+
+
+class ReplaySpeechClient:
+    """
+    Stands in for speech.SpeechClient when STT_REPLAY_FIXTURE is set. Every recognition request
+    returns the response stored in the fixture, as written by
+    speech.LongRunningRecognizeResponse.to_json(response).
+    """
+
+    def __init__(self, fixture_path: str):
+        with open(fixture_path) as f:
+            self.response = speech_api().LongRunningRecognizeResponse.from_json(f.read(), ignore_unknown_fields=True)
+
+    def long_running_recognize(self, config=None, audio=None):
+        return _CompletedOperation(self.response)
 
 
 def get_speech_client():
     """
     Initializes the Google Cloud Speech-to-Text client using environment variables.
+    Returns a ReplaySpeechClient instead when STT_REPLAY_FIXTURE is set.
     """
+    if STT_REPLAY_FIXTURE:
+        print(f"Replaying Speech-to-Text responses from '{STT_REPLAY_FIXTURE}'.")
+        return ReplaySpeechClient(STT_REPLAY_FIXTURE)
+
     try:
         # Construct credentials info from environment variables
         creds_info = {
@@ -75,8 +109,10 @@ def get_speech_client():
         if missing_vars:
             raise Exception(f"Missing required environment variables: {', '.join([f'STT_{key.upper()}' for key in missing_vars])}")
         
+        from google.oauth2 import service_account
+
         credentials = service_account.Credentials.from_service_account_info(creds_info)
-        client = speech.SpeechClient(credentials=credentials)
+        client = speech_api().SpeechClient(credentials=credentials)
         print("Successfully authenticated and initialized Speech-to-Text client.")
         return client
     except KeyError as e:
@@ -88,7 +124,7 @@ def get_speech_client():
         raise Exception(f"Speech-to-Text authentication failed: {e}")
 
 
-def extract_audio(video_path, audio_path=None):
+async def extract_audio(video_path, audio_path=None):
     """
     Extracts the audio from a video file using FFmpeg.
     Converts to mono (single channel) for Speech-to-Text compatibility.
@@ -108,7 +144,7 @@ def extract_audio(video_path, audio_path=None):
         audio_path
     ]
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        result = await run_process(command)
         print(f"Audio successfully extracted to '{audio_path}' (mono, 16kHz).")
         return audio_path
     except subprocess.CalledProcessError as e:
@@ -119,26 +155,43 @@ def extract_audio(video_path, audio_path=None):
         raise Exception("ffmpeg command not found. Is FFmpeg installed and in your PATH?")
 
 
-def get_word_timestamps(audio_path, client):
+async def get_word_timestamps(audio_path, client):
     """
     Transcribes an audio file to get word-level timestamps.
+    The long-running operation is polled with asyncio.sleep between checks
+    instead of blocking on operation.result(), and is cancelled on the server
+    if the caller is cancelled.
     """
     print(f"Requesting transcription with word timestamps for '{audio_path}'...")
     with open(audio_path, "rb") as audio_file:
         content = audio_file.read()
 
-    audio = speech.RecognitionAudio(content=content)
-    config = speech.RecognitionConfig(
+    audio = speech_api().RecognitionAudio(content=content)
+    config = speech_api().RecognitionConfig(
         language_code="en-US",
         enable_word_time_offsets=True,
     )
 
+    operation = None
     try:
-        operation = client.long_running_recognize(config=config, audio=audio)
+        operation = await asyncio.to_thread(client.long_running_recognize, config=config, audio=audio)
         print("Waiting for transcription to complete...")
-        response = operation.result(timeout=300)  # 5-minute timeout
+        deadline = time.monotonic() + STT_TIMEOUT_SECONDS
+        while not await asyncio.to_thread(operation.done):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Operation did not complete within {STT_TIMEOUT_SECONDS:.0f} seconds")
+            await asyncio.sleep(STT_POLL_INTERVAL_SECONDS)
+        response = operation.result()
         print("Transcription finished.")
         return response
+    except asyncio.CancelledError:
+        if operation is not None:
+            try:
+                await asyncio.shield(asyncio.to_thread(operation.cancel))
+                print("Transcription cancelled.")
+            except Exception as e:
+                print(f"Could not cancel the transcription operation: {e}")
+        raise
     except Exception as e:
         print(f"An error occurred during transcription: {e}")
         raise Exception(f"Speech-to-text transcription failed: {e}")
@@ -177,10 +230,14 @@ def format_timestamps_to_srt(response, srt_path=None):
     return srt_path
 
 
-def translate_text(text: str, target_lang: str) -> str:
+async def translate_text(text: str, target_lang: str) -> str:
     """
-    Translates text using DeepL API.
+    Translates text using DeepL API (or the stub backend, see TRANSLATION_BACKEND).
     """
+    if TRANSLATION_BACKEND == "stub":
+        print(f"Translating text to {target_lang} with the stub backend...")
+        return text
+
     deepl_auth_key = os.getenv("DEEPL_AUTH_KEY")
     if not deepl_auth_key:
         raise Exception("DEEPL_AUTH_KEY environment variable not set")
@@ -198,7 +255,7 @@ def translate_text(text: str, target_lang: str) -> str:
     
     print(f"Translating text to {target_lang}...")
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = await asyncio.to_thread(requests.post, url, headers=headers, json=data)
         response.raise_for_status()
         result = response.json()
         translated_text = result["translations"][0]["text"]
@@ -275,26 +332,32 @@ def format_translated_timestamps_to_srt(response, translated_text: str, srt_path
     return srt_path
 
 
-def add_captions_to_video(video_path, srt_path, output_path=None):
+def burn_in_filter(srt_path: str) -> str:
+    """subtitles filter rendering the SRT with a semi-transparent background for readability."""
+    subtitle_style = "Fontname=Arial,Fontsize=16,PrimaryColour=&H00FFFFFF,BorderStyle=3,Outline=1,Shadow=1,BackColour=&H80000000"
+    return f"subtitles={srt_path}:force_style='{subtitle_style}'"
+
+
+async def add_captions_to_video(video_path, srt_path, output_path=None, encoder_options=None):
     """
-    Burns the SRT captions into the video file using FFmpeg.
+    Burns the SRT captions into the video file using FFmpeg, with the given video encoder
+    options (e.g. from an encode_profile) or ffmpeg's defaults.
     """
     if output_path is None:
         output_path = tempfile.NamedTemporaryFile(suffix=".mp4", delete=False).name
     
     print(f"Adding captions from '{srt_path}' to '{video_path}'...")
-    # Use a filter complex to overlay subtitles with a semi-transparent background for readability
-    subtitle_style = "Fontname=Arial,Fontsize=16,PrimaryColour=&H00FFFFFF,BorderStyle=3,Outline=1,Shadow=1,BackColour=&H80000000"
     command = [
         "ffmpeg",
         "-i", video_path,
-        "-vf", f"subtitles={srt_path}:force_style='{subtitle_style}'",
+        "-vf", burn_in_filter(srt_path),
+        *(encoder_options or []),
         "-c:a", "copy",       # Copy the audio stream without re-encoding
         "-y",                 # Overwrite output file if it exists
         output_path
     ]
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        result = await run_process(command)
         print(f"Video with burned-in captions saved to '{output_path}'.")
         return output_path
     except subprocess.CalledProcessError as e:
@@ -305,82 +368,195 @@ def add_captions_to_video(video_path, srt_path, output_path=None):
         raise Exception("ffmpeg command not found. Is FFmpeg installed and in your PATH?")
 
 
-def add_captions_to_video_from_uri(video_uri: str, bucket_name: str, token: str, output_extension: str = "mp4", target_lang: str = None) -> dict:
+def soft_subtitle_codec(output_path: str) -> str:
+    """
+    Subtitle codec for muxing captions into output_path's container.
+    Raises ValueError for containers without text subtitle support.
+    """
+    extension = os.path.splitext(output_path)[1].lstrip(".").lower()
+    if extension not in SOFT_SUBTITLE_CODECS:
+        raise ValueError(
+            f"Soft captions are not supported for .{extension} outputs (use one of: {', '.join(SOFT_SUBTITLE_CODECS)})"
+        )
+    return SOFT_SUBTITLE_CODECS[extension]
+
+
+async def mux_captions_into_video(video_path, srt_path, output_path):
+    """
+    Adds the SRT captions as a subtitle track. Audio and video are stream-copied,
+    so this costs about as much as copying the file.
+    """
+    print(f"Muxing captions from '{srt_path}' into '{video_path}'...")
+    command = [
+        "ffmpeg",
+        "-i", video_path,
+        "-i", srt_path,
+        "-map", "0:v", "-map", "0:a?", "-map", "1:s",
+        "-c", "copy",
+        "-c:s", soft_subtitle_codec(output_path),
+        "-y",
+        output_path
+    ]
+    try:
+        await run_process(command)
+        print(f"Video with soft captions saved to '{output_path}'.")
+        return output_path
+    except subprocess.CalledProcessError as e:
+        print("Error during FFmpeg caption muxing:")
+        print(e.stderr)
+        raise Exception(f"Caption muxing failed: {e.stderr}")
+
+
+async def caption_video_file(video_path: str, output_file: str, workspace, speech_client, target_lang: str = None, artifact_prefix: str = "", caption_mode: str = "burn", job=None, encoder_options: list = None) -> str:
+    """
+    Captions a local video file: extracts audio, gets word timestamps, builds the SRT
+    (translated if target_lang is provided) and burns it into output_file (encoded with
+    encoder_options, if given), or muxes it as a subtitle track when caption_mode is "soft".
+    With caption_mode "smart" only the GOPs containing captions are re-encoded and the rest
+    is stream-copied.
+    Intermediate WAV/SRT files are staged in the job workspace's small-artifact area.
+    With a stored job, the transcript and translation are checkpointed, so a resumed run
+    does not pay for Speech-to-Text or DeepL again.
+    """
+    transcript_stage = f"{artifact_prefix}transcript_ready"
+    translation_stage = f"{artifact_prefix}translation_ready"
+    if checkpoint_reached(job, transcript_stage):
+        print(f"[CAPTIONS] Reusing transcript from an earlier attempt")
+        stt_response = speech_api().LongRunningRecognizeResponse.from_json(job.checkpoints[transcript_stage]["response"])
+    else:
+        # Extract audio from video (small artifacts are staged on tmpfs when available)
+        print(f"[CAPTIONS] Extracting audio from video...")
+        audio_path = await extract_audio(video_path, workspace.small_file(f"{artifact_prefix}audio.wav"))
+        
+        # Get word timestamps from speech-to-text
+        print(f"[CAPTIONS] Getting word timestamps from speech-to-text...")
+        stt_response = await get_word_timestamps(audio_path, speech_client)
+        await record_checkpoint(job, transcript_stage, response=speech_api().LongRunningRecognizeResponse.to_json(stt_response))
+    
+    # Format timestamps to SRT
+    srt_path = workspace.small_file(f"{artifact_prefix}captions.srt")
+    if target_lang:
+        # Extract full transcript for translation
+        full_transcript = ""
+        for result in stt_response.results:
+            full_transcript += result.alternatives[0].transcript + " "
+        
+        if checkpoint_reached(job, translation_stage):
+            translated_text = job.checkpoints[translation_stage]["text"]
+        else:
+            print(f"[CAPTIONS] Translating transcript to {target_lang}...")
+            translated_text = await translate_text(full_transcript.strip(), target_lang)
+            await record_checkpoint(job, translation_stage, text=translated_text)
+        
+        print(f"[CAPTIONS] Formatting translated text into 3-word chunks...")
+        format_translated_timestamps_to_srt(stt_response, translated_text, srt_path)
+    else:
+        print(f"[CAPTIONS] Formatting timestamps to SRT...")
+        format_timestamps_to_srt(stt_response, srt_path)
+    
+    # Add captions to video
+    if caption_mode == "soft":
+        print(f"[CAPTIONS] Muxing captions into video as a subtitle track...")
+        return await mux_captions_into_video(video_path, srt_path, output_file)
+    if caption_mode == "smart":
+        print(f"[CAPTIONS] Burning captions into the captioned parts of the video only...")
+        try:
+            stats = await smart_burn_captions(
+                video_path, srt_path, output_file, workspace.file(f"{artifact_prefix}smart_render"), burn_in_filter(srt_path),
+                encoder_options
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"[CAPTIONS] Smart render failed, falling back to a full re-encode: {e.stderr}")
+            stats = None
+        if stats is not None:
+            return output_file
+    print(f"[CAPTIONS] Adding captions to video...")
+    return await add_captions_to_video(video_path, srt_path, output_file, encoder_options)
+
+
+async def tune_caption_encode(profile: EncodeProfile, bucket_manager, video_uri: str, metadata: dict, video_path: str,
+                              output_extension: str, work_dir: str):
+    """
+    Encoder options meeting profile for burning captions into video_path, or None when the
+    output is not encoded with libx264 or calibration fails. The samples are encoded without
+    the subtitles filter, which costs little next to the encode, so calibrations stay cacheable.
+    """
+    if DEFAULT_VIDEO_ENCODERS.get(output_extension.lower()) != "libx264":
+        print(f"[CAPTIONS] encode_profile {profile} ignored: .{output_extension} outputs are not encoded with libx264")
+        return None
+    tuning = await tune_source(profile, bucket_manager, video_uri, metadata, video_path, work_dir)
+    if tuning is None:
+        return None
+    print(f"[CAPTIONS] Optimization: {describe_tuning(profile, tuning)}")
+    return x264_options(tuning)
+
+
+async def add_captions_to_video_from_uri(video_uri: str, bucket_name: str, token_provider: Callable[[], str], output_extension: str = "mp4", target_lang: str = None, caption_mode: str = "burn", encode_profile: str = None, job=None) -> dict:
     """
     Main function to add captions to a video from GCS URI.
     Downloads video, extracts audio, gets transcription, creates captions, and uploads result.
     If target_lang is provided, translates the captions to that language.
+    With an encode_profile, a burn-mode re-encode gets the libx264 settings calibrated for it.
+    In smart mode the re-encoded chunks get its preset and threads (they keep the source's CRF),
+    and a fallback to a full re-encode gets all of them.
+    Blocking client calls (GCS, Speech-to-Text setup) are offloaded to worker threads.
+    With a stored job, finished stages are checkpointed and skipped when the job is resumed.
     """
+    if checkpoint_reached(job, "output_uploaded"):
+        return job.checkpoints["output_uploaded"]
+
     print(f"[CAPTIONS] Starting caption addition pipeline")
     print(f"[CAPTIONS] Input video URI: {video_uri}")
     print(f"[CAPTIONS] Target bucket: {bucket_name}")
     if target_lang:
         print(f"[CAPTIONS] Target language: {target_lang}")
     
-    bucket_manager = GCSStorageManagerJWT(bucket_name, token)
+    bucket_manager = storage_for(bucket_name, token_provider)
+    metadata = await asyncio.to_thread(bucket_manager.get_metadata, video_uri)
+    if job:
+        await job.reset_if_source_changed(metadata["generation"])
     
     # Initialize Speech-to-Text client
-    speech_client = get_speech_client()
-    
-    # Download video to temp file
-    print(f"[CAPTIONS] Downloading video from GCS to temporary file...")
-    temp_video = bucket_manager.download_to_tempfile(video_uri)
-    print(f"[CAPTIONS] Video downloaded to: {temp_video.name}")
+    speech_client = await asyncio.to_thread(get_speech_client)
     
-    # Create temp files for processing
-    temp_audio = None
-    temp_srt = None
-    temp_output = None
-    
-    try:
-        # Extract audio from video
-        print(f"[CAPTIONS] Extracting audio from video...")
-        temp_audio = extract_audio(temp_video.name)
-        
-        # Get word timestamps from speech-to-text
-        print(f"[CAPTIONS] Getting word timestamps from speech-to-text...")
-        stt_response = get_word_timestamps(temp_audio, speech_client)
-        
-        # Format timestamps to SRT
-        if target_lang:
-            # Extract full transcript for translation
-            full_transcript = ""
-            for result in stt_response.results:
-                full_transcript += result.alternatives[0].transcript + " "
+    async with workspace_manager.job(metadata["size"], job_id=job and job.id, keep_on_cancel=job is not None) as workspace:
+        try:
+            # Download video into the job workspace
+            video_path = workspace.file("input" + os.path.splitext(bucket_manager.blob_name(video_uri))[1])
+            if checkpoint_reached(job, "source_downloaded", video_path):
+                print(f"[CAPTIONS] Reusing video downloaded by an earlier attempt: {video_path}")
+            else:
+                print(f"[CAPTIONS] Downloading video from GCS to job workspace...")
+                await asyncio.to_thread(bucket_manager.download, video_uri, video_path)
+                print(f"[CAPTIONS] Video downloaded to: {video_path}")
+                await record_checkpoint(job, "source_downloaded", path=video_path, generation=metadata["generation"])
             
-            print(f"[CAPTIONS] Translating transcript to {target_lang}...")
-            translated_text = translate_text(full_transcript.strip(), target_lang)
+            output_file = workspace.file(f"output.{output_extension}")
+            if checkpoint_reached(job, "output_ready", output_file):
+                print(f"[CAPTIONS] Reusing captioned video rendered by an earlier attempt")
+            else:
+                encoder_options = None
+                if encode_profile and caption_mode in ("burn", "smart"):
+                    encoder_options = await tune_caption_encode(
+                        EncodeProfile.parse(encode_profile), bucket_manager, video_uri, metadata, video_path,
+                        output_extension, workspace.file("tuning")
+                    )
+                await caption_video_file(
+                    video_path, output_file, workspace, speech_client, target_lang,
+                    caption_mode=caption_mode, job=job, encoder_options=encoder_options
+                )
+                await record_checkpoint(job, "output_ready", path=output_file)
             
-            print(f"[CAPTIONS] Formatting translated text into 3-word chunks...")
-            temp_srt = format_translated_timestamps_to_srt(stt_response, translated_text)
-        else:
-            print(f"[CAPTIONS] Formatting timestamps to SRT...")
-            temp_srt = format_timestamps_to_srt(stt_response)
-        
-        # Add captions to video
-        print(f"[CAPTIONS] Adding captions to video...")
-        temp_output = add_captions_to_video(temp_video.name, temp_srt)
-        
-        # Upload processed video to GCS
-        lang_suffix = f"_{target_lang}" if target_lang else ""
-        output_path = f"captioned_videos/{uuid4()}{lang_suffix}.{output_extension}"
-        print(f"[CAPTIONS] Uploading captioned video to GCS path: {output_path}")
-        result_uri = bucket_manager.upload(temp_output, output_path)
-        print(f"[CAPTIONS] Upload completed. Result URI: {result_uri}")
-        
-        return {"result_uri": result_uri}
-        
-    except Exception as e:
-        print(f"[CAPTIONS] Error during caption processing: {str(e)}")
-        raise e
-        
-    finally:
-        # Cleanup temp files
-        print(f"[CAPTIONS] Cleaning up temporary files...")
-        for temp_file in [temp_video.name, temp_audio, temp_srt, temp_output]:
-            if temp_file:
-                try:
-                    os.unlink(temp_file)
-                except OSError as e:
-                    print(f"[CAPTIONS] Warning: Could not clean up {temp_file}: {e}")
-        print(f"[CAPTIONS] Temporary files cleaned up successfully")
\ No newline at end of file
+            # Upload processed video to GCS
+            lang_suffix = f"_{target_lang}" if target_lang else ""
+            output_path = f"captioned_videos/{uuid4()}{lang_suffix}.{output_extension}"
+            print(f"[CAPTIONS] Uploading captioned video to GCS path: {output_path}")
+            result_uri = await upload_cancellable(bucket_manager, output_file, output_path)
+            print(f"[CAPTIONS] Upload completed. Result URI: {result_uri}")
+            
+            await record_checkpoint(job, "output_uploaded", result_uri=result_uri)
+            return {"result_uri": result_uri}
+            
+        except Exception as e:
+            print(f"[CAPTIONS] Error during caption processing: {str(e)}")
+            raise e
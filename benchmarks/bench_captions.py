@@ -0,0 +1,340 @@
+"""
+Offline benchmark for the caption pipeline.
+
+Speech-to-Text is replaced by recorded or synthetic LongRunningRecognizeResponse fixtures
+(ReplaySpeechClient) and DeepL by the stub translator, so every local stage can be timed:
+
+  srt        format_timestamps_to_srt / format_translated_timestamps_to_srt at several word counts
+  render     burned-in vs soft (muxed) captions at several cue counts, next to a plain re-encode
+  replay     the full caption_video_file path on a generated video, stage by stage
+  smart      smart-render vs full burn-in on limited-range and full-range BT.709 sources; fails
+             unless every smart-rendered output decodes cleanly (ffprobe -show_frames) with all frames
+
+    python benchmarks/bench_captions.py --output benchmarks/captions_baseline.json
+    python benchmarks/bench_captions.py --baseline benchmarks/captions_baseline.json
+    python benchmarks/bench_captions.py --fixture recorded.json   # use a recorded response for the SRT stage
+
+A fixture can be recorded from a live run with speech.LongRunningRecognizeResponse.to_json(response);
+--write-fixture saves a synthetic one that also works with STT_REPLAY_FIXTURE.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TRANSLATION_BACKEND", "stub")
+
+from bench_process_video import log, generate_video
+
+WORDS_PER_SECOND = 2.5
+WORDS_PER_RESULT = 15
+VOCABULARY = (
+    "the quick brown fox jumps over lazy dog video caption speech timing frame render "
+    "subtitle stream encode packet cloud storage bucket token request latency"
+).split()
+
+
+def synthetic_response_json(word_count: int, duration: float = None, seed: int = 0) -> str:
+    """
+    A LongRunningRecognizeResponse in the API's JSON form: word_count words spread evenly
+    over duration seconds (default: natural speech rate), grouped into results like the live API.
+    """
+    rng = random.Random(seed)
+    duration = duration or word_count / WORDS_PER_SECOND
+    step = duration / max(word_count, 1)
+    results = []
+    for first in range(0, word_count, WORDS_PER_RESULT):
+        words = []
+        for index in range(first, min(first + WORDS_PER_RESULT, word_count)):
+            start = index * step
+            words.append({
+                "startTime": f"{start:.3f}s",
+                "endTime": f"{start + step * 0.9:.3f}s",
+                "word": rng.choice(VOCABULARY),
+            })
+        results.append({"alternatives": [{
+            "transcript": " ".join(word["word"] for word in words),
+            "confidence": 0.9,
+            "words": words,
+        }]})
+    return json.dumps({"results": results})
+
+
+def load_response(fixture_json: str):
+    from google.cloud import speech
+
+    return speech.LongRunningRecognizeResponse.from_json(fixture_json, ignore_unknown_fields=True)
+
+
+def best_of(repeats: int, function, *args) -> float:
+    """Fastest of `repeats` runs, in seconds; the app's progress output is discarded."""
+    timings = []
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            started = time.perf_counter()
+            function(*args)
+            timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+async def timed(coroutine) -> float:
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        started = time.perf_counter()
+        await coroutine
+        return time.perf_counter() - started
+
+
+def bench_srt(word_counts: list, repeats: int, workdir: str, fixture: str = None) -> list:
+    import add_captions
+
+    sources = [(f"synthetic_{count}", synthetic_response_json(count)) for count in word_counts]
+    if fixture:
+        with open(fixture) as f:
+            sources.append((f"fixture_{os.path.basename(fixture)}", f.read()))
+
+    results = []
+    srt_path = os.path.join(workdir, "bench.srt")
+    for name, fixture_json in sources:
+        response = load_response(fixture_json)
+        words = sum(len(result.alternatives[0].words) for result in response.results)
+        transcript = " ".join(result.alternatives[0].transcript for result in response.results)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            translated = asyncio.run(add_captions.translate_text(transcript, "ES"))
+        for stage, function, args in (
+            ("srt", add_captions.format_timestamps_to_srt, (response, srt_path)),
+            ("srt_translated", add_captions.format_translated_timestamps_to_srt, (response, translated, srt_path)),
+        ):
+            seconds = best_of(repeats, function, *args)
+            results.append({
+                "key": f"{stage}/{name}", "stage": stage, "words": words,
+                "seconds": round(seconds, 5), "words_per_second": round(words / seconds) if seconds else None,
+            })
+            log(f"[BENCH] {stage:15s} {name:24s} {words:7d} words {seconds * 1000:9.2f} ms")
+    return results
+
+
+def bench_render(video_path: str, duration: float, cue_counts: list, workdir: str) -> list:
+    import add_captions
+    from process_runner import run_process
+
+    results = []
+    output_path = os.path.join(workdir, "render.mp4")
+    reference = asyncio.run(timed(run_process(
+        ["ffmpeg", "-i", video_path, "-c:a", "copy", "-y", output_path]
+    )))
+    results.append({"key": "render/reencode_only", "stage": "reencode_only", "cues": 0, "seconds": round(reference, 4)})
+    log(f"[BENCH] {'reencode_only':15s} {'':24s} {0:7d} cues  {reference:9.3f} s")
+
+    for cues in cue_counts:
+        srt_path = os.path.join(workdir, f"cues_{cues}.srt")
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            add_captions.format_timestamps_to_srt(load_response(synthetic_response_json(cues, duration)), srt_path)
+        for stage, function in (
+            ("burn", add_captions.add_captions_to_video),
+            ("soft", add_captions.mux_captions_into_video),
+        ):
+            seconds = asyncio.run(timed(function(video_path, srt_path, output_path)))
+            results.append({"key": f"render/{stage}/{cues}", "stage": stage, "cues": cues, "seconds": round(seconds, 4)})
+            log(f"[BENCH] {stage:15s} {'':24s} {cues:7d} cues  {seconds:9.3f} s")
+    return results
+
+
+async def bench_replay(video_path: str, duration: float, workdir: str) -> list:
+    """Runs the caption_video_file stages in order against a replayed response."""
+    import add_captions
+    from workspace import workspace_manager
+
+    fixture_path = os.path.join(workdir, "replay_fixture.json")
+    with open(fixture_path, "w") as f:
+        f.write(synthetic_response_json(int(duration * WORDS_PER_SECOND), duration))
+    client = add_captions.ReplaySpeechClient(fixture_path)
+
+    timings = {}
+    async with workspace_manager.job(os.path.getsize(video_path)) as workspace:
+        audio_path = workspace.small_file("audio.wav")
+        srt_path = workspace.small_file("captions.srt")
+        timings["extract_audio"] = await timed(add_captions.extract_audio(video_path, audio_path))
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            response = await add_captions.get_word_timestamps(audio_path, client)
+        timings["transcribe_replay"] = time.perf_counter() - started
+        timings["format_srt"] = best_of(1, add_captions.format_timestamps_to_srt, response, srt_path)
+        timings["burn"] = await timed(add_captions.add_captions_to_video(video_path, srt_path, workspace.file("burn.mp4")))
+        timings["soft"] = await timed(add_captions.mux_captions_into_video(video_path, srt_path, workspace.file("soft.mp4")))
+        timings["caption_video_file"] = await timed(add_captions.caption_video_file(
+            video_path, workspace.file("output.mp4"), workspace, client
+        ))
+
+    for stage, seconds in timings.items():
+        log(f"[BENCH] replay/{stage:22s} {seconds:9.3f} s")
+    return [{"key": f"replay/{stage}", "stage": stage, "seconds": round(seconds, 4)} for stage, seconds in timings.items()]
+
+
+def srt_time(seconds: float) -> str:
+    milliseconds = int(round(seconds * 1000))
+    return f"{milliseconds // 3600000:02d}:{milliseconds // 60000 % 60:02d}:{milliseconds // 1000 % 60:02d},{milliseconds % 1000:03d}"
+
+
+def decoded_frames(path: str) -> tuple:
+    """(video frames decoded, decoder errors) for path, by ffprobe -show_frames (ffmpeg when ffprobe is missing)."""
+    if shutil.which("ffprobe"):
+        command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_frames",
+                   "-show_entries", "frame=pict_type", "-of", "csv=p=0", path]
+        result = subprocess.run(command, capture_output=True, text=True)
+        frames = len([line for line in result.stdout.splitlines() if line.strip()])
+    else:
+        command = ["ffmpeg", "-v", "error", "-i", path, "-map", "0:v:0", "-f", "framemd5", "-"]
+        result = subprocess.run(command, capture_output=True, text=True)
+        frames = len([line for line in result.stdout.splitlines() if line and not line.startswith("#")])
+    errors = result.stderr.strip() or (f"exit status {result.returncode}" if result.returncode else "")
+    return frames, errors
+
+
+def bench_smart(video_path: str, duration: float, workdir: str) -> tuple:
+    """
+    Smart-render and full burn-in of captions covering a fifth of the video. Returns the results
+    and the sources whose smart-rendered output did not decode cleanly or lost frames.
+    """
+    import add_captions
+    import smart_render
+
+    full_range_path = os.path.join(workdir, "source_pc_bt709.mp4")
+    if not os.path.exists(full_range_path):
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error", "-i", video_path, "-c:a", "copy", "-vf", "format=yuvj420p",
+            "-c:v", "libx264", "-profile:v", "main", "-crf", "28", "-g", "60", "-color_range", "pc",
+            "-colorspace", "bt709", "-color_primaries", "bt709", "-color_trc", "bt709", full_range_path,
+        ], check=True)
+
+    srt_path = os.path.join(workdir, "smart.srt")
+    with open(srt_path, "w") as f:
+        for number, start in enumerate((duration * 0.1, duration * 0.5), start=1):
+            f.write(f"{number}\n{srt_time(start)} --> {srt_time(start + duration * 0.1)}\nsmart render\n\n")
+
+    results, failures = [], []
+    for name, source in (("tv", video_path), ("pc_bt709", full_range_path)):
+        smart_path = os.path.join(workdir, f"smart_{name}.mp4")
+        smart_dir = os.path.join(workdir, f"smart_{name}")
+        shutil.rmtree(smart_dir, ignore_errors=True)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            started = time.perf_counter()
+            stats = asyncio.run(smart_render.smart_burn_captions(
+                source, srt_path, smart_path, smart_dir, add_captions.burn_in_filter(srt_path)
+            ))
+            smart_seconds = time.perf_counter() - started
+        burn_seconds = asyncio.run(timed(add_captions.add_captions_to_video(source, srt_path, os.path.join(workdir, f"burn_{name}.mp4"))))
+        if stats is None:
+            failures.append(f"smart/{name}: fell back to a full re-encode")
+            continue
+        source_frames, _ = decoded_frames(source)
+        frames, errors = decoded_frames(smart_path)
+        if errors or frames != source_frames:
+            failures.append(f"smart/{name}: decoded {frames}/{source_frames} frames {errors}".strip())
+        results.append({
+            "key": f"smart/{name}", "stage": "smart", "seconds": round(smart_seconds, 4),
+            "burn_seconds": round(burn_seconds, 4), "reencoded_seconds": stats["reencoded_seconds"], "frames": frames,
+        })
+        log(f"[BENCH] smart/{name:18s} {smart_seconds:9.3f} s (full burn {burn_seconds:.3f} s), {frames}/{source_frames} frames decoded")
+    return results, failures
+
+
+def compare_to_baseline(results: list, baseline: dict, tolerance: float) -> list:
+    previous = {case["key"]: case for case in baseline.get("results", [])}
+    regressions = []
+    for case in results:
+        old = previous.get(case["key"])
+        if old and old["seconds"] and case["seconds"] > old["seconds"] * (1 + tolerance):
+            regressions.append(f"{case['key']}: {old['seconds']:.4f}s -> {case['seconds']:.4f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--words", default="1000,5000,20000", help="Comma-separated word counts for the SRT stage")
+    parser.add_argument("--cues", default="10,100,1000", help="Comma-separated cue counts for the render stage")
+    parser.add_argument("--duration", type=int, default=60, help="Length of the generated video in seconds")
+    parser.add_argument("--resolution", default="1280x720", help="Resolution of the generated video")
+    parser.add_argument("--repeats", type=int, default=5, help="Repeats for the pure-Python stages (best is kept)")
+    parser.add_argument("--stages", default="srt,render,replay,smart", help="Comma-separated subset of srt,render,replay,smart")
+    parser.add_argument("--fixture", help="A recorded LongRunningRecognizeResponse JSON to include in the SRT stage")
+    parser.add_argument("--write-fixture", help="Write a synthetic fixture (--words' first count) here and exit")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "coolifyeasyapi-bench"),
+                        help="Where generated videos, fixtures and scratch space live")
+    parser.add_argument("--output", default="benchmarks/results/captions.json", help="Write results here")
+    parser.add_argument("--baseline", help="Compare against a previous results file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    word_counts = [int(value) for value in args.words.split(",")]
+    if args.write_fixture:
+        with open(args.write_fixture, "w") as f:
+            f.write(synthetic_response_json(word_counts[0]))
+        log(f"[BENCH] Wrote a {word_counts[0]}-word fixture to {args.write_fixture}")
+        return
+
+    workdir = os.path.join(args.workdir, "captions")
+    os.makedirs(workdir, exist_ok=True)
+    os.environ.setdefault("SCRATCH_DIR", os.path.join(args.workdir, "scratch"))
+    stages = args.stages.split(",")
+
+    video_path = os.path.join(args.workdir, "videos", f"{args.resolution}_{args.duration}s.mp4")
+    if "render" in stages or "replay" in stages or "smart" in stages:
+        os.makedirs(os.path.dirname(video_path), exist_ok=True)
+        log(f"[BENCH] Preparing {os.path.basename(video_path)}")
+        generate_video(video_path, args.duration, args.resolution)
+
+    results = []
+    if "srt" in stages:
+        results += bench_srt(word_counts, args.repeats, workdir, args.fixture)
+    if "render" in stages:
+        results += bench_render(video_path, args.duration, [int(value) for value in args.cues.split(",")], workdir)
+    if "replay" in stages:
+        results += asyncio.run(bench_replay(video_path, args.duration, workdir))
+    failures = []
+    if "smart" in stages:
+        smart_results, failures = bench_smart(video_path, args.duration, workdir)
+        results += smart_results
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": {"duration": args.duration, "resolution": args.resolution, "repeats": args.repeats},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    log(f"[BENCH] Results written to {args.output}")
+
+    if failures:
+        log(f"[BENCH] {len(failures)} smart-render output(s) did not decode cleanly:")
+        for line in failures:
+            log(f"  {line}")
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            log(f"[BENCH] {len(regressions)} regression(s) against {args.baseline}:")
+            for line in regressions:
+                log(f"  {line}")
+            sys.exit(1)
+        log(f"[BENCH] No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+End-to-end benchmark for /process-video.
+
+Runs the real FastAPI app under uvicorn against the in-process fake GCS (which also stubs the
+OAuth token endpoint), so the full request path is measured: auth, metadata/ranged reads,
+ffmpeg and upload. Test videos are generated with ffmpeg's lavfi sources.
+
+    python benchmarks/bench_process_video.py --output benchmarks/baseline.json
+    python benchmarks/bench_process_video.py --baseline benchmarks/baseline.json --tolerance 0.25
+
+With --baseline the run exits with status 1 if any case's p50/p90 latency or throughput regressed
+by more than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gcs import FakeGCSServer
+
+BUCKET = "bench-bucket"
+BEARER_KEY = "bench-key"
+
+SCENARIOS = {
+    "trim_copy": "ffmpeg -ss 1 -i INPUT_FILE -t 2 -c copy OUTPUT_FILE",
+    "scale_transcode": "ffmpeg -i INPUT_FILE -vf scale=iw/2:-2 -c:a copy OUTPUT_FILE",
+}
+
+
+def log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Linear-interpolated percentile of an unsorted list."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def generate_video(path: str, duration: int, resolution: str):
+    """Synthetic test pattern + tone, encoded like a typical upload (H.264/AAC, 2 s GOP, moov at the front)."""
+    if os.path.exists(path):
+        return
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-g", "60", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k", "-shortest", "-movflags", "+faststart", path
+    ], check=True)
+
+
+def configure_environment(fake_url: str, scratch_dir: str):
+    """Point the app at the fake endpoints with a throwaway service-account key. Must run before importing main."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    os.environ.update({
+        "BEARER_KEY": BEARER_KEY,
+        "GCP_BUCKET_NAME": BUCKET,
+        "GCP_PROJECT_ID": "bench-project",
+        "GCP_PRIVATE_KEY": pem,
+        "GCP_KEY_ID": "bench-key-id",
+        "GCP_CLIENT_EMAIL": "bench@bench-project.iam.gserviceaccount.com",
+        "GCP_TOKEN_URI": f"{fake_url}/token",
+        "STORAGE_EMULATOR_HOST": fake_url,
+        "SCRATCH_DIR": scratch_dir,
+    })
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(port: int):
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+async def run_level(base_url: str, payload: dict, concurrency: int, total_requests: int) -> dict:
+    """
+    Send total_requests requests with at most `concurrency` in flight. Each carries its own
+    Idempotency-Key, so the service runs every one instead of coalescing the identical payloads.
+    """
+    import httpx
+
+    latencies = []
+    errors = []
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"Authorization": f"Bearer {BEARER_KEY}"}
+
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, timeout=600) as client:
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/process-video", json=payload, headers={"Idempotency-Key": uuid4().hex})
+                elapsed = time.perf_counter() - started
+                if response.status_code == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(f"{response.status_code}: {response.text[:200]}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total_requests)))
+        wall = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "p50": round(percentile(latencies, 0.50), 4),
+        "p90": round(percentile(latencies, 0.90), 4),
+        "p99": round(percentile(latencies, 0.99), 4),
+        "mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+        "throughput_rps": round(len(latencies) / wall, 4) if wall else 0.0,
+        "wall_seconds": round(wall, 4),
+    }
+
+
+def case_key(case: dict) -> str:
+    return f"{case['video']}/{case['scenario']}/c{case['concurrency']}"
+
+
+def compare_to_baseline(results: list, baseline: dict, tolerance: float) -> list:
+    """Returns human-readable regressions: latency up or throughput down by more than `tolerance`."""
+    previous = {case_key(case): case for case in baseline.get("results", [])}
+    regressions = []
+    for case in results:
+        old = previous.get(case_key(case))
+        if old is None:
+            continue
+        for metric in ("p50", "p90"):
+            if old[metric] and case[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{case_key(case)} {metric}: {old[metric]:.3f}s -> {case[metric]:.3f}s")
+        if old["throughput_rps"] and case["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{case_key(case)} throughput: {old['throughput_rps']:.3f} -> {case['throughput_rps']:.3f} req/s"
+            )
+        if case["errors"] > old["errors"]:
+            regressions.append(f"{case_key(case)} errors: {old['errors']} -> {case['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--durations", default="10,60", help="Comma-separated video durations in seconds")
+    parser.add_argument("--resolutions", default="640x360,1280x720", help="Comma-separated WxH resolutions")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of {list(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,4,8", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=8, help="Requests per concurrency level")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "coolifyeasyapi-bench"),
+                        help="Where generated videos, fake bucket contents and scratch space live")
+    parser.add_argument("--output", default="benchmarks/results/process_video.json", help="Write results here")
+    parser.add_argument("--baseline", help="Compare against a previous results file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (0.2 = 20%%)")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's own logging on stdout")
+    args = parser.parse_args()
+
+    videos_dir = os.path.join(args.workdir, "videos")
+    os.makedirs(videos_dir, exist_ok=True)
+
+    fake = FakeGCSServer(os.path.join(args.workdir, "gcs")).start()
+    configure_environment(fake.url, os.path.join(args.workdir, "scratch"))
+
+    videos = []
+    for duration in [int(value) for value in args.durations.split(",")]:
+        for resolution in args.resolutions.split(","):
+            name = f"{resolution}_{duration}s.mp4"
+            path = os.path.join(videos_dir, name)
+            log(f"[BENCH] Preparing {name}")
+            generate_video(path, duration, resolution)
+            fake.put_file(BUCKET, f"bench/{name}", path)
+            videos.append(name)
+
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    port = free_port()
+    server, thread = start_app(port)
+    base_url = f"http://127.0.0.1:{port}"
+
+    results = []
+    try:
+        for name in videos:
+            for scenario in args.scenarios.split(","):
+                payload = {
+                    "video_uri": f"gs://{BUCKET}/bench/{name}",
+                    "ffmpeg_command": SCENARIOS[scenario],
+                    "output_extension": "mp4",
+                }
+                for concurrency in [int(value) for value in args.concurrency.split(",")]:
+                    case = asyncio.run(run_level(base_url, payload, concurrency, args.requests))
+                    case.update({"video": name, "scenario": scenario})
+                    results.append(case)
+                    log(f"[BENCH] {case_key(case):40s} p50={case['p50']:.3f}s p90={case['p90']:.3f}s "
+                        f"p99={case['p99']:.3f}s {case['throughput_rps']:.2f} req/s errors={case['errors']}")
+    finally:
+        server.should_exit = True
+        thread.join()
+        fake.stop()
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": {"requests_per_level": args.requests},
+        "fake_gcs": fake.stats,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    log(f"[BENCH] Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            log(f"[BENCH] {len(regressions)} regression(s) against {args.baseline}:")
+            for line in regressions:
+                log(f"  {line}")
+            sys.exit(1)
+        log(f"[BENCH] No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
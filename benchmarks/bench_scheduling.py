@@ -0,0 +1,163 @@
+"""
+Offline benchmark for job cost estimation, which orders the scheduler queue.
+
+Runs cost_model.estimate_job_cost against the in-process fake GCS on generated videos of
+different durations, the way run_job calls it (with a token provider):
+
+  estimate   time to estimate each job (cold and cached); fails if any estimate is the
+             COST_FALLBACK_SECONDS fallback or does not grow with the source's duration
+  order      queues one re-encode job per video, longest first, behind a busy slot of the real
+             FairScheduler, with their estimated costs; fails unless they start shortest-first
+
+    python benchmarks/bench_scheduling.py --output benchmarks/results/scheduling.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gcs import FakeGCSServer
+from bench_process_video import BUCKET, log, generate_video, configure_environment
+
+JOBS = {
+    "trim_copy": ("process-video", {"ffmpeg_command": "ffmpeg -i INPUT_FILE -c copy OUTPUT_FILE", "output_extension": "mp4"}),
+    "scale_transcode": ("process-video", {"ffmpeg_command": "ffmpeg -i INPUT_FILE -vf scale=iw/2:-2 OUTPUT_FILE", "output_extension": "mp4"}),
+    "previews": ("previews", {}),
+}
+
+
+async def bench_estimate(videos: dict) -> tuple:
+    """Estimates every job on every video; videos maps a name to its duration."""
+    from cost_model import estimate_job_cost, COST_FALLBACK_SECONDS
+    from gcp_auth import authenticate_gcp
+
+    results, failures = [], []
+    for job_name, (kind, request) in JOBS.items():
+        costs = []
+        for name, duration in sorted(videos.items(), key=lambda item: item[1]):
+            job_request = {**request, "video_uri": f"gs://{BUCKET}/bench/{name}", "bucket_name": BUCKET}
+            timings = []
+            for _ in range(2):
+                started = time.perf_counter()
+                cost = await estimate_job_cost(kind, job_request, authenticate_gcp)
+                timings.append(time.perf_counter() - started)
+            if cost == COST_FALLBACK_SECONDS:
+                failures.append(f"estimate/{job_name}/{name}: got the {COST_FALLBACK_SECONDS:.0f}s fallback")
+            costs.append(cost)
+            results.append({
+                "key": f"estimate/{job_name}/{name}", "stage": "estimate", "duration": duration, "cost": round(cost, 4),
+                "cold_seconds": round(timings[0], 4), "cached_seconds": round(timings[1], 4),
+            })
+            log(f"[BENCH] estimate/{job_name:16s} {name:20s} cost={cost:8.2f}s "
+                f"cold={timings[0] * 1000:8.2f} ms cached={timings[1] * 1000:8.2f} ms")
+        if any(shorter >= longer for shorter, longer in zip(costs, costs[1:])):
+            failures.append(f"estimate/{job_name}: costs {costs} do not grow with the source's duration")
+    return results, failures
+
+
+async def bench_order(videos: dict) -> tuple:
+    """Dequeue order of re-encode jobs for every video, submitted longest first to one busy slot."""
+    from cost_model import estimate_job_cost
+    from gcp_auth import authenticate_gcp
+    from scheduler import FairScheduler
+    from tenants import Tenant
+
+    kind, request = JOBS["scale_transcode"]
+    arrivals = sorted(videos, key=videos.get, reverse=True)
+    costs = {}
+    for name in arrivals:
+        job_request = {**request, "video_uri": f"gs://{BUCKET}/bench/{name}", "bucket_name": BUCKET}
+        costs[name] = await estimate_job_cost(kind, job_request, authenticate_gcp)
+
+    scheduler = FairScheduler(slots=1)
+    tenant = Tenant("bench")
+    started = []
+
+    async def job(name: str):
+        async with scheduler.slot(tenant, costs[name]):
+            started.append(name)
+
+    jobs = []
+    async with scheduler.slot(tenant):
+        for name in arrivals:
+            jobs.append(asyncio.create_task(job(name)))
+            # Let it reach the queue, so arrival order is the submission order
+            await asyncio.sleep(0)
+    await asyncio.gather(*jobs)
+
+    expected = sorted(videos, key=videos.get)
+    failures = [] if started == expected else [f"order: started {started}, expected shortest-first {expected} (costs {costs})"]
+    log(f"[BENCH] order: submitted {arrivals}, started {started}")
+    return [{"key": "order", "stage": "order", "submitted": arrivals, "started": started,
+             "costs": {name: round(cost, 4) for name, cost in costs.items()}}], failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--durations", default="5,30", help="Comma-separated video durations in seconds (at least two)")
+    parser.add_argument("--resolution", default="640x360", help="WxH of the generated videos")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "coolifyeasyapi-bench"),
+                        help="Where generated videos, fake bucket contents and scratch space live")
+    parser.add_argument("--output", default="benchmarks/results/scheduling.json", help="Write results here")
+    parser.add_argument("--stages", default="estimate,order", help="Comma-separated subset of estimate,order")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's own logging on stdout")
+    args = parser.parse_args()
+
+    videos_dir = os.path.join(args.workdir, "videos")
+    os.makedirs(videos_dir, exist_ok=True)
+
+    fake = FakeGCSServer(os.path.join(args.workdir, "gcs")).start()
+    configure_environment(fake.url, os.path.join(args.workdir, "scratch"))
+
+    videos = {}
+    for duration in [int(value) for value in args.durations.split(",")]:
+        name = f"{args.resolution}_{duration}s.mp4"
+        path = os.path.join(videos_dir, name)
+        log(f"[BENCH] Preparing {name}")
+        generate_video(path, duration, args.resolution)
+        fake.put_file(BUCKET, f"bench/{name}", path)
+        videos[name] = duration
+
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    stages = args.stages.split(",")
+    results, failures = [], []
+    try:
+        for stage, function in (("estimate", bench_estimate), ("order", bench_order)):
+            if stage in stages:
+                stage_results, stage_failures = asyncio.run(function(videos))
+                results += stage_results
+                failures += stage_failures
+    finally:
+        fake.stop()
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    log(f"[BENCH] Results written to {args.output}")
+
+    if failures:
+        log(f"[BENCH] {len(failures)} check(s) failed:")
+        for line in failures:
+            log(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Cold-start benchmark: how long until a fresh process can serve requests.
+
+Each run starts a new interpreter, so nothing is shared between runs (the OS page cache aside):
+
+    import    `import main`, i.e. everything module-level code does before uvicorn can bind
+    ready     from spawning `uvicorn main:app` until it answers an HTTP request
+
+It also checks that the heavy client libraries (google.cloud.storage, google.cloud.speech,
+cryptography) are not imported by `import main`: they are meant to load lazily or in the
+background warm-up after the port is bound.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --import-budget 1.0 --ready-budget 2.5 --profile
+
+Exits with status 1 if the median import or ready time is over its budget, or if a heavy
+module is imported at startup.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gcs import FakeGCSServer
+from bench_process_video import configure_environment, percentile, log
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Must not be in sys.modules after `import main`
+LAZY_MODULES = ["google.cloud.storage", "google.cloud.speech", "cryptography.hazmat.primitives.serialization"]
+
+IMPORT_PROBE = """
+import sys, json, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "loaded": [name for name in %r if name in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_import() -> dict:
+    result = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=APP_DIR, capture_output=True, text=True, check=True)
+    # Module-level prints of the app come first; the probe's JSON is the last line
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure_ready(timeout: float) -> float:
+    """Seconds from spawning the server until it answers; any HTTP status counts as an answer."""
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with status {process.returncode} during startup")
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=1)
+                return time.perf_counter() - started
+            except urllib.error.HTTPError:
+                return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise RuntimeError(f"Server did not answer within {timeout:.0f}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def import_profile(top: int) -> list:
+    """The modules with the highest cumulative import time, from python -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=APP_DIR,
+                            capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace("import time:", "|", 1).split("|")]
+        rows.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+    return rows[:top]
+
+
+def summarize(values: list) -> dict:
+    return {
+        "p50": round(percentile(values, 0.50), 4),
+        "p90": round(percentile(values, 0.90), 4),
+        "min": round(min(values), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per measurement")
+    parser.add_argument("--import-budget", type=float, default=1.5, help="Allowed median `import main` time in seconds")
+    parser.add_argument("--ready-budget", type=float, default=3.0, help="Allowed median time until the server answers")
+    parser.add_argument("--profile", action="store_true", help="Also list the slowest imports (python -X importtime)")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "coolifyeasyapi-bench-startup"),
+                        help="Where the fake bucket contents and scratch space live")
+    parser.add_argument("--output", default="benchmarks/results/startup.json", help="Write results here")
+    args = parser.parse_args()
+
+    # The warm-up after startup fetches a token; point it at the fake endpoint instead of Google
+    fake = FakeGCSServer(os.path.join(args.workdir, "gcs")).start()
+    configure_environment(fake.url, os.path.join(args.workdir, "scratch"))
+    os.environ["JOB_STORE_PATH"] = os.path.join(args.workdir, "jobs.sqlite3")
+
+    failures = []
+    try:
+        imports = [measure_import() for _ in range(args.runs)]
+        import_seconds = [run["seconds"] for run in imports]
+        log(f"[BENCH] import main      p50={percentile(import_seconds, 0.5):.3f}s max={max(import_seconds):.3f}s")
+        loaded = sorted({name for run in imports for name in run["loaded"]})
+        if loaded:
+            failures.append(f"imported at startup but meant to load lazily: {', '.join(loaded)}")
+
+        ready_seconds = [measure_ready(timeout=max(30.0, args.ready_budget * 5)) for _ in range(args.runs)]
+        log(f"[BENCH] server answering p50={percentile(ready_seconds, 0.5):.3f}s max={max(ready_seconds):.3f}s")
+
+        profile = import_profile(15) if args.profile else []
+        for row in profile:
+            log(f"  {row['cumulative_ms']:8.1f} ms  {row['module']}")
+    finally:
+        fake.stop()
+
+    if percentile(import_seconds, 0.5) > args.import_budget:
+        failures.append(f"import main p50 {percentile(import_seconds, 0.5):.3f}s over budget {args.import_budget:.3f}s")
+    if percentile(ready_seconds, 0.5) > args.ready_budget:
+        failures.append(f"ready p50 {percentile(ready_seconds, 0.5):.3f}s over budget {args.ready_budget:.3f}s")
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": {"runs": args.runs, "import_budget": args.import_budget, "ready_budget": args.ready_budget},
+        "import_seconds": summarize(import_seconds),
+        "ready_seconds": summarize(ready_seconds),
+        "eagerly_imported": loaded,
+        "slowest_imports": profile,
+        "failures": failures,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    log(f"[BENCH] Results written to {args.output}")
+
+    if failures:
+        for line in failures:
+            log(f"[BENCH] FAIL: {line}")
+        sys.exit(1)
+    log("[BENCH] Startup within budget")
+
+
+if __name__ == "__main__":
+    main()
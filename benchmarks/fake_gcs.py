@@ -0,0 +1,252 @@
+"""
+In-process fake of the parts of the GCS JSON/upload API and the OAuth token endpoint this service uses.
+
+Point the app at it with STORAGE_EMULATOR_HOST=http://127.0.0.1:<port> and
+GCP_TOKEN_URI=http://127.0.0.1:<port>/token. Objects are stored as plain files under a root directory.
+"""
+import os
+import re
+import json
+import base64
+import hashlib
+import shutil
+import threading
+from uuid import uuid4
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote, quote
+import google_crc32c
+
+_CHUNK_BYTES = 1024 * 1024
+
+
+class FakeGCSServer:
+    def __init__(self, root: str, host: str = "127.0.0.1", port: int = 0):
+        self.root = root
+        self.generations = {}
+        self.hashes = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes_sent": 0, "bytes_received": 0}
+        os.makedirs(root, exist_ok=True)
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def path_for(self, bucket: str, name: str) -> str:
+        return os.path.join(self.root, bucket, quote(name, safe=""))
+
+    def put_file(self, bucket: str, name: str, local_path: str):
+        """Seed an object from a local file."""
+        os.makedirs(os.path.join(self.root, bucket), exist_ok=True)
+        shutil.copyfile(local_path, self.path_for(bucket, name))
+        self._bump(bucket, name)
+
+    def _bump(self, bucket: str, name: str) -> int:
+        # Generations follow the file's mtime, so they stay stable across fake server restarts.
+        # Resumable uploads are validated against crc32c, so every stored object carries real hashes
+        path = self.path_for(bucket, name)
+        crc32c, md5 = google_crc32c.Checksum(), hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK_BYTES), b""):
+                crc32c.update(chunk)
+                md5.update(chunk)
+        with self.lock:
+            generation = os.stat(path).st_mtime_ns // 1000
+            self.generations[(bucket, name)] = generation
+            self.hashes[(bucket, name)] = (
+                base64.b64encode(crc32c.digest()).decode(), base64.b64encode(md5.digest()).decode()
+            )
+            return generation
+
+    def metadata(self, bucket: str, name: str):
+        path = self.path_for(bucket, name)
+        if not os.path.exists(path):
+            return None
+        generation = self.generations.get((bucket, name)) or self._bump(bucket, name)
+        crc32c, md5 = self.hashes[(bucket, name)]
+        return {
+            "kind": "storage#object",
+            "bucket": bucket,
+            "name": name,
+            "id": f"{bucket}/{name}/{generation}",
+            "size": str(os.path.getsize(path)),
+            "generation": str(generation),
+            "metageneration": "1",
+            "contentType": "application/octet-stream",
+            "crc32c": crc32c,
+            "md5Hash": md5,
+        }
+
+
+def _make_handler(server: FakeGCSServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict, headers: dict = None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _not_found(self):
+            self._send_json(404, {"error": {"code": 404, "message": "No such object"}})
+
+        def _read_body(self) -> bytes:
+            length = int(self.headers.get("Content-Length") or 0)
+            data = self.rfile.read(length) if length else b""
+            server.stats["bytes_received"] += len(data)
+            return data
+
+        def _send_media(self, bucket: str, name: str):
+            path = server.path_for(bucket, name)
+            if not os.path.exists(path):
+                return self._not_found()
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            status = 200
+            match = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+            if match and size:
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = int(match.group(2)) if match.group(2) else size - 1
+                else:
+                    start = max(size - int(match.group(2)), 0)
+                end = min(end, size - 1)
+                status = 206
+            if start > end and size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            length = end - start + 1 if size else 0
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(length))
+            self.send_header("x-goog-generation", str(server.generations.get((bucket, name), 0)))
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if self.command == "HEAD":
+                return
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = length
+                while remaining > 0:
+                    chunk = f.read(min(_CHUNK_BYTES, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    server.stats["bytes_sent"] += len(chunk)
+
+        def _store(self, bucket: str, name: str, data: bytes):
+            os.makedirs(os.path.join(server.root, bucket), exist_ok=True)
+            with open(server.path_for(bucket, name), "wb") as f:
+                f.write(data)
+            server._bump(bucket, name)
+            return server.metadata(bucket, name)
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            server.stats["requests"] += 1
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            match = re.match(r"^(?:/download)?/storage/v1/b/([^/]+)/o/(.+)$", url.path)
+            if match:
+                bucket, name = match.group(1), unquote(match.group(2))
+                if query.get("alt") == ["media"]:
+                    return self._send_media(bucket, name)
+                metadata = server.metadata(bucket, name)
+                return self._send_json(200, metadata) if metadata else self._not_found()
+            # Public-style object URLs, as used by ffprobe/ffmpeg range reads
+            match = re.match(r"^/([^/]+)/(.+)$", url.path)
+            if match:
+                return self._send_media(match.group(1), unquote(match.group(2)))
+            self._not_found()
+
+        def do_POST(self):
+            server.stats["requests"] += 1
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            body = self._read_body()
+            if url.path == "/token":
+                return self._send_json(200, {"access_token": "fake-access-token", "expires_in": 3600, "token_type": "Bearer"})
+            match = re.match(r"^/upload/storage/v1/b/([^/]+)/o$", url.path)
+            if not match:
+                return self._not_found()
+            bucket = match.group(1)
+            upload_type = query.get("uploadType", ["media"])[0]
+            if upload_type == "multipart":
+                boundary = re.search(r'boundary="?([^";]+)"?', self.headers.get("Content-Type", "")).group(1).encode()
+                parts = [part for part in body.split(b"--" + boundary) if part.strip(b"\r\n-")]
+                metadata_part, media_part = parts[0], parts[1]
+                metadata = json.loads(metadata_part.split(b"\r\n\r\n", 1)[1].strip())
+                data = media_part.split(b"\r\n\r\n", 1)[1]
+                if data.endswith(b"\r\n"):
+                    data = data[:-2]
+                return self._send_json(200, self._store(bucket, metadata.get("name") or query["name"][0], data))
+            if upload_type == "resumable":
+                metadata = json.loads(body or b"{}")
+                upload_id = uuid4().hex
+                server.uploads[upload_id] = {"bucket": bucket, "name": metadata.get("name") or query["name"][0], "data": bytearray()}
+                location = f"{server.url}/upload/storage/v1/b/{bucket}/o?uploadType=resumable&upload_id={upload_id}"
+                return self._send_json(200, {}, {"Location": location})
+            return self._send_json(200, self._store(bucket, query["name"][0], body))
+
+        def do_PUT(self):
+            server.stats["requests"] += 1
+            query = parse_qs(urlparse(self.path).query)
+            upload = server.uploads.get(query.get("upload_id", [""])[0])
+            body = self._read_body()
+            if upload is None:
+                return self._not_found()
+            upload["data"] += body
+            match = re.match(r"bytes (?:\d+-\d+|\*)/(\d+|\*)", self.headers.get("Content-Range", ""))
+            total = match.group(1) if match else str(len(upload["data"]))
+            if total != "*" and len(upload["data"]) >= int(total):
+                server.uploads.pop(query["upload_id"][0], None)
+                return self._send_json(200, self._store(upload["bucket"], upload["name"], bytes(upload["data"])))
+            self.send_response(308)
+            self.send_header("Range", f"bytes=0-{len(upload['data']) - 1}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_DELETE(self):
+            server.stats["requests"] += 1
+            match = re.match(r"^/storage/v1/b/([^/]+)/o/(.+)$", urlparse(self.path).path)
+            if not match:
+                return self._not_found()
+            path = server.path_for(match.group(1), unquote(match.group(2)))
+            if not os.path.exists(path):
+                return self._not_found()
+            os.unlink(path)
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    return Handler
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from dotenv import load_dotenv
+
+from shared_state import shared_state, SHARED_STATE_POLL_SECONDS
+
+load_dotenv()
+
+# How long the result of a request sent with an Idempotency-Key is kept for replays
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+
+
+class IdempotencyKeyConflict(Exception):
+    """Raised when an Idempotency-Key is reused for a different request."""
+
+
+def request_fingerprint(endpoint: str, payload: dict) -> str:
+    """Stable hash of an endpoint and its (fully resolved) request parameters."""
+    canonical = json.dumps({"endpoint": endpoint, "payload": payload}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class Flight:
+    """One shared execution and the requests attached to it."""
+
+    def __init__(self, fingerprint: str, task: asyncio.Task, retain: bool):
+        self.fingerprint = fingerprint
+        self.task = task
+        self.retain = retain
+        self.waiters = 1
+        self.expires_at = None
+
+
+class RequestCoalescer:
+    """
+    Single-flight execution of identical requests.
+
+    Requests are matched by their Idempotency-Key when the client sends one, otherwise by
+    request fingerprint. A duplicate that arrives while the original is running attaches to
+    it and receives the same result instead of starting a second pipeline. Results of keyed
+    requests are also replayed for ttl_seconds after completion; failed runs are forgotten
+    so a retry executes again. An execution is cancelled once every request waiting on it
+    has gone away (e.g. all clients disconnected).
+
+    With shared state, Idempotency-Keys also hold across worker processes: the first worker
+    to claim a key runs the request, and the others wait for its result in the shared store
+    (or take over if it fails or its worker dies).
+    """
+
+    def __init__(self, ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.flights = {}
+
+    async def _purge(self):
+        if shared_state:
+            await asyncio.to_thread(shared_state.purge_keys)
+        now = time.monotonic()
+        for key in [key for key, flight in self.flights.items() if flight.expires_at and flight.expires_at <= now]:
+            del self.flights[key]
+
+    def _finished(self, key: str, flight: Flight, task: asyncio.Task):
+        failed = task.cancelled() or task.exception() is not None
+        if failed or not flight.retain:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        else:
+            flight.expires_at = time.monotonic() + self.ttl_seconds
+
+    async def _run_keyed(self, key: str, fingerprint: str, factory, idempotency_key: str):
+        """factory() if this worker claims the key, else the result of the worker that did."""
+        while True:
+            claimed_by = await asyncio.to_thread(shared_state.claim_key, key, fingerprint)
+            if claimed_by is None:
+                try:
+                    result = await factory()
+                except BaseException:
+                    await asyncio.shield(asyncio.to_thread(shared_state.forget_key, key))
+                    raise
+                await asyncio.to_thread(shared_state.finish_key, key, result, self.ttl_seconds)
+                return result
+            held_fingerprint, owner_pid, result = claimed_by
+            if held_fingerprint != fingerprint:
+                raise IdempotencyKeyConflict(f"Idempotency-Key '{idempotency_key}' was already used for a different request")
+            if result is not None:
+                print(f"[COALESCE] Replaying result of worker {owner_pid}")
+                return result
+            await asyncio.sleep(SHARED_STATE_POLL_SECONDS)
+
+    async def run(self, fingerprint: str, factory, idempotency_key: str = None):
+        """
+        Returns the result of factory() for this request, sharing one execution between duplicates.
+        factory is only called when no matching execution is running or retained.
+        """
+        await self._purge()
+        key = f"key:{idempotency_key}" if idempotency_key else f"fingerprint:{fingerprint}"
+        flight = self.flights.get(key)
+        if flight is not None:
+            if flight.fingerprint != fingerprint:
+                raise IdempotencyKeyConflict(f"Idempotency-Key '{idempotency_key}' was already used for a different request")
+            flight.waiters += 1
+            state = "running" if not flight.task.done() else "completed"
+            print(f"[COALESCE] Attaching request to {state} job ({flight.waiters} requests share it)")
+        else:
+            if idempotency_key and shared_state:
+                execution = self._run_keyed(key, fingerprint, factory, idempotency_key)
+            else:
+                execution = factory()
+            flight = Flight(fingerprint, asyncio.create_task(execution), retain=idempotency_key is not None)
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finished(key, flight, task))
+        # A waiter going away must not cancel the execution the others are waiting on
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                print(f"[COALESCE] Last request waiting on a running job went away, cancelling it")
+                flight.task.cancel()
+            raise
+
+
+request_coalescer = RequestCoalescer()
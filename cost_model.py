@@ -0,0 +1,101 @@
+import os
+import asyncio
+from typing import Callable
+from dotenv import load_dotenv
+
+from storage import storage_for
+from media_index import describe_media, trim_window_from_command
+from ffmpeg_planner import parse_ffmpeg_command, stream_copy_candidate, explicit_stream_copy, FFmpegCommandError
+
+load_dotenv()
+
+# Processing seconds per second of media, per megapixel of frame size, for a re-encode
+COST_ENCODE_SECONDS_PER_MEGAPIXEL = float(os.getenv("COST_ENCODE_SECONDS_PER_MEGAPIXEL", "0.25"))
+# Processing seconds per second of media for a stream copy (remux, trim without re-encode)
+COST_COPY_SECONDS_PER_SECOND = float(os.getenv("COST_COPY_SECONDS_PER_SECOND", "0.01"))
+# Processing seconds per second of audio for Speech-to-Text (and translation)
+COST_STT_SECONDS_PER_SECOND = float(os.getenv("COST_STT_SECONDS_PER_SECOND", "0.5"))
+# Used to guess the duration from the object size when the source cannot be probed
+COST_ASSUMED_BITRATE = float(os.getenv("COST_ASSUMED_BITRATE", str(5_000_000)))
+# Estimate for jobs whose source cannot even be looked up
+COST_FALLBACK_SECONDS = float(os.getenv("COST_FALLBACK_SECONDS", "60"))
+
+# Frame size assumed when the source's is unknown
+DEFAULT_MEGAPIXELS = 1920 * 1080 / 1e6
+
+
+class MediaShape:
+    def __init__(self, duration: float, megapixels: float):
+        self.duration = duration
+        self.megapixels = megapixels
+
+    def encode(self, seconds: float = None, megapixels: float = None) -> float:
+        return (seconds if seconds is not None else self.duration) * (megapixels or self.megapixels) * COST_ENCODE_SECONDS_PER_MEGAPIXEL
+
+    def copy(self, seconds: float = None) -> float:
+        return (seconds if seconds is not None else self.duration) * COST_COPY_SECONDS_PER_SECOND
+
+    def transcribe(self) -> float:
+        return self.duration * COST_STT_SECONDS_PER_SECOND
+
+
+def ffmpeg_command_cost(shape: MediaShape, ffmpeg_command: str) -> float:
+    """A command is priced as a stream copy when it asks for -c copy or the planner may serve it with -c copy."""
+    plan = parse_ffmpeg_command(ffmpeg_command)
+    seconds = shape.duration
+    window = trim_window_from_command(plan.to_args())
+    if window is not None:
+        start, end = window
+        seconds = max(0.0, min(end if end is not None else shape.duration, shape.duration) - start)
+    return shape.copy(seconds) if explicit_stream_copy(plan) or stream_copy_candidate(plan) else shape.encode(seconds)
+
+
+def captions_cost(shape: MediaShape, caption_mode: str) -> float:
+    return shape.transcribe() + (shape.copy() if caption_mode == "soft" else shape.encode())
+
+
+def rendition_megapixels(height: int, shape: MediaShape) -> float:
+    # Renditions are 16:9-ish and never upscaled
+    return min(height * height * 16 / 9 / 1e6, shape.megapixels)
+
+
+def operation_cost(kind: str, request: dict, shape: MediaShape) -> float:
+    if kind == "process-video":
+        return ffmpeg_command_cost(shape, request["ffmpeg_command"])
+    if kind == "pipeline":
+        return sum(
+            captions_cost(shape, step.get("caption_mode") or "burn") if step.get("type") == "captions"
+            else ffmpeg_command_cost(shape, step["ffmpeg_command"])
+            for step in request["steps"]
+        )
+    if kind == "add-captions":
+        return captions_cost(shape, request["caption_mode"])
+    if kind == "previews":
+        # One full decode plus small encodes: about half of a full re-encode
+        return shape.encode() / 2
+    if kind == "package":
+        return sum(shape.encode(megapixels=rendition_megapixels(rendition["height"], shape)) for rendition in request["renditions"])
+    return shape.encode()
+
+
+async def estimate_job_cost(kind: str, request: dict, token_provider: Callable[[], str]) -> float:
+    """
+    Estimated processing seconds of a job, from the source's duration and frame size
+    (packet index or ffprobe, both cached) and the kind of work: stream copy, re-encode or
+    Speech-to-Text. Only used to order the scheduler queue, so rough is fine.
+    """
+    try:
+        bucket_manager = storage_for(request["bucket_name"], token_provider)
+        metadata = await asyncio.to_thread(bucket_manager.get_metadata, request["video_uri"])
+        description = await describe_media(bucket_manager, request["video_uri"], metadata)
+    except Exception as e:
+        print(f"[COST] Could not look up {request.get('video_uri')}: {e}")
+        return COST_FALLBACK_SECONDS
+
+    duration = description["duration"] or metadata["size"] * 8 / COST_ASSUMED_BITRATE
+    megapixels = description["width"] * description["height"] / 1e6 if description["width"] and description["height"] else DEFAULT_MEGAPIXELS
+    try:
+        return operation_cost(kind, request, MediaShape(duration, megapixels))
+    except (FFmpegCommandError, KeyError, TypeError) as e:
+        print(f"[COST] Could not estimate {kind} job: {e}")
+        return COST_FALLBACK_SECONDS
@@ -0,0 +1,325 @@
+import os
+import re
+import json
+import time
+import asyncio
+from dotenv import load_dotenv
+
+from process_runner import run_process
+from media_index import describe_media
+from cost_model import COST_ASSUMED_BITRATE
+from scheduler import WORKER_SLOTS
+from shared_state import shared_state
+
+load_dotenv()
+
+# Sample segments encoded per calibration, and their length in seconds
+ENCODE_TUNER_SAMPLES = int(os.getenv("ENCODE_TUNER_SAMPLES", "3"))
+ENCODE_TUNER_SAMPLE_SECONDS = float(os.getenv("ENCODE_TUNER_SAMPLE_SECONDS", "4"))
+# Calibrated speed must beat the target by this factor: samples skip decoding the rest of the
+# source and the full encode shares the machine with other jobs
+ENCODE_TUNER_SPEED_MARGIN = float(os.getenv("ENCODE_TUNER_SPEED_MARGIN", "1.25"))
+# CRF for speed targets when the command sets none; "deadline" targets spend the time on quality
+ENCODE_TUNER_DEFAULT_CRF = int(os.getenv("ENCODE_TUNER_DEFAULT_CRF", "23"))
+ENCODE_TUNER_QUALITY_CRF = int(os.getenv("ENCODE_TUNER_QUALITY_CRF", "20"))
+# CRF range searched for "vmaf" targets, and the preset they are encoded with
+ENCODE_TUNER_MIN_CRF = int(os.getenv("ENCODE_TUNER_MIN_CRF", "16"))
+ENCODE_TUNER_MAX_CRF = int(os.getenv("ENCODE_TUNER_MAX_CRF", "40"))
+ENCODE_TUNER_VMAF_PRESET = os.getenv("ENCODE_TUNER_VMAF_PRESET", "medium")
+# Encoder threads per job: the job's share of the machine when every worker slot is busy. x264
+# scales sublinearly with threads, so this does more work per CPU second than one job using all.
+ENCODE_TUNER_THREADS = int(os.getenv("ENCODE_TUNER_THREADS", str(max(1, (os.cpu_count() or 1) // WORKER_SLOTS))))
+# How long a calibration is reused for sources of the same resolution class
+ENCODE_TUNER_CACHE_SECONDS = float(os.getenv("ENCODE_TUNER_CACHE_SECONDS", "86400"))
+
+# x264 presets from best compression to fastest
+X264_PRESETS = ["veryslow", "slower", "slow", "medium", "fast", "faster", "veryfast", "superfast", "ultrafast"]
+# Smallest frame height of each resolution class calibrations are cached by
+RESOLUTION_CLASSES = [(1800, "2160p"), (1260, "1440p"), (900, "1080p"), (600, "720p"), (400, "480p"), (0, "sd")]
+
+PROFILE_PATTERN = re.compile(r"^(realtime|deadline|vmaf)\s*[:x×]\s*([0-9]*\.?[0-9]+)$")
+# The same targets spelled out, e.g. "best quality under 10 minutes", "smallest file at vmaf≥93"
+PROFILE_PHRASES = [
+    (re.compile(r"^best quality under\s*([0-9]*\.?[0-9]+)\s*min(?:ute)?s?$"), "deadline"),
+    (re.compile(r"^smallest file at vmaf\s*(?:>=|≥)\s*([0-9]*\.?[0-9]+)$"), "vmaf"),
+]
+VMAF_SCORE = re.compile(r"VMAF score[:=]\s*([0-9.]+)")
+
+
+class EncodeProfile:
+    """
+    A target for a libx264 encode:
+
+    - "realtime:N": encode at least N times faster than real time, at the best preset that does;
+    - "deadline:M": finish the encode within M minutes, at the best preset that does;
+    - "vmaf:X": the smallest file (highest CRF) with a VMAF of at least X.
+    """
+
+    def __init__(self, kind: str, value: float):
+        self.kind = kind
+        self.value = value
+
+    @classmethod
+    def parse(cls, text: str):
+        normalized = " ".join(text.strip().lower().split())
+        match = PROFILE_PATTERN.match(normalized)
+        if match:
+            profile = cls(match.group(1), float(match.group(2)))
+        else:
+            profile = next((cls(kind, float(phrase.match(normalized).group(1)))
+                            for phrase, kind in PROFILE_PHRASES if phrase.match(normalized)), None)
+        if profile is None:
+            raise ValueError(f"Invalid encode_profile '{text}': expected realtime:<factor>, deadline:<minutes> or vmaf:<score>")
+        if profile.value <= 0 or (profile.kind == "vmaf" and profile.value > 100):
+            raise ValueError(f"Invalid encode_profile '{text}': out of range")
+        return profile
+
+    def __str__(self):
+        return f"{self.kind}:{self.value:g}"
+
+
+def resolution_class(height: int) -> str:
+    if not height:
+        return "unknown"
+    return next(name for minimum, name in RESOLUTION_CLASSES if height >= minimum)
+
+
+def sample_windows(duration: float) -> list:
+    """(start, length) of the calibration samples, spread evenly through the source."""
+    if not duration or duration <= ENCODE_TUNER_SAMPLES * ENCODE_TUNER_SAMPLE_SECONDS:
+        return [(0.0, min(duration or ENCODE_TUNER_SAMPLE_SECONDS, ENCODE_TUNER_SAMPLES * ENCODE_TUNER_SAMPLE_SECONDS))]
+    return [
+        (max(0.0, duration * (number + 1) / (ENCODE_TUNER_SAMPLES + 1) - ENCODE_TUNER_SAMPLE_SECONDS / 2), ENCODE_TUNER_SAMPLE_SECONDS)
+        for number in range(ENCODE_TUNER_SAMPLES)
+    ]
+
+
+class TuningCache:
+    """
+    Calibration results by resolution class and video options (VMAF targets: the chosen CRF;
+    speed targets: the measured speed of each preset), in memory and (with several workers) shared.
+    """
+
+    def __init__(self, ttl_seconds: float = ENCODE_TUNER_CACHE_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None and shared_state:
+            entry = await asyncio.to_thread(shared_state.get_tuning, key)
+        if entry is None or entry["expires_at"] <= time.time():
+            return None
+        self.entries[key] = entry
+        return entry["settings"]
+
+    async def put(self, key: str, settings: dict):
+        entry = {"settings": settings, "expires_at": time.time() + self.ttl_seconds}
+        self.entries[key] = entry
+        if shared_state:
+            await asyncio.to_thread(shared_state.put_tuning, key, entry)
+
+
+tuning_cache = TuningCache()
+
+
+async def _encode_samples(source_path: str, windows: list, video_options: list, preset: str, crf: int, threads: int) -> float:
+    """Encodes the samples to nowhere; returns the encode speed as a multiple of real time."""
+    wall_seconds = 0.0
+    for start, length in windows:
+        command = ["ffmpeg", "-nostdin", "-y", "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", source_path]
+        command += video_options
+        command += ["-an", "-sn", "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-threads", str(threads), "-f", "null", "-"]
+        result = await run_process(command)
+        wall_seconds += result.usage["wall_seconds"]
+    return sum(length for _, length in windows) / max(wall_seconds, 1e-3)
+
+
+async def _calibrate_speed(source_path: str, windows: list, video_options: list, crf: int, threads: int, required_speed: float,
+                           measurements: dict) -> dict:
+    """
+    The slowest preset whose sample encodes run at required_speed (with margin). Starts at
+    medium and walks towards slower presets while the target is met, or faster ones until it is.
+
+    measurements holds the speeds of earlier calibrations with the same CRF, threads, resolution
+    class and video options, and is updated in place: "speeds" maps presets to their speed, and
+    "slower_than" presets whose samples timed out to the speed they were known to fall short of.
+    Only presets these cannot decide for this target are encoded.
+    """
+    needed = required_speed * ENCODE_TUNER_SPEED_MARGIN
+    speeds, slower_than = measurements["speeds"], measurements["slower_than"]
+
+    # A preset that has not finished the samples by the time the target speed allows has failed
+    sample_seconds = sum(length for _, length in windows)
+    time_allowed = sample_seconds / needed * 1.1 if needed else None
+
+    async def speed(preset: str) -> float:
+        if preset in speeds:
+            return speeds[preset]
+        if preset in slower_than and slower_than[preset] <= needed:
+            return 0.0
+        try:
+            speeds[preset] = await asyncio.wait_for(
+                _encode_samples(source_path, windows, video_options, preset, crf, threads), time_allowed
+            )
+            slower_than.pop(preset, None)
+        except asyncio.TimeoutError:
+            slower_than[preset] = sample_seconds / time_allowed
+        print(f"[TUNER] preset {preset}: {speeds.get(preset, 0.0):.2f}x real time (need {needed:.2f}x)")
+        return speeds.get(preset, 0.0)
+
+    position = X264_PRESETS.index("medium")
+    if await speed(X264_PRESETS[position]) >= needed:
+        while position > 0 and await speed(X264_PRESETS[position - 1]) >= needed:
+            position -= 1
+    else:
+        while position < len(X264_PRESETS) - 1:
+            position += 1
+            if await speed(X264_PRESETS[position]) >= needed:
+                break
+    preset = X264_PRESETS[position]
+    return {"preset": preset, "crf": crf, "threads": threads, "speed": round(speeds.get(preset, 0.0), 2)}
+
+
+async def _vmaf_available() -> bool:
+    result = await run_process(["ffmpeg", "-hide_banner", "-filters"])
+    return " libvmaf " in result.stdout
+
+
+async def _calibrate_vmaf(source_path: str, windows: list, video_options: list, preset: str, threads: int, target: float, work_dir: str) -> dict:
+    """
+    The highest CRF whose sample encodes all score at least target, by binary search. Samples
+    are first rendered losslessly (with the video options), so each is encoded and scored against
+    exactly the frames the full encode would see.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    references = []
+    for number, (start, length) in enumerate(windows):
+        reference = os.path.join(work_dir, f"reference_{number}.mkv")
+        command = ["ffmpeg", "-nostdin", "-y", "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", source_path]
+        command += video_options
+        command += ["-an", "-sn", "-c:v", "libx264", "-preset", "ultrafast", "-qp", "0", reference]
+        await run_process(command)
+        references.append(reference)
+
+    async def lowest_score(crf: int) -> float:
+        scores = []
+        for number, reference in enumerate(references):
+            encoded = os.path.join(work_dir, f"encoded_{number}.mkv")
+            await run_process([
+                "ffmpeg", "-nostdin", "-y", "-i", reference, "-c:v", "libx264", "-preset", preset,
+                "-crf", str(crf), "-threads", str(threads), encoded,
+            ])
+            result = await run_process([
+                "ffmpeg", "-nostdin", "-i", encoded, "-i", reference,
+                "-lavfi", f"[0:v][1:v]libvmaf=n_threads={threads}", "-f", "null", "-",
+            ])
+            match = VMAF_SCORE.search(result.stderr)
+            if not match:
+                raise ValueError("libvmaf printed no score")
+            scores.append(float(match.group(1)))
+        print(f"[TUNER] crf {crf}: lowest VMAF {min(scores):.2f} (need {target:g})")
+        return min(scores)
+
+    low, high = ENCODE_TUNER_MIN_CRF, ENCODE_TUNER_MAX_CRF
+    best = ENCODE_TUNER_MIN_CRF
+    score = None
+    while low <= high:
+        crf = (low + high) // 2
+        crf_score = await lowest_score(crf)
+        if crf_score >= target:
+            best, score = crf, crf_score
+            low = crf + 1
+        else:
+            high = crf - 1
+    return {"preset": preset, "crf": best, "threads": threads, "vmaf": round(score, 2) if score is not None else None}
+
+
+async def tune_encode(source_path: str, profile: EncodeProfile, duration: float, height: int, work_dir: str,
+                      video_options: list = None, crf: int = None, preset: str = None, start: float = 0.0) -> dict:
+    """
+    Preset, CRF and thread count for encoding source_path with libx264 to meet profile, from
+    cached calibrations for the same resolution class and video options, or from encoding
+    short samples of the source. The encode covers duration seconds from start; video_options
+    are the output options that shape the picture (-vf, -s, ...).
+
+    Speed targets cache the speed measured for each preset rather than the preset chosen, as
+    the speed a deadline needs depends on the duration: each job picks its own preset from them.
+    Returns the settings plus how they were obtained ("cached" or the calibration time).
+    """
+    video_options = video_options or []
+    started_at = time.monotonic()
+    windows = [(start + offset, length) for offset, length in sample_windows(duration)]
+    if profile.kind == "vmaf":
+        preset = preset or ENCODE_TUNER_VMAF_PRESET
+        key = json.dumps([str(profile), resolution_class(height), video_options, ENCODE_TUNER_THREADS, None, preset])
+        cached = await tuning_cache.get(key)
+        if cached is not None:
+            print(f"[TUNER] Using cached calibration for {profile} at {resolution_class(height)}: {cached}")
+            return {**cached, "calibration": "cached"}
+        if not await _vmaf_available():
+            raise ValueError("encode_profile vmaf needs an ffmpeg built with libvmaf")
+        print(f"[TUNER] Calibrating {profile} at {resolution_class(height)} on {len(windows)} samples")
+        settings = await _calibrate_vmaf(
+            source_path, windows, video_options, preset, ENCODE_TUNER_THREADS, profile.value, work_dir
+        )
+        await tuning_cache.put(key, settings)
+    else:
+        if profile.kind == "realtime":
+            crf, required_speed = crf or ENCODE_TUNER_DEFAULT_CRF, profile.value
+        else:
+            if not duration:
+                # Without it every preset looks fast enough, and the slowest one would be chosen
+                raise ValueError("a deadline needs the source's duration, which is unknown")
+            crf, required_speed = crf or ENCODE_TUNER_QUALITY_CRF, duration / (profile.value * 60)
+        key = json.dumps(["speed", resolution_class(height), video_options, ENCODE_TUNER_THREADS, crf])
+        measurements = await tuning_cache.get(key) or {"speeds": {}, "slower_than": {}}
+        known = dict(measurements["speeds"]), dict(measurements["slower_than"])
+        print(f"[TUNER] Choosing a preset for {profile} at {resolution_class(height)} "
+              f"({len(known[0])} preset speeds cached, {len(windows)} samples)")
+        settings = await _calibrate_speed(
+            source_path, windows, video_options, crf, ENCODE_TUNER_THREADS, required_speed, measurements
+        )
+        if (measurements["speeds"], measurements["slower_than"]) == known:
+            print(f"[TUNER] Using cached preset speeds for {profile} at {resolution_class(height)}: {settings}")
+            return {**settings, "calibration": "cached"}
+        await tuning_cache.put(key, measurements)
+    calibration_seconds = round(time.monotonic() - started_at, 2)
+    print(f"[TUNER] Calibrated {profile} in {calibration_seconds}s: {settings}")
+    return {**settings, "calibration": f"{calibration_seconds}s"}
+
+
+async def tune_source(profile: EncodeProfile, bucket_manager, uri: str, metadata: dict, source_path: str, work_dir: str,
+                      trim_window: tuple = None, **options):
+    """
+    tune_encode for a source object staged at source_path, with its duration and frame height
+    from describe_media; trim_window (start, end) limits the encode to part of it. A duration
+    that cannot be read is estimated from the object size at COST_ASSUMED_BITRATE, as for job
+    costs. Returns None when calibration fails, after logging why, so the encode runs with the
+    settings it asked for.
+    """
+    description = await describe_media(bucket_manager, uri, metadata)
+    start, duration = 0.0, description["duration"]
+    if duration is None and metadata and metadata.get("size"):
+        duration = metadata["size"] * 8 / COST_ASSUMED_BITRATE
+        print(f"[TUNER] Duration of {uri} unknown, assuming {duration:.0f}s from its size")
+    if trim_window:
+        start, end = trim_window
+        if end is not None and (duration is None or end < duration):
+            duration = end
+        duration = duration - start if duration is not None else None
+    try:
+        return await tune_encode(source_path, profile, duration, description["height"], work_dir, start=start, **options)
+    except Exception as e:
+        print(f"[TUNER] Warning: could not calibrate {profile}, encoding with the requested settings: {e}")
+        return None
+
+
+def x264_options(settings: dict) -> list:
+    return ["-c:v", "libx264", "-preset", settings["preset"], "-crf", str(settings["crf"]), "-threads", str(settings["threads"])]
+
+
+def describe_tuning(profile: EncodeProfile, settings: dict) -> str:
+    measured = f", {settings['speed']}x real time" if settings.get("speed") else f", VMAF {settings['vmaf']}" if settings.get("vmaf") else ""
+    return (f"encode_profile {profile}: preset {settings['preset']}, crf {settings['crf']}, "
+            f"{settings['threads']} threads ({settings['calibration']} calibration{measured})")
@@ -0,0 +1,435 @@
+import os
+import shlex
+from dotenv import load_dotenv
+
+from media_index import parse_ffmpeg_time
+
+load_dotenv()
+
+# Applied to re-encoding outputs that don't set them explicitly (unset = leave to ffmpeg)
+FFMPEG_THREADS = os.getenv("FFMPEG_THREADS")
+FFMPEG_X264_PRESET = os.getenv("FFMPEG_X264_PRESET")
+
+INPUT_PLACEHOLDER = "INPUT_FILE"
+OUTPUT_PLACEHOLDER = "OUTPUT_FILE"
+
+# Options that never take a value
+BOOLEAN_FLAGS = {
+    "-y", "-n", "-hide_banner", "-nostdin", "-stdin", "-stats", "-nostats", "-benchmark", "-benchmark_all",
+    "-report", "-xerror", "-ignore_unknown", "-copy_unknown", "-an", "-vn", "-sn", "-dn", "-shortest",
+    "-re", "-copyts", "-start_at_zero", "-accurate_seek", "-noaccurate_seek", "-autorotate",
+    "-noautorotate", "-copyinkf", "-fix_sub_duration", "-dump", "-hex",
+}
+# Options that apply to the whole command rather than to one input or output
+GLOBAL_OPTIONS = {
+    "-y", "-n", "-hide_banner", "-nostdin", "-stdin", "-stats", "-nostats", "-benchmark", "-benchmark_all",
+    "-report", "-xerror", "-ignore_unknown", "-copy_unknown", "-loglevel", "-v", "-progress",
+    "-stats_period", "-filter_complex", "-lavfi", "-filter_complex_script", "-filter_threads",
+    "-filter_complex_threads", "-max_error_rate", "-abort_on",
+}
+FILTER_OPTIONS = {"-vf", "-af", "-filter", "-filter:v", "-filter:a", "-filter_script"}
+CODEC_OPTIONS = {"-c", "-codec", "-c:v", "-c:a", "-codec:v", "-codec:a", "-vcodec", "-acodec"}
+# Options that only make sense when encoding; any of these rules out stream copy
+ENCODING_OPTIONS = {
+    "-crf", "-qp", "-b", "-b:v", "-b:a", "-maxrate", "-bufsize", "-preset", "-tune", "-profile",
+    "-profile:v", "-level", "-r", "-s", "-pix_fmt", "-ar", "-ac", "-q", "-q:v", "-q:a", "-qscale",
+    "-aspect", "-g", "-keyint_min", "-x264-params", "-x265-params", "-x264opts", "-vframes",
+    "-frames:v", "-aframes", "-sample_fmt", "-channel_layout",
+}
+# Filters whose output does not depend on frame timestamps, so seeking before or after them is equivalent
+TIMESTAMP_AGNOSTIC_FILTERS = {
+    "scale", "crop", "pad", "format", "hflip", "vflip", "transpose", "setsar", "setdar", "null",
+    "anull", "unsharp", "eq", "hqdn3d", "boxblur", "gblur", "colorchannelmixer", "lut", "lutrgb",
+    "lutyuv", "hue", "negate", "grayscale", "volume", "aresample", "aformat", "pan", "highpass",
+    "lowpass", "equalizer", "bass", "treble",
+}
+# Codecs each output container can hold without re-encoding (None = anything)
+CONTAINER_CODECS = {
+    "mp4": {"h264", "hevc", "av1", "vp9", "mpeg4", "aac", "mp3", "ac3", "eac3", "alac", "opus", "flac"},
+    "m4v": {"h264", "hevc", "av1", "vp9", "mpeg4", "aac", "mp3", "ac3", "eac3", "alac", "opus", "flac"},
+    "mov": {"h264", "hevc", "prores", "mpeg4", "mjpeg", "aac", "mp3", "ac3", "alac", "pcm_s16le", "pcm_s24le"},
+    "mkv": None,
+    "webm": {"vp8", "vp9", "av1", "opus", "vorbis"},
+    "ts": {"h264", "hevc", "mpeg2video", "aac", "mp3", "ac3", "eac3"},
+}
+# Encoders ffmpeg picks for these containers when no video codec is given
+DEFAULT_VIDEO_ENCODERS = {"mp4": "libx264", "m4v": "libx264", "mov": "libx264", "mkv": "libx264", "ts": "libx264"}
+
+
+class FFmpegCommandError(ValueError):
+    """Raised when an ffmpeg command string cannot be parsed into a plan."""
+
+
+class FFmpegFile:
+    """One input or output of an ffmpeg command, with the options that precede it."""
+
+    def __init__(self, path: str, options: list = None):
+        self.path = path
+        # [flag, value] pairs in command order; value is None for boolean flags
+        self.options = options or []
+
+    def get(self, *flags):
+        for flag, value in self.options:
+            if flag in flags:
+                return value
+        return None
+
+    def has(self, *flags) -> bool:
+        return any(flag in flags for flag, _ in self.options)
+
+    def remove(self, *flags):
+        self.options = [option for option in self.options if option[0] not in flags]
+
+    def set(self, flag: str, value: str = None):
+        for option in self.options:
+            if option[0] == flag:
+                option[1] = value
+                return
+        self.options.append([flag, value])
+
+    def args(self) -> list:
+        parts = []
+        for flag, value in self.options:
+            parts.append(flag)
+            if value is not None:
+                parts.append(value)
+        return parts
+
+
+class FFmpegPlan:
+    """
+    Structured form of an ffmpeg command: global options, inputs and outputs, each with their own options.
+    The source video is the input whose path is INPUT_FILE; the uploaded result is the output whose path is OUTPUT_FILE.
+    """
+
+    def __init__(self, global_options: list, inputs: list, outputs: list):
+        self.global_options = global_options
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def global_has(self, *flags) -> bool:
+        return any(flag in flags for flag, _ in self.global_options)
+
+    def to_args(self, input_path: str = INPUT_PLACEHOLDER, output_path: str = OUTPUT_PLACEHOLDER) -> list:
+        parts = ["ffmpeg"]
+        for flag, value in self.global_options:
+            parts.append(flag)
+            if value is not None:
+                parts.append(value)
+        for ffmpeg_input in self.inputs:
+            parts += ffmpeg_input.args()
+            parts += ["-i", input_path if ffmpeg_input.path == INPUT_PLACEHOLDER else ffmpeg_input.path]
+        for output in self.outputs:
+            parts += output.args()
+            parts.append(output_path if output.path == OUTPUT_PLACEHOLDER else output.path)
+        return parts
+
+    def to_command(self, input_path: str = INPUT_PLACEHOLDER, output_path: str = OUTPUT_PLACEHOLDER) -> str:
+        return shlex.join(self.to_args(input_path, output_path))
+
+
+def parse_ffmpeg_command(ffmpeg_command: str) -> FFmpegPlan:
+    """
+    Parses a request's ffmpeg_command into an FFmpegPlan. Quoted arguments are honoured, so filters
+    like -filter:v "setpts=0.5*PTS" survive intact.
+
+    Without INPUT_FILE/OUTPUT_FILE placeholders, the first -i (or a bare -i) is the source video and
+    the last output is the result, which is appended if the command names none.
+    """
+    try:
+        tokens = shlex.split(ffmpeg_command)
+    except ValueError as e:
+        raise FFmpegCommandError(f"Could not parse ffmpeg command: {e}")
+    if tokens and os.path.basename(tokens[0]) in ("ffmpeg", "ffmpeg.exe"):
+        tokens = tokens[1:]
+    has_placeholders = INPUT_PLACEHOLDER in tokens or OUTPUT_PLACEHOLDER in tokens
+
+    global_options = []
+    inputs = []
+    outputs = []
+    pending = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == "-i":
+            path = tokens[i + 1] if i + 1 < len(tokens) else None
+            if path is None or (path.startswith("-") and path != "-"):
+                # Bare -i: the source video goes here
+                path = INPUT_PLACEHOLDER
+                i += 1
+            else:
+                i += 2
+            if not has_placeholders and not inputs:
+                path = INPUT_PLACEHOLDER
+            inputs.append(FFmpegFile(path, pending))
+            pending = []
+        elif token.startswith("-") and len(token) > 1:
+            if token in BOOLEAN_FLAGS:
+                value = None
+                i += 1
+            elif i + 1 < len(tokens):
+                value = tokens[i + 1]
+                i += 2
+            else:
+                raise FFmpegCommandError(f"Option {token} is missing its value")
+            if token in GLOBAL_OPTIONS:
+                global_options.append([token, value])
+            else:
+                pending.append([token, value])
+        else:
+            outputs.append(FFmpegFile(token, pending))
+            pending = []
+            i += 1
+
+    if not inputs:
+        inputs.insert(0, FFmpegFile(INPUT_PLACEHOLDER))
+    if not outputs:
+        outputs.append(FFmpegFile(OUTPUT_PLACEHOLDER, pending))
+    else:
+        # Trailing options after the last output are kept with it
+        outputs[-1].options += pending
+    if not has_placeholders:
+        outputs[-1].path = OUTPUT_PLACEHOLDER
+    if not any(f.path == INPUT_PLACEHOLDER for f in inputs):
+        raise FFmpegCommandError("Command does not read the source video (use -i INPUT_FILE)")
+    if not any(f.path == OUTPUT_PLACEHOLDER for f in outputs):
+        raise FFmpegCommandError("Command does not write the result (use OUTPUT_FILE as the output)")
+
+    plan = FFmpegPlan(global_options, inputs, outputs)
+    # Always overwrite existing files without prompting
+    if not plan.global_has("-y"):
+        plan.global_options.insert(0, ["-y", None])
+    return plan
+
+
+def filter_names(filtergraph: str) -> list:
+    """
+    Names of the filters in a filtergraph string, ignoring link labels, options and quoted text.
+    """
+    names = []
+    current = ""
+    quote = None
+    depth = 0
+    for char in filtergraph + ",":
+        if quote:
+            if char == quote:
+                quote = None
+            continue
+        if char in "'\"":
+            quote = char
+        elif char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+        elif depth == 0 and char in ",;":
+            name = current.split("=", 1)[0].split("@", 1)[0].strip()
+            if name:
+                names.append(name)
+            current = ""
+        elif depth == 0:
+            current += char
+    return names
+
+
+def _uses_filters(plan: FFmpegPlan, output: FFmpegFile) -> bool:
+    return output.has(*FILTER_OPTIONS) or plan.global_has("-filter_complex", "-lavfi", "-filter_complex_script")
+
+
+def _filters_are_timestamp_agnostic(plan: FFmpegPlan, output: FFmpegFile) -> bool:
+    if plan.global_has("-filter_complex_script") or output.has("-filter_script"):
+        return False
+    graphs = [value for flag, value in plan.global_options if flag in ("-filter_complex", "-lavfi")]
+    graphs += [value for flag, value in output.options if flag in FILTER_OPTIONS]
+    return all(name in TIMESTAMP_AGNOSTIC_FILTERS for graph in graphs for name in filter_names(graph))
+
+
+def _can_stream_copy(plan: FFmpegPlan, output: FFmpegFile, output_extension: str, source_extension: str, probe: dict):
+    if _uses_filters(plan, output) or output.has(*CODEC_OPTIONS) or output.has(*ENCODING_OPTIONS):
+        return False
+    output_extension = output_extension.lower().lstrip(".")
+    if output_extension == source_extension.lower().lstrip("."):
+        return True
+    if output_extension not in CONTAINER_CODECS or not probe:
+        return False
+    allowed = CONTAINER_CODECS[output_extension]
+    for stream in probe.get("streams", []):
+        codec_type = stream.get("codec_type")
+        if codec_type in ("subtitle", "data"):
+            # Default stream selection may pick these up and they rarely survive a container change
+            return False
+        if codec_type == "video" and stream.get("disposition", {}).get("attached_pic"):
+            continue
+        if codec_type in ("video", "audio") and allowed is not None and stream.get("codec_name") not in allowed:
+            return False
+    return True
+
+
+def _video_encoder(output: FFmpegFile, output_extension: str):
+    if output.has("-vn"):
+        return None
+    codec = output.get("-c:v", "-codec:v", "-vcodec", "-c", "-codec")
+    if codec is None:
+        return DEFAULT_VIDEO_ENCODERS.get(output_extension.lower().lstrip("."))
+    return codec
+
+
+def optimize_plan(plan: FFmpegPlan, output_extension: str, source_extension: str = "", probe: dict = None) -> list:
+    """
+    Rewrites a single-input, single-output plan into a faster equivalent, in place.
+    Returns a list of human-readable notes describing each rewrite.
+
+    - output-side -ss moves before -i (fast input seeking) when filters don't depend on timestamps
+    - plain trims/remuxes with no filters or codec settings switch to -c copy when the
+      output container can hold the source codecs (checked against ffprobe results when available)
+    - re-encoding x264/x265 outputs get the configured preset and thread count
+    """
+    notes = []
+    if len(plan.inputs) != 1 or len(plan.outputs) != 1 or plan.inputs[0].path != INPUT_PLACEHOLDER:
+        return notes
+    source = plan.inputs[0]
+    output = plan.outputs[0]
+
+    # Input seeking: ffmpeg jumps to the nearest keyframe instead of decoding everything before -ss
+    seek = output.get("-ss")
+    if seek is not None and not source.has("-ss") and not plan.global_has("-copyts") \
+            and _filters_are_timestamp_agnostic(plan, output):
+        try:
+            seek_seconds = parse_ffmpeg_time(seek)
+            end = output.get("-to")
+            if end is not None:
+                # Timestamps restart at zero after an input seek, so -to becomes a duration
+                output.remove("-to")
+                output.set("-t", f"{parse_ffmpeg_time(end) - seek_seconds:.6f}".rstrip("0").rstrip("."))
+            output.remove("-ss")
+            source.set("-ss", seek)
+            notes.append(f"moved -ss {seek} before -i for input seeking")
+        except ValueError:
+            pass
+
+    if _can_stream_copy(plan, output, output_extension, source_extension, probe):
+        output.set("-c", "copy")
+        notes.append("no filters or codec changes requested: using -c copy instead of re-encoding")
+        return notes
+
+    encoder = _video_encoder(output, output_extension)
+    if encoder in ("libx264", "libx265"):
+        if FFMPEG_X264_PRESET and not output.has("-preset"):
+            output.set("-preset", FFMPEG_X264_PRESET)
+            notes.append(f"applied configured preset {FFMPEG_X264_PRESET}")
+        if FFMPEG_THREADS and not output.has("-threads"):
+            output.set("-threads", FFMPEG_THREADS)
+            notes.append(f"applied configured thread count {FFMPEG_THREADS}")
+    return notes
+
+
+def stream_copy_candidate(plan: FFmpegPlan) -> bool:
+    """
+    True when the plan might be served with -c copy, i.e. when probing the source is worth it.
+    """
+    if len(plan.inputs) != 1 or len(plan.outputs) != 1:
+        return False
+    output = plan.outputs[0]
+    return not (_uses_filters(plan, output) or output.has(*CODEC_OPTIONS) or output.has(*ENCODING_OPTIONS))
+
+
+def explicit_stream_copy(plan: FFmpegPlan) -> bool:
+    """True when the command itself only copies: -c copy (or per-stream copies), no filters or encoding options."""
+    if len(plan.inputs) != 1 or len(plan.outputs) != 1:
+        return False
+    output = plan.outputs[0]
+    codecs = [value for flag, value in output.options if flag in CODEC_OPTIONS]
+    return (bool(codecs) and all(value == "copy" for value in codecs)
+            and not (_uses_filters(plan, output) or output.has(*ENCODING_OPTIONS)))
+
+
+VIDEO_FILTER_OPTIONS = ("-vf", "-filter:v")
+AUDIO_FILTER_OPTIONS = ("-af", "-filter:a")
+TIME_OPTIONS = ("-ss", "-t", "-to")
+# Output options that change the stream layout or timing in ways a later filter chain would observe
+_UNFUSABLE_OUTPUT_OPTIONS = {"-filter", "-filter_script", "-map", "-r", "-s", "-pix_fmt", "-ar", "-ac",
+                             "-frames:v", "-vframes", "-aframes", "-sample_fmt", "-channel_layout"}
+
+
+def _simple(plan: FFmpegPlan) -> bool:
+    return (len(plan.inputs) == 1 and len(plan.outputs) == 1 and plan.inputs[0].path == INPUT_PLACEHOLDER
+            and plan.outputs[0].path == OUTPUT_PLACEHOLDER
+            and not plan.global_has("-filter_complex", "-lavfi", "-filter_complex_script"))
+
+
+# Output options that change the encoded picture, so encode_profile calibration samples apply them too
+TUNING_VIDEO_OPTIONS = ("-vf", "-filter:v", "-s", "-r", "-pix_fmt")
+
+
+def tunable_x264_output(plan: FFmpegPlan, output_extension: str):
+    """
+    The output of a plan an encode_profile can tune: one source and one output, whose video is
+    encoded with libx264 and shaped only by TUNING_VIDEO_OPTIONS. None for anything else.
+    """
+    if not _simple(plan):
+        return None
+    output = plan.outputs[0]
+    if output.has("-filter", "-filter_script") or _video_encoder(output, output_extension) != "libx264":
+        return None
+    return output
+
+
+def fuse_plans(first: FFmpegPlan, second: FFmpegPlan):
+    """
+    Combines two chained single-input, single-output plans (second reads first's output) into one
+    plan whose filter chains are concatenated, so the video is decoded and encoded once.
+    Returns None when the pair can't be fused without changing the result.
+    """
+    if not (_simple(first) and _simple(second)):
+        return None
+    first_input, first_output = first.inputs[0], first.outputs[0]
+    second_input, second_output = second.inputs[0], second.outputs[0]
+    if second_input.options or first_output.has(*_UNFUSABLE_OUTPUT_OPTIONS, "-an", "-vn", "-sn"):
+        return None
+    if second_output.has(*_UNFUSABLE_OUTPUT_OPTIONS - {"-r", "-s", "-pix_fmt", "-ar", "-ac"}):
+        return None
+    first_filtered = first_output.has(*VIDEO_FILTER_OPTIONS, *AUDIO_FILTER_OPTIONS)
+    if first_filtered and first_output.has(*TIME_OPTIONS):
+        # A trim after a filter chain can't be expressed on the fused input
+        return None
+
+    fused_input = FFmpegFile(INPUT_PLACEHOLDER, [list(option) for option in first_input.options])
+    fused_output = FFmpegFile(OUTPUT_PLACEHOLDER)
+    for flag, value in first_output.options:
+        if flag in TIME_OPTIONS:
+            # Without filters, output timestamps equal input timestamps, so the trim can move to the input
+            if fused_input.has(flag):
+                return None
+            fused_input.set(flag, value)
+        elif flag not in VIDEO_FILTER_OPTIONS + AUDIO_FILTER_OPTIONS:
+            fused_output.options.append([flag, value])
+
+    if any(flag in CODEC_OPTIONS and value == "copy" for flag, value in second_output.options):
+        # A copying second step keeps what the first one encoded, which only survives fusing
+        # when the first step copies too
+        first_copies = (first_output.has(*CODEC_OPTIONS) and not first_output.has(*ENCODING_OPTIONS)
+                        and not first_filtered
+                        and all(value == "copy" for flag, value in first_output.options if flag in CODEC_OPTIONS))
+        if not first_copies:
+            return None
+    else:
+        # Run in sequence, the second step re-encodes with its own codec options, or the
+        # container's default encoder when it sets none, so the first step's are dropped
+        fused_output.remove(*CODEC_OPTIONS, *ENCODING_OPTIONS)
+    for flag, value in second_output.options:
+        if flag not in VIDEO_FILTER_OPTIONS + AUDIO_FILTER_OPTIONS:
+            fused_output.set(flag, value)
+
+    for flags in (VIDEO_FILTER_OPTIONS, AUDIO_FILTER_OPTIONS):
+        chain = [value for flag, value in first_output.options + second_output.options if flag in flags]
+        if chain:
+            fused_output.set(flags[0], ",".join(chain))
+    if fused_output.has(*VIDEO_FILTER_OPTIONS, *AUDIO_FILTER_OPTIONS):
+        # Filtered streams can't be stream-copied
+        fused_output.options = [option for option in fused_output.options
+                                if not (option[0] in CODEC_OPTIONS and option[1] == "copy")]
+
+    global_options = [list(option) for option in first.global_options]
+    for flag, value in second.global_options:
+        if not any(flag == existing for existing, _ in global_options):
+            global_options.append([flag, value])
+    return FFmpegPlan(global_options, [fused_input], [fused_output])
@@ -2,16 +2,19 @@ import os
 import json
 import time
 import base64
+import threading
 import requests
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.backends import default_backend
 from typing import Dict, Any
 from dotenv import load_dotenv
 
-load_dotenv()
+from shared_state import shared_state
 
+load_dotenv()
 
+# Overridable so the service can run against a local token endpoint (benchmarks, emulators)
+TOKEN_URI = os.getenv("GCP_TOKEN_URI", "https://oauth2.googleapis.com/token")
+# Access tokens are reused until this many seconds before they expire
+GCP_TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv("GCP_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
 
 
 def base64url_encode(data: bytes) -> str:
@@ -39,6 +42,11 @@ def create_jwt_token() -> str:
     if not all([private_key_str, key_id, client_email]):
         raise ValueError("Missing required environment variables: GCP_PRIVATE_KEY, GCP_KEY_ID, GCP_CLIENT_EMAIL")
     
+    # cryptography is only needed when a token is actually minted
+    from cryptography.hazmat.primitives import serialization, hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.backends import default_backend
+
     # Replace escaped newlines in private key
     private_key_str = private_key_str.replace('\\n', '\n')
     
@@ -64,7 +72,7 @@ def create_jwt_token() -> str:
     payload = {
         "iss": client_email,
         "sub": client_email,
-        "aud": "https://oauth2.googleapis.com/token",
+        "aud": TOKEN_URI,
         "iat": iat,
         "exp": exp,
         "scope": "https://www.googleapis.com/auth/generative-language https://www.googleapis.com/auth/cloud-platform"
@@ -93,12 +101,12 @@ def create_jwt_token() -> str:
     return jwt_token
 
 
-def get_oauth_access_token() -> str:
+def request_access_token() -> Dict[str, Any]:
     """
     Exchange JWT for OAuth2 access token.
     
     Returns:
-        str: OAuth2 access token that can be used for API calls
+        dict: The token endpoint's response, with access_token and expires_in
         
     Raises:
         requests.exceptions.RequestException: For network/HTTP errors
@@ -108,7 +116,7 @@ def get_oauth_access_token() -> str:
     jwt_token = create_jwt_token()
     
     # Exchange JWT for access token
-    token_url = "https://oauth2.googleapis.com/token"
+    token_url = TOKEN_URI
     
     data = {
         "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
@@ -129,7 +137,7 @@ def get_oauth_access_token() -> str:
         if not access_token:
             raise ValueError(f"No access token in response: {token_data}")
             
-        return access_token
+        return token_data
         
     except requests.exceptions.RequestException as e:
         raise requests.exceptions.RequestException(f"Failed to get access token: {str(e)}") from e
@@ -141,6 +149,62 @@ def get_oauth_access_token() -> str:
             raise ValueError(f"Token exchange failed: {response.text}") from e
 
 
+def get_oauth_access_token() -> str:
+    """
+    Exchange JWT for OAuth2 access token.
+    
+    Returns:
+        str: OAuth2 access token that can be used for API calls
+    """
+    return request_access_token()["access_token"]
+
+
+class TokenCache:
+    """
+    Keeps the current access token until shortly before it expires. Minting one signs a JWT
+    and makes a round trip to the token endpoint, which every request used to pay for.
+    """
+
+    def __init__(self, refresh_margin: float = GCP_TOKEN_REFRESH_MARGIN_SECONDS):
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0.0
+        self.refreshes = 0
+        self.lock = threading.Lock()
+
+    def valid(self) -> bool:
+        return self.token is not None and time.time() < self.expires_at - self.refresh_margin
+
+    def get(self) -> str:
+        if self.valid():
+            return self.token
+        # One thread refreshes; the others wait for its token instead of minting their own
+        with self.lock:
+            if not self.valid():
+                # With several workers, one of them may already have minted a fresh token
+                shared = shared_state.get_token("gcp") if shared_state else None
+                if shared and time.time() < shared[1] - self.refresh_margin:
+                    self.token, self.expires_at = shared
+                    return self.token
+                token_data = request_access_token()
+                self.token = token_data["access_token"]
+                self.expires_at = time.time() + float(token_data.get("expires_in", 3600))
+                self.refreshes += 1
+                if shared_state:
+                    shared_state.put_token("gcp", self.token, self.expires_at)
+            return self.token
+
+    def status(self) -> dict:
+        return {
+            "cached": self.valid(),
+            "expires_in_seconds": max(0, round(self.expires_at - time.time())) if self.token else None,
+            "refreshes": self.refreshes,
+        }
+
+
+token_cache = TokenCache()
+
+
 def authenticate_gcp() -> str:
     """
     Main function to authenticate with GCP and return an access token.
@@ -150,6 +214,8 @@ def authenticate_gcp() -> str:
     2. Exchanges the JWT for an OAuth2 access token
     3. Returns the access token for use with GCP APIs
     
+    The token is cached and reused until shortly before it expires.
+    
     Returns:
         str: OAuth2 access token that can be used for GCP API calls
         
@@ -157,11 +223,14 @@ def authenticate_gcp() -> str:
         ValueError: If authentication fails or credentials are missing
         requests.exceptions.RequestException: If network/HTTP errors occur
     """
+    if token_cache.valid():
+        return token_cache.token
+
     print("[AUTH] Starting GCP authentication process...")
     
     try:
         # Get the OAuth2 access token
-        access_token = get_oauth_access_token()
+        access_token = token_cache.get()
         print("[AUTH] Successfully obtained GCP access token")
         
         return access_token
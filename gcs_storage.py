@@ -0,0 +1,156 @@
+import os
+import base64
+import tempfile
+import threading
+import requests
+from typing import Callable
+
+# Uploads larger than this are sent in chunks of this size (a multiple of 256 KiB), so they can be aborted in between
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+
+
+class UploadCancelled(Exception):
+    """Raised inside the upload thread when an upload was aborted between chunks."""
+
+
+class GCSStorageManagerJWT:
+    """
+    A GCS bucket accessed with OAuth2 access tokens from token_provider. A job can outlive the
+    token it started with, so the token is resolved again before every operation; the provider
+    caches it, which makes that cheap until the token is about to expire.
+    """
+
+    def __init__(self, bucket_name: str, token_provider: Callable[[], str]):
+        self.bucket_name = bucket_name
+        self.token_provider = token_provider
+        # Imported here rather than at module level: google.cloud.storage takes a good part of
+        # a second to import, and the service should start accepting requests without it
+        from google.cloud import storage
+        from google.oauth2.credentials import Credentials as OAuth2Credentials
+
+        # OAuth2 credentials whose access token _authorize() replaces
+        self.credentials = OAuth2Credentials(token=None)
+
+        self.client = storage.Client(
+            credentials=self.credentials,
+            project=os.getenv("GCP_PROJECT_ID")
+        )
+        self.bucket = self.client.bucket(bucket_name)
+
+    def _authorize(self) -> str:
+        token = self.token_provider()
+        self.credentials.token = token
+        return token
+
+    def uri_to_url(self, uri: str) -> str:
+        if not uri.startswith("gs://"):
+            raise ValueError("Invalid GCS URI")
+        parts = uri[5:].split("/", 1)
+        bucket_name = parts[0]
+        blob_name = parts[1] if len(parts) > 1 else ""
+        return f"https://storage.googleapis.com/{bucket_name}/{blob_name}"
+
+    def uri(self, remote_path: str) -> str:
+        return f"gs://{self.bucket_name}/{remote_path}"
+
+    def blob_name(self, uri: str) -> str:
+        return uri.replace(f"gs://{self.bucket_name}/", "")
+
+    def get_metadata(self, uri: str) -> dict:
+        """
+        Fetch object metadata (no content) for a GCS URI.
+        """
+        self._authorize()
+        blob = self.bucket.get_blob(self.blob_name(uri))
+        if blob is None:
+            raise FileNotFoundError(f"Object not found: {uri}")
+        return {
+            "size": blob.size,
+            "generation": blob.generation,
+            "content_type": blob.content_type,
+        }
+
+    def read_range(self, uri: str, start: int, end: int) -> bytes:
+        """
+        Read bytes [start, end) of an object.
+        """
+        self._authorize()
+        blob = self.bucket.blob(self.blob_name(uri))
+        return blob.download_as_bytes(start=start, end=end - 1, checksum=None)
+
+    def download_ranges(self, uri: str, local_path: str, total_size: int, ranges: list):
+        """
+        Download only the given byte ranges into a sparse local file of the object's full size.
+        Every other byte reads back as zero without taking disk space.
+        """
+        print(f"[GCS] Starting ranged download from: {uri} ({len(ranges)} ranges, "
+              f"{sum(end - start for start, end in ranges)} of {total_size} bytes)")
+        self._authorize()
+        blob = self.bucket.blob(self.blob_name(uri))
+        with open(local_path, "wb") as f:
+            f.truncate(total_size)
+            for start, end in ranges:
+                f.seek(start)
+                blob.download_to_file(f, start=start, end=end - 1, checksum=None)
+        print(f"[GCS] Ranged download completed to: {local_path}")
+
+    def upload(self, local_path: str, remote_path: str, content_type: str = None, cache_control: str = None,
+               cancel_event: threading.Event = None):
+        print(f"[GCS] Starting upload: {local_path} -> gs://{self.bucket_name}/{remote_path}")
+        self._authorize()
+        blob = self.bucket.blob(remote_path)
+        if cache_control:
+            blob.cache_control = cache_control
+        if cancel_event is not None and os.path.getsize(local_path) > UPLOAD_CHUNK_BYTES:
+            self._upload_in_chunks(blob, local_path, content_type, cancel_event)
+        else:
+            blob.upload_from_filename(local_path, content_type=content_type)
+        uri = self.uri(remote_path)
+        print(f"[GCS] Upload completed. File URL: {self.uri_to_url(uri)}")
+        return uri
+
+    def _upload_in_chunks(self, blob, local_path: str, content_type: str, cancel_event: threading.Event):
+        """Resumable upload that checks cancel_event before every chunk and abandons the session when it is set."""
+        total = os.path.getsize(local_path)
+        session_url = blob.create_resumable_upload_session(content_type=content_type, size=total)
+        with open(local_path, "rb") as f:
+            offset = 0
+            while offset < total:
+                if cancel_event.is_set():
+                    try:
+                        requests.delete(session_url, timeout=10)
+                    except requests.exceptions.RequestException:
+                        pass
+                    print(f"[GCS] Upload aborted after {offset} of {total} bytes: {local_path}")
+                    raise UploadCancelled(f"Upload of {local_path} was cancelled")
+                chunk = f.read(UPLOAD_CHUNK_BYTES)
+                response = requests.put(
+                    session_url, data=chunk, timeout=300,
+                    headers={"Content-Range": f"bytes {offset}-{offset + len(chunk) - 1}/{total}"}
+                )
+                if response.status_code not in (200, 201, 308):
+                    raise Exception(f"Upload of {local_path} failed: HTTP {response.status_code} {response.text}")
+                offset += len(chunk)
+
+    def download(self, uri: str, local_path: str):
+        print(f"[GCS] Starting download from: {uri}")
+        self._authorize()
+        blob = self.bucket.blob(self.blob_name(uri))
+        blob.download_to_filename(local_path)
+        print(f"[GCS] Download completed to: {local_path}")
+
+    def download_to_b64(self, uri: str) -> str:
+        self._authorize()
+        blob = self.bucket.blob(self.blob_name(uri))
+        data = blob.download_as_bytes()
+        return base64.b64encode(data).decode('utf-8')
+
+    def download_to_tempfile(self, uri: str):
+        print(f"[GCS] Starting download from: {uri}")
+        self._authorize()
+        blob = self.bucket.blob(self.blob_name(uri))
+        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        blob.download_to_filename(temp_file.name)
+        print(f"[GCS] Download completed to temporary file: {temp_file.name}")
+        return temp_file
+
@@ -0,0 +1,235 @@
+import os
+import shlex
+import asyncio
+from typing import Callable
+from uuid import uuid4
+from dotenv import load_dotenv
+
+from storage import storage_for, upload_cancellable
+from media_index import describe_media
+from process_runner import run_process
+from workspace import workspace_manager
+from job_store import checkpoint_reached, record_checkpoint
+
+load_dotenv()
+
+# x264 preset used for every rendition of the ladder
+PACKAGE_X264_PRESET = os.getenv("PACKAGE_X264_PRESET", "veryfast")
+# Segments uploaded at the same time while the ladder is being encoded
+PACKAGE_UPLOAD_CONCURRENCY = int(os.getenv("PACKAGE_UPLOAD_CONCURRENCY", "8"))
+# How often the output directory is checked for finished segments
+PACKAGE_POLL_SECONDS = float(os.getenv("PACKAGE_POLL_SECONDS", "1"))
+
+# (height, video kbps, audio kbps)
+DEFAULT_LADDER = [(1080, 5000, 128), (720, 2800, 128), (480, 1400, 96), (360, 800, 96)]
+
+PLAYLIST_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+SEGMENT_CONTENT_TYPE = "video/iso.segment"
+# Playlists change while the ladder is encoded, so caches must not keep them
+PLAYLIST_CACHE_CONTROL = "no-cache, max-age=0"
+
+
+class Rendition:
+    def __init__(self, height: int, video_kbps: int, audio_kbps: int = 128):
+        self.height = height
+        self.video_kbps = video_kbps
+        self.audio_kbps = audio_kbps
+
+
+def build_package_command(input_path: str, output_dir: str, renditions: list, segment_duration: float, has_audio: bool = True) -> list:
+    """
+    One ffmpeg invocation encoding the whole ladder from a single decode: the video is split
+    once per rendition and each branch scaled to its height (never upscaled). Keyframes are
+    forced on segment boundaries so all renditions switch cleanly, and the output is HLS with
+    fMP4 segments, one directory (v0, v1, ...) per rendition plus master.m3u8.
+    """
+    count = len(renditions)
+    graph = [f"[0:v]split={count}" + "".join(f"[split{index}]" for index in range(count))]
+    for index, rendition in enumerate(renditions):
+        graph.append(f"[split{index}]scale=-2:'min({rendition.height},ih)'[video{index}]")
+
+    command = ["ffmpeg", "-y", "-i", input_path, "-filter_complex", ";".join(graph)]
+    for index in range(count):
+        command += ["-map", f"[video{index}]"]
+        if has_audio:
+            command += ["-map", "0:a:0"]
+    command += [
+        "-c:v", "libx264", "-preset", PACKAGE_X264_PRESET, "-pix_fmt", "yuv420p",
+        "-force_key_frames", f"expr:gte(t,n_forced*{segment_duration})", "-sc_threshold", "0",
+    ]
+    for index, rendition in enumerate(renditions):
+        command += [
+            f"-b:v:{index}", f"{rendition.video_kbps}k",
+            f"-maxrate:v:{index}", f"{int(rendition.video_kbps * 1.1)}k",
+            f"-bufsize:v:{index}", f"{rendition.video_kbps * 2}k",
+        ]
+        if has_audio:
+            command += [f"-b:a:{index}", f"{rendition.audio_kbps}k"]
+    if has_audio:
+        command += ["-c:a", "aac", "-ac", "2"]
+
+    stream_map = " ".join(f"v:{index},a:{index}" if has_audio else f"v:{index}" for index in range(count))
+    command += [
+        "-f", "hls",
+        "-hls_time", str(segment_duration),
+        # EVENT playlists only grow, so players can start on the renditions before the encode ends
+        "-hls_playlist_type", "event",
+        "-hls_flags", "independent_segments+temp_file",
+        "-hls_segment_type", "fmp4",
+        "-hls_segment_filename", os.path.join(output_dir, "v%v", "segment_%05d.m4s"),
+        "-master_pl_name", "master.m3u8",
+        "-var_stream_map", stream_map,
+        os.path.join(output_dir, "v%v", "index.m3u8"),
+    ]
+    return command
+
+
+def playlist_entries(playlist: str) -> list:
+    """Files a media playlist refers to: its init section and the segments listed so far."""
+    entries = []
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-MAP:"):
+            entries.append(line.split('URI="', 1)[1].split('"', 1)[0])
+        elif line and not line.startswith("#"):
+            entries.append(line)
+    return entries
+
+
+class SegmentUploader:
+    """
+    Uploads an HLS output directory while ffmpeg is still writing it.
+
+    ffmpeg lists a segment in its playlist only after finishing it, so every file a playlist
+    refers to is complete. Each pass uploads the newly listed files in parallel, then the
+    playlists that refer to them, and the master playlist once every rendition has one.
+    """
+
+    def __init__(self, bucket_manager, local_dir: str, prefix: str, renditions: int,
+                 concurrency: int = PACKAGE_UPLOAD_CONCURRENCY):
+        self.bucket_manager = bucket_manager
+        self.local_dir = local_dir
+        self.prefix = prefix
+        self.renditions = renditions
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.uploaded = set()
+        self.playlists = {}
+        self.master_uploaded = False
+        self.segments = 0
+
+    async def _upload(self, relative_path: str, content_type: str, cache_control: str = None):
+        async with self.semaphore:
+            await upload_cancellable(
+                self.bucket_manager, os.path.join(self.local_dir, relative_path),
+                f"{self.prefix}/{relative_path}", content_type, cache_control
+            )
+
+    async def sync(self):
+        pending = []
+        playlists = {}
+        for index in range(self.renditions):
+            path = os.path.join(self.local_dir, f"v{index}", "index.m3u8")
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                playlist = f.read()
+            if playlist == self.playlists.get(index):
+                continue
+            playlists[index] = playlist
+            for entry in playlist_entries(playlist):
+                relative_path = f"v{index}/{entry}"
+                if relative_path not in self.uploaded:
+                    pending.append(relative_path)
+
+        await asyncio.gather(*(
+            self._upload(relative_path, "video/mp4" if relative_path.endswith(".mp4") else SEGMENT_CONTENT_TYPE)
+            for relative_path in pending
+        ))
+        self.uploaded.update(pending)
+        self.segments += sum(1 for relative_path in pending if relative_path.endswith(".m4s"))
+
+        await asyncio.gather(*(
+            self._upload(f"v{index}/index.m3u8", PLAYLIST_CONTENT_TYPE, PLAYLIST_CACHE_CONTROL)
+            for index in playlists
+        ))
+        self.playlists.update(playlists)
+
+        if not self.master_uploaded and len(self.playlists) == self.renditions:
+            if os.path.exists(os.path.join(self.local_dir, "master.m3u8")):
+                await self._upload("master.m3u8", PLAYLIST_CONTENT_TYPE, PLAYLIST_CACHE_CONTROL)
+                self.master_uploaded = True
+                print(f"[PACKAGE] Master playlist is live: {self.bucket_manager.uri(self.prefix)}/master.m3u8")
+
+    async def follow(self, process: asyncio.Task):
+        """Uploads output as it appears until process finishes, then the rest; returns process' result."""
+        try:
+            while True:
+                done, _ = await asyncio.wait({process}, timeout=PACKAGE_POLL_SECONDS)
+                if done:
+                    break
+                await self.sync()
+            result = process.result()
+            await self.sync()
+            return result
+        finally:
+            if not process.done():
+                process.cancel()
+                await asyncio.gather(process, return_exceptions=True)
+
+
+async def package_gcs_video(video_uri: str, bucket_name: str, token_provider: Callable[[], str], renditions: list, segment_duration: float = 4, return_raw_output: bool = False, job=None) -> dict:
+    """
+    Download a video once, encode an adaptive-bitrate ladder from a single decode and
+    publish it as HLS (fMP4 segments) under packaged/<id>/. Segments and playlists are
+    uploaded while the encode runs, so playback can start before the ladder is finished.
+    """
+    if checkpoint_reached(job, "output_uploaded"):
+        return job.checkpoints["output_uploaded"]
+
+    print(f"[PACKAGE] Packaging {video_uri} into {len(renditions)} renditions")
+    bucket_manager = storage_for(bucket_name, token_provider)
+    metadata = await asyncio.to_thread(bucket_manager.get_metadata, video_uri)
+    source_extension = os.path.splitext(bucket_manager.blob_name(video_uri))[1]
+    if job:
+        await job.reset_if_source_changed(metadata["generation"])
+    description = await describe_media(bucket_manager, video_uri, metadata)
+    has_audio = description["has_audio"] is not False
+
+    async with workspace_manager.job(metadata["size"], job_id=job and job.id, keep_on_cancel=job is not None) as workspace:
+        input_path = workspace.file("input" + source_extension)
+        if checkpoint_reached(job, "source_downloaded", input_path):
+            print(f"[PACKAGE] Reusing video downloaded by an earlier attempt")
+        else:
+            await asyncio.to_thread(bucket_manager.download, video_uri, input_path)
+            await record_checkpoint(job, "source_downloaded", path=input_path, generation=metadata["generation"])
+
+        # Segments are uploaded to a fresh prefix on every attempt, so the encode always starts over
+        output_dir = workspace.file("hls")
+        for index in range(len(renditions)):
+            os.makedirs(os.path.join(output_dir, f"v{index}"), exist_ok=True)
+        command_parts = build_package_command(input_path, output_dir, renditions, segment_duration, has_audio)
+        print(f"[PACKAGE] Executing command: {shlex.join(command_parts)}")
+
+        prefix = f"packaged/{uuid4()}"
+        uploader = SegmentUploader(bucket_manager, output_dir, prefix, len(renditions))
+        result = await uploader.follow(asyncio.create_task(run_process(command_parts)))
+        print(f"[PACKAGE] Uploaded {uploader.segments} segments to {bucket_manager.uri(prefix)}/")
+
+        response = {
+            "result_uri": bucket_manager.uri(f"{prefix}/master.m3u8"),
+            "renditions": [
+                {
+                    "height": rendition.height,
+                    "video_kbps": rendition.video_kbps,
+                    "audio_kbps": rendition.audio_kbps if has_audio else None,
+                    "playlist_uri": bucket_manager.uri(f"{prefix}/v{index}/index.m3u8"),
+                }
+                for index, rendition in enumerate(renditions)
+            ],
+            "segment_duration": segment_duration,
+            "segments": uploader.segments,
+        }
+        if return_raw_output:
+            response.update({"command": shlex.join(command_parts), "stderr": result.stderr, "resource_usage": result.usage})
+        await record_checkpoint(job, "output_uploaded", **response)
+        return response
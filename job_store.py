@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+from uuid import uuid4
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from workspace import SCRATCH_DIR, pid_is_alive
+
+load_dotenv()
+
+# SQLite database holding job state and stage checkpoints. Keep it (and SCRATCH_DIR) on a
+# persistent volume so jobs survive redeploys.
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", os.path.join(SCRATCH_DIR, "jobs.sqlite3"))
+# A job that has been started this many times without finishing is marked failed instead of resumed
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Finished jobs are purged from the store after this long
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# How often a running job checks whether it was cancelled through another worker process
+JOB_CANCEL_POLL_SECONDS = float(os.getenv("JOB_CANCEL_POLL_SECONDS", "1"))
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    request TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner_pid INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (job_id, stage)
+);
+"""
+
+
+class JobCancelled(Exception):
+    """Raised to the waiters of a job that was cancelled (DELETE /jobs/{id} or every client gone)."""
+
+
+class Job:
+    """
+    A stored job and its checkpoints. Passed down the processing functions so each stage can
+    record what it finished and, on a resumed run, skip what an earlier attempt already did.
+    """
+
+    def __init__(self, store, job_id: str, kind: str, request: dict, checkpoints: dict = None):
+        self.store = store
+        self.id = job_id
+        self.kind = kind
+        self.request = request
+        self.checkpoints = checkpoints or {}
+
+    async def checkpoint(self, stage: str, **data):
+        self.checkpoints[stage] = data
+        await asyncio.to_thread(self.store.checkpoint, self.id, stage, data)
+
+    async def reset_if_source_changed(self, generation: int):
+        """Drops all checkpoints if the source object was overwritten since they were recorded."""
+        recorded = self.checkpoints.get("source_downloaded", {}).get("generation")
+        if recorded is not None and recorded != generation:
+            print(f"[JOBS] Source of job {self.id} changed since the last attempt, starting over")
+            self.checkpoints = {}
+            await asyncio.to_thread(self.store.clear_checkpoints, self.id)
+
+
+def checkpoint_reached(job: Job, stage: str, artifact_path: str = None) -> bool:
+    """
+    True if the job already passed `stage` (and its local artifact, if any, survived).
+    Always False for untracked runs (job is None).
+    """
+    if job is None or stage not in job.checkpoints:
+        return False
+    return artifact_path is None or os.path.exists(artifact_path)
+
+
+async def record_checkpoint(job: Job, stage: str, **data):
+    if job is not None:
+        await job.checkpoint(stage, **data)
+
+
+class JobStore:
+    """
+    Durable job records on SQLite in WAL mode. Writes are small and infrequent (a few per
+    job), so a single connection behind a lock is enough. Workers share the database, so a
+    call can wait up to busy_timeout for another worker's write: the app calls it on threads.
+    """
+
+    def __init__(self, path: str = JOB_STORE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.executescript(SCHEMA)
+            self.connection = connection
+        return self.connection
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> list:
+        with self.lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction: committed when the block completes, rolled back if it (or the commit) raises."""
+        with self.lock:
+            connection = self._connect()
+            connection.execute("BEGIN")
+            try:
+                yield connection
+                connection.execute("COMMIT")
+            except BaseException:
+                # SQLite may already have rolled back on its own (e.g. disk full)
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+
+    def create(self, kind: str, request: dict) -> Job:
+        job_id = uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (id, kind, status, request, owner_pid, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, PENDING, json.dumps(request), os.getpid(), now, now)
+        )
+        print(f"[JOBS] Created {kind} job {job_id}")
+        return Job(self, job_id, kind, request)
+
+    def mark_running(self, job_id: str) -> bool:
+        """False if the job was cancelled meanwhile (it must not run)."""
+        with self.lock:
+            cursor = self._connect().execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, owner_pid = ?, updated_at = ? WHERE id = ? AND status != ?",
+                (RUNNING, os.getpid(), time.time(), job_id, CANCELLED)
+            )
+            return cursor.rowcount > 0
+
+    def checkpoint(self, job_id: str, stage: str, data: dict):
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO checkpoints (job_id, stage, data, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, stage, json.dumps(data), now)
+            )
+            connection.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (now, job_id))
+        print(f"[JOBS] Job {job_id} reached checkpoint '{stage}'")
+
+    def clear_checkpoints(self, job_id: str):
+        self._execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+
+    def finish(self, job_id: str, result: dict) -> bool:
+        """Records the result; False (and nothing recorded) if the job was cancelled meanwhile."""
+        with self.lock:
+            cursor = self._connect().execute(
+                "UPDATE jobs SET status = ?, result = ?, error = NULL, updated_at = ? WHERE id = ? AND status != ?",
+                (SUCCEEDED, json.dumps(result), time.time(), job_id, CANCELLED)
+            )
+            return cursor.rowcount > 0
+
+    def fail(self, job_id: str, error: str):
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status != ?",
+            (FAILED, error, time.time(), job_id, CANCELLED)
+        )
+
+    def is_cancelled(self, job_id: str) -> bool:
+        return self._execute("SELECT 1 FROM jobs WHERE id = ? AND status = ?", (job_id, CANCELLED)) != []
+
+    def cancel(self, job_id: str) -> bool:
+        """Marks an unfinished job cancelled so it is never resumed; False if it already finished."""
+        with self.lock:
+            cursor = self._connect().execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status IN (?, ?)",
+                (CANCELLED, "Cancelled", time.time(), job_id, PENDING, RUNNING)
+            )
+            return cursor.rowcount > 0
+
+    def load(self, job_id: str) -> Job:
+        rows = self._execute("SELECT kind, request FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        checkpoints = {
+            stage: json.loads(data)
+            for stage, data in self._execute("SELECT stage, data FROM checkpoints WHERE job_id = ?", (job_id,))
+        }
+        return Job(self, job_id, rows[0][0], json.loads(rows[0][1]), checkpoints)
+
+    def get(self, job_id: str) -> dict:
+        """Public view of a job: state, result/error and the checkpoints reached so far."""
+        rows = self._execute(
+            "SELECT kind, status, result, error, attempts, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)
+        )
+        if not rows:
+            return None
+        kind, status, result, error, attempts, created_at, updated_at = rows[0]
+        checkpoints = self._execute(
+            "SELECT stage, created_at FROM checkpoints WHERE job_id = ? ORDER BY created_at", (job_id,)
+        )
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "status": status,
+            "attempts": attempts,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "checkpoints": [{"stage": stage, "at": at} for stage, at in checkpoints],
+            "result": json.loads(result) if result else None,
+            "error": error,
+        }
+
+    def resumable_jobs(self) -> list:
+        """
+        Unfinished jobs whose worker is gone, claimed for this worker (so with several workers
+        starting at once, each job is resumed by exactly one). Jobs that already used up
+        JOB_MAX_ATTEMPTS (e.g. ones that keep crashing the worker) are marked failed instead.
+        """
+        jobs = []
+        rows = self._execute(
+            "SELECT id, attempts, owner_pid FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (PENDING, RUNNING)
+        )
+        for job_id, attempts, owner_pid in rows:
+            if owner_pid and owner_pid != os.getpid() and pid_is_alive(owner_pid):
+                continue
+            if attempts >= JOB_MAX_ATTEMPTS:
+                self.fail(job_id, f"Gave up after {attempts} interrupted attempts")
+                continue
+            with self.lock:
+                claimed = self._connect().execute(
+                    "UPDATE jobs SET owner_pid = ? WHERE id = ? AND owner_pid IS ?", (os.getpid(), job_id, owner_pid)
+                ).rowcount
+            if claimed:
+                jobs.append(self.load(job_id))
+        return jobs
+
+    def unfinished_job_ids(self) -> set:
+        return {job_id for (job_id,) in self._execute("SELECT id FROM jobs WHERE status IN (?, ?)", (PENDING, RUNNING))}
+
+    def purge_finished(self, older_than_seconds: float = JOB_RETENTION_SECONDS) -> int:
+        cutoff = time.time() - older_than_seconds
+        with self.lock:
+            cursor = self._connect().execute(
+                "DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ?", (*FINISHED_STATUSES, cutoff)
+            )
+            return cursor.rowcount
+
+
+job_store = JobStore()
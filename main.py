@@ -1,20 +1,49 @@
 import os
+import shlex
+import asyncio
+import importlib
+import mimetypes
 import subprocess
-import tempfile
-from typing import Union
+from contextlib import asynccontextmanager
+from typing import Callable, List, Literal, Union
 from uuid import uuid4
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Request, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from google.cloud import storage
-from google.oauth2.credentials import Credentials
 from dotenv import load_dotenv
-import base64
-from gcp_auth import authenticate_gcp
-from add_captions import add_captions_to_video_from_uri
+from gcp_auth import authenticate_gcp, token_cache
+from storage import storage_for, upload_cancellable, is_local_bucket, LocalStorage, InvalidBucket
+from add_captions import add_captions_to_video_from_uri, soft_subtitle_codec, speech_api
+from pipeline import execute_pipeline_on_gcs_video
+from previews import generate_previews_on_gcs_video, PreviewSettings
+from hls_packaging import package_gcs_video, Rendition, DEFAULT_LADDER
+from process_runner import run_process, current_job_class
+from media_index import get_media_info, source_ranges_for_command, trim_window_from_command
+from encode_tuner import EncodeProfile, tune_source, describe_tuning
+from ffmpeg_planner import parse_ffmpeg_command, optimize_plan, stream_copy_candidate, tunable_x264_output, TUNING_VIDEO_OPTIONS, FFmpegCommandError
+from workspace import workspace_manager, InsufficientScratchSpace
+from coalescing import request_coalescer, request_fingerprint, IdempotencyKeyConflict
+from job_store import job_store, Job, JobCancelled, checkpoint_reached, record_checkpoint, FINISHED_STATUSES, JOB_CANCEL_POLL_SECONDS
+from webhooks import webhook_dispatcher, validate_callback_url
+from tenants import tenant_registry, Tenant
+from scheduler import fair_scheduler
+from shared_state import shared_state
+from cost_model import estimate_job_cost
 
 load_dotenv()
 
+# Import the Google client libraries and fetch the first access token in the background once the
+# server is up, instead of on the first request that needs them
+WARM_UP_ON_STARTUP = os.getenv("WARM_UP_ON_STARTUP", "true").lower() == "true"
+# /readyz answers 503, so a load balancer sends new work to another instance, once every worker
+# slot is busy and at least this many jobs are already waiting for one
+READY_MAX_QUEUED_JOBS = int(os.getenv("READY_MAX_QUEUED_JOBS", "0"))
+# Largest output /process-video streams back in the response with delivery "inline"; larger ones are uploaded
+INLINE_MAX_BYTES = int(os.getenv("INLINE_MAX_BYTES", str(8 * 1024 * 1024)))
+INLINE_CHUNK_BYTES = 64 * 1024
+
 # Pydantic models for request/response
 class ProcessVideoRequest(BaseModel):
     video_uri: str
@@ -22,189 +51,771 @@ class ProcessVideoRequest(BaseModel):
     bucket_name: str = None  # Optional, will use GCP_BUCKET_NAME if not provided
     output_extension: str = "mp4"
     return_raw_output: bool = False
+    optimize: bool = True  # Let the planner rewrite the command into a faster equivalent
+    delivery: Literal["upload", "inline"] = "upload"  # "inline" returns the output itself in the response body if it is at most INLINE_MAX_BYTES
+    encode_profile: str = None  # Optional libx264 target: "realtime:4", "deadline:10" (minutes) or "vmaf:93"; picks preset, CRF and threads
+    callback_url: str = None  # Optional: respond 202 at once and POST the signed result here when done
+
+class PipelineStep(BaseModel):
+    type: Literal["ffmpeg", "captions"] = "ffmpeg"
+    ffmpeg_command: str = None  # Required for ffmpeg steps
+    target_lang: str = None  # Optional translation for captions steps
+    caption_mode: Literal["burn", "smart", "soft"] = "burn"  # Captions steps: burn into the picture (all of it, or with "smart" only the captioned GOPs) or mux as a subtitle track
+
+class PipelineRequest(BaseModel):
+    video_uri: str
+    steps: List[PipelineStep]
+    bucket_name: str = None  # Optional, will use GCP_BUCKET_NAME if not provided
+    output_extension: str = "mp4"
+    return_raw_output: bool = False
+    optimize: bool = True  # Fuse adjacent ffmpeg steps and optimize each command
+    callback_url: str = None  # Optional: respond 202 at once and POST the signed result here when done
+
+class ProbeRequest(BaseModel):
+    video_uri: str
+    bucket_name: str = None  # Optional, will use GCP_BUCKET_NAME if not provided
+    include_keyframes: bool = False  # Include keyframe timestamps from the packet index
 
 class AddCaptionsRequest(BaseModel):
     video_uri: str
     bucket_name: str = None  # Optional, will use GCP_BUCKET_NAME if not provided
     output_extension: str = "mp4"
     target_lang: str = None  # Optional, language code for translation (e.g., "ES", "FR", "DE")
+    caption_mode: Literal["burn", "smart", "soft"] = "burn"  # "soft" muxes a subtitle track instead of re-encoding; "smart" re-encodes only the GOPs with captions
+    encode_profile: str = None  # Optional libx264 target for the re-encode ("burn" and "smart"), as for /process-video
+    callback_url: str = None  # Optional: respond 202 at once and POST the signed result here when done
 
-class GCSStorageManagerJWT:
-    def __init__(self, bucket_name: str, token: str):
-        self.bucket_name = bucket_name
-        # Create credentials from access token
-        from google.auth.credentials import AnonymousCredentials
-        from google.oauth2.credentials import Credentials as OAuth2Credentials
-        
-        # Create OAuth2 credentials from access token
-        credentials = OAuth2Credentials(token=token)
-        
-        self.client = storage.Client(
-            credentials=credentials, 
-            project=os.getenv("GCP_PROJECT_ID")
-        )
-        self.bucket = self.client.bucket(bucket_name)
-
-    def uri_to_url(self, uri: str) -> str:
-        if not uri.startswith("gs://"):
-            raise ValueError("Invalid GCS URI")
-        parts = uri[5:].split("/", 1)
-        bucket_name = parts[0]
-        blob_name = parts[1] if len(parts) > 1 else ""
-        return f"https://storage.googleapis.com/{bucket_name}/{blob_name}"
-
-    def upload(self, local_path: str, remote_path: str):
-        print(f"[GCS] Starting upload: {local_path} -> gs://{self.bucket_name}/{remote_path}")
-        blob = self.bucket.blob(remote_path)
-        blob.upload_from_filename(local_path)
-        uri = f'gs://{self.bucket_name}/{remote_path}'
-        print(f"[GCS] Upload completed. File URL: {self.uri_to_url(uri)}")
-        return uri
-
-    def download(self, uri: str, local_path: str):
-        blob = self.bucket.blob(uri.replace(f"gs://{self.bucket_name}/", ""))
-        blob.download_to_filename(local_path)
-        print(f"File downloaded to: {local_path}")
-
-    def download_to_b64(self, uri: str) -> str:
-        blob = self.bucket.blob(uri.replace(f"gs://{self.bucket_name}/", ""))
-        data = blob.download_as_bytes()
-        return base64.b64encode(data).decode('utf-8')
-    
-    def download_to_tempfile(self, uri: str):
-        print(f"[GCS] Starting download from: {uri}")
-        blob = self.bucket.blob(uri.replace(f"gs://{self.bucket_name}/", ""))
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        blob.download_to_filename(temp_file.name)
-        print(f"[GCS] Download completed to temporary file: {temp_file.name}")
-        return temp_file
-
-def execute_ffmpeg_on_gcs_video(video_uri: str, ffmpeg_command: str, bucket_name: str, token: str, output_extension: str = "mp4", return_raw_output: bool = False) -> dict:
+class PreviewsRequest(BaseModel):
+    video_uri: str
+    bucket_name: str = None  # Optional, will use GCP_BUCKET_NAME if not provided
+    poster_time: float = None  # Seconds; defaults to 10% into the video
+    poster_width: int = 1280
+    sprite_interval: float = 10  # Seconds between seek-bar thumbnails
+    sprite_width: int = 160
+    sprite_columns: int = 10
+    sprite_rows: int = 10  # Longer videos get several sprite sheets
+    sprite_keyframes_only: bool = False  # Build sprites from keyframes only (much faster, less exact)
+    clip_start: float = None  # Seconds; defaults to 10% into the video
+    clip_duration: float = 6
+    clip_width: int = 480
+    return_raw_output: bool = False
+    callback_url: str = None  # Optional: respond 202 at once and POST the signed result here when done
+
+class RenditionRequest(BaseModel):
+    height: int
+    video_kbps: int
+    audio_kbps: int = 128
+
+class PackageRequest(BaseModel):
+    video_uri: str
+    bucket_name: str = None  # Optional, will use GCP_BUCKET_NAME if not provided
+    renditions: List[RenditionRequest] = [
+        RenditionRequest(height=height, video_kbps=video_kbps, audio_kbps=audio_kbps)
+        for height, video_kbps, audio_kbps in DEFAULT_LADDER
+    ]
+    segment_duration: float = 4  # Seconds; every rendition gets a keyframe on each boundary
+    return_raw_output: bool = False
+    callback_url: str = None  # Optional: respond 202 at once and POST the signed result here when done
+
+async def tune_plan_output(plan, output_extension: str, profile: EncodeProfile, bucket_manager, video_uri: str,
+                           metadata: dict, input_path: str, work_dir: str):
+    """
+    Calibrates profile for the plan's libx264 output and sets the resulting -preset, -crf and
+    -threads on it. Returns the settings, or None when the plan has no output it can tune.
+    """
+    output = tunable_x264_output(plan, output_extension)
+    if output is None:
+        print(f"[FFMPEG] encode_profile {profile} ignored: the command has no single libx264 output to tune")
+        return None
+    video_options = [part for flag, value in output.options if flag in TUNING_VIDEO_OPTIONS for part in (flag, value)]
+    try:
+        crf = int(float(output.get("-crf"))) if output.has("-crf") else None
+    except ValueError:
+        crf = None
+    tuning = await tune_source(
+        profile, bucket_manager, video_uri, metadata, input_path, work_dir,
+        trim_window=trim_window_from_command(plan.to_args(input_path)),
+        video_options=video_options, crf=crf, preset=output.get("-preset")
+    )
+    if tuning:
+        output.set("-preset", tuning["preset"])
+        output.set("-crf", str(tuning["crf"]))
+        output.set("-threads", str(tuning["threads"]))
+    return tuning
+
+async def execute_ffmpeg_on_gcs_video(video_uri: str, ffmpeg_command: str, bucket_name: str, token_provider: Callable[[], str], output_extension: str = "mp4", return_raw_output: bool = False, optimize: bool = True, delivery: str = "upload", encode_profile: str = None, job: Job = None) -> dict:
     """
     Download video from GCS, execute ffmpeg command, upload result back to GCS
+    (or, with delivery "inline" and an output of at most INLINE_MAX_BYTES, keep it on
+    disk for the endpoint to stream back as the response body)
+
+    GCS transfers use the blocking client, so they are offloaded to worker threads;
+    ffmpeg itself runs as an asyncio subprocess. All files live in a per-job
+    workspace that is admitted against the scratch disk budget up front.
+    The command is parsed into a plan and, if optimize is set, rewritten into a faster
+    equivalent (input seeking, stream copy, configured presets/threads) before it runs.
+    Commands that seek on the input side (-ss before -i) of an MP4/MOV source only
+    download the byte ranges they read, staged into a sparse local file.
+    With an encode_profile, a libx264 output gets the preset, CRF and threads calibrated for it.
+    With a stored job, each stage is checkpointed and a resumed run skips finished stages.
     """
+    if checkpoint_reached(job, "output_uploaded"):
+        return job.checkpoints["output_uploaded"]
+
     print(f"[FFMPEG] Starting video processing pipeline")
     print(f"[FFMPEG] Input video URI: {video_uri}")
     print(f"[FFMPEG] Target bucket: {bucket_name}")
     
-    bucket_manager = GCSStorageManagerJWT(bucket_name, token)
+    print(f"[FFMPEG] Processing FFmpeg command: {ffmpeg_command}")
+    plan = parse_ffmpeg_command(ffmpeg_command)
     
-    # Download video to temp file
-    print(f"[FFMPEG] Downloading video from GCS to temporary file...")
-    temp_video = bucket_manager.download_to_tempfile(video_uri)
-    print(f"[FFMPEG] Video downloaded to: {temp_video.name}")
+    bucket_manager = storage_for(bucket_name, token_provider)
+    metadata = await asyncio.to_thread(bucket_manager.get_metadata, video_uri)
+    source_extension = os.path.splitext(bucket_manager.blob_name(video_uri))[1]
+    if job:
+        await job.reset_if_source_changed(metadata["generation"])
     
-    # Create temp output file
-    temp_output = tempfile.NamedTemporaryFile(suffix=f'.{output_extension}', delete=False)
-    temp_output.close()
-    print(f"[FFMPEG] Created temporary output file: {temp_output.name}")
+    optimizations = []
+    if optimize:
+        # Stream copy into a different container depends on the source codecs
+        probe = None
+        if stream_copy_candidate(plan) and output_extension.lower() != source_extension.lstrip(".").lower():
+            try:
+                probe = (await get_media_info(bucket_manager, video_uri, metadata, with_index=False))["probe"]
+            except Exception as e:
+                print(f"[FFMPEG] Warning: could not probe source: {e}")
+        optimizations = optimize_plan(plan, output_extension, source_extension, probe)
+        for note in optimizations:
+            print(f"[FFMPEG] Optimization: {note}")
     
-    try:
-        # Replace placeholders in ffmpeg command
-        command_parts = ffmpeg_command.split()
-        print(f"[FFMPEG] Processing FFmpeg command: {ffmpeg_command}")
-        
-        # Find and replace INPUT_FILE and OUTPUT_FILE placeholders
-        for i, part in enumerate(command_parts):
-            if part == "INPUT_FILE":
-                command_parts[i] = temp_video.name
-            elif part == "OUTPUT_FILE":
-                command_parts[i] = temp_output.name
-        
-        # If no placeholders found, assume standard format and insert files
-        if "INPUT_FILE" not in ffmpeg_command and "OUTPUT_FILE" not in ffmpeg_command:
-            # Find -i flag and insert input file after it
-            if "-i" in command_parts:
-                i_index = command_parts.index("-i") + 1
-                command_parts.insert(i_index, temp_video.name)
+    # Trims only need the part of the source around the trim window
+    ranges = await source_ranges_for_command(bucket_manager, video_uri, metadata, plan.to_args())
+    expected_bytes = sum(end - start for start, end in ranges) if ranges else metadata["size"]
+    
+    async with workspace_manager.job(expected_bytes, job_id=job and job.id, keep_on_cancel=job is not None) as workspace:
+        # Download video into the job workspace
+        input_path = workspace.file("input" + source_extension)
+        if checkpoint_reached(job, "source_downloaded", input_path):
+            print(f"[FFMPEG] Reusing video downloaded by an earlier attempt: {input_path}")
+        else:
+            print(f"[FFMPEG] Downloading video from GCS to job workspace...")
+            if ranges:
+                await asyncio.to_thread(bucket_manager.download_ranges, video_uri, input_path, metadata["size"], ranges)
             else:
-                # Add -i and input file at the beginning
-                command_parts.insert(1, "-i")
-                command_parts.insert(2, temp_video.name)
-            
-            # Add output file at the end
-            command_parts.append(temp_output.name)
+                await asyncio.to_thread(bucket_manager.download, video_uri, input_path)
+            print(f"[FFMPEG] Video downloaded to: {input_path}")
+            await record_checkpoint(job, "source_downloaded", path=input_path, generation=metadata["generation"])
         
-        # Always add -y flag to overwrite existing files without prompting
-        if "-y" not in command_parts:
-            command_parts.insert(1, "-y")
+        output_file = workspace.file(f"output.{output_extension}")
+        print(f"[FFMPEG] Output file: {output_file}")
         
-        final_command = " ".join(command_parts)
-        print(f"[FFMPEG] Executing command: {final_command}")
+        tuning = None
+        if encode_profile and not checkpoint_reached(job, "output_ready", output_file):
+            profile = EncodeProfile.parse(encode_profile)
+            tuning = await tune_plan_output(plan, output_extension, profile, bucket_manager, video_uri, metadata,
+                                            input_path, workspace.file("tuning"))
+            if tuning:
+                optimizations.append(describe_tuning(profile, tuning))
+                print(f"[FFMPEG] Optimization: {optimizations[-1]}")
         
-        # Execute ffmpeg command
-        result = subprocess.run(command_parts, check=True, capture_output=True, text=True)
-        print(f"[FFMPEG] FFmpeg execution completed successfully")
+        command_parts = plan.to_args(input_path, output_file)
+        final_command = shlex.join(command_parts)
         
-        # Upload processed video to GCS
-        output_path = f"ffmpeg_processed/{uuid4()}.{output_extension}"
-        print(f"[FFMPEG] Uploading processed video to GCS path: {output_path}")
-        result_uri = bucket_manager.upload(temp_output.name, output_path)
-        print(f"[FFMPEG] Upload completed. Result URI: {result_uri}")
+        if checkpoint_reached(job, "output_ready", output_file):
+            print(f"[FFMPEG] Reusing output rendered by an earlier attempt")
+            result = subprocess.CompletedProcess(command_parts, 0, "", "")
+        else:
+            # Execute ffmpeg command
+            print(f"[FFMPEG] Executing command: {final_command}")
+            result = await run_process(command_parts)
+            print(f"[FFMPEG] FFmpeg execution completed successfully")
+            await record_checkpoint(job, "output_ready", path=output_file)
         
-        response = {"result_uri": result_uri}
+        output_size = os.path.getsize(output_file)
+        inline_path = None
+        if delivery == "inline" and output_size <= INLINE_MAX_BYTES:
+            # Moved out of the workspace, which is removed when this returns (None if scratch space is short)
+            inline_path = await asyncio.to_thread(workspace_manager.hold_inline, output_file)
+        if inline_path:
+            print(f"[FFMPEG] Output ({output_size} bytes) will be returned inline")
+            response = {"result_uri": None, "delivery": "inline", "inline_path": inline_path, "size": output_size}
+        else:
+            if delivery == "inline" and output_size > INLINE_MAX_BYTES:
+                print(f"[FFMPEG] Output ({output_size} bytes) is over INLINE_MAX_BYTES, uploading instead")
+            # Upload processed video to GCS
+            output_path = f"ffmpeg_processed/{uuid4()}.{output_extension}"
+            print(f"[FFMPEG] Uploading processed video to GCS path: {output_path}")
+            result_uri = await upload_cancellable(bucket_manager, output_file, output_path)
+            print(f"[FFMPEG] Upload completed. Result URI: {result_uri}")
+            response = {"result_uri": result_uri, "delivery": "upload", "size": output_size}
         
         if return_raw_output:
             print(f"[FFMPEG] Including raw output in response")
             response.update({
                 "stdout": result.stdout,
                 "stderr": result.stderr,
-                "command": final_command
+                "resource_usage": getattr(result, "usage", None),
+                "command": final_command,
+                "original_command": ffmpeg_command,
+                "optimizations": optimizations,
+                "encode_tuning": tuning
             })
         
+        # Inline outputs are only kept for a while, so a resumed job renders and uploads again
+        if response["delivery"] == "upload":
+            await record_checkpoint(job, "output_uploaded", **response)
         return response
-        
+
+async def run_process_video_job(request: dict, token_provider: Callable[[], str], job: Job) -> dict:
+    return await execute_ffmpeg_on_gcs_video(
+        video_uri=request["video_uri"],
+        ffmpeg_command=request["ffmpeg_command"],
+        bucket_name=request["bucket_name"],
+        token_provider=token_provider,
+        output_extension=request["output_extension"],
+        return_raw_output=request["return_raw_output"],
+        optimize=request["optimize"],
+        # Only a waiting client can receive the output inline; resumed jobs upload it
+        delivery=request.get("delivery", "upload") if current_job_class.get() != "batch" else "upload",
+        encode_profile=request.get("encode_profile"),
+        job=job
+    )
+
+async def run_pipeline_job(request: dict, token_provider: Callable[[], str], job: Job) -> dict:
+    return await execute_pipeline_on_gcs_video(
+        video_uri=request["video_uri"],
+        steps=[PipelineStep.model_construct(**step) for step in request["steps"]],  # validated when first submitted
+        bucket_name=request["bucket_name"],
+        token_provider=token_provider,
+        output_extension=request["output_extension"],
+        return_raw_output=request["return_raw_output"],
+        optimize=request["optimize"],
+        job=job
+    )
+
+async def run_add_captions_job(request: dict, token_provider: Callable[[], str], job: Job) -> dict:
+    return await add_captions_to_video_from_uri(
+        video_uri=request["video_uri"],
+        bucket_name=request["bucket_name"],
+        token_provider=token_provider,
+        output_extension=request["output_extension"],
+        target_lang=request["target_lang"],
+        caption_mode=request["caption_mode"],
+        encode_profile=request.get("encode_profile"),
+        job=job
+    )
+
+async def run_previews_job(request: dict, token_provider: Callable[[], str], job: Job) -> dict:
+    settings = PreviewSettings(
+        poster_time=request["poster_time"],
+        poster_width=request["poster_width"],
+        sprite_interval=request["sprite_interval"],
+        sprite_width=request["sprite_width"],
+        sprite_columns=request["sprite_columns"],
+        sprite_rows=request["sprite_rows"],
+        sprite_keyframes_only=request["sprite_keyframes_only"],
+        clip_start=request["clip_start"],
+        clip_duration=request["clip_duration"],
+        clip_width=request["clip_width"]
+    )
+    return await generate_previews_on_gcs_video(
+        video_uri=request["video_uri"],
+        bucket_name=request["bucket_name"],
+        token_provider=token_provider,
+        settings=settings,
+        return_raw_output=request["return_raw_output"],
+        job=job
+    )
+
+async def run_package_job(request: dict, token_provider: Callable[[], str], job: Job) -> dict:
+    return await package_gcs_video(
+        video_uri=request["video_uri"],
+        bucket_name=request["bucket_name"],
+        token_provider=token_provider,
+        renditions=[Rendition(**rendition) for rendition in request["renditions"]],
+        segment_duration=request["segment_duration"],
+        return_raw_output=request["return_raw_output"],
+        job=job
+    )
+
+# Stored job kinds and the functions that (re)run them from their stored request
+JOB_RUNNERS = {
+    "process-video": run_process_video_job,
+    "pipeline": run_pipeline_job,
+    "add-captions": run_add_captions_job,
+    "previews": run_previews_job,
+    "package": run_package_job,
+}
+
+def notify_job_outcome(job: Job, result: dict = None, error: Exception = None, cancelled: bool = False):
+    """Queues the signed completion callback for jobs submitted with a callback_url."""
+    callback_url = job.request.get("callback_url")
+    if not callback_url:
+        return
+    outcome = "cancelled" if cancelled else "failed" if error else "succeeded"
+    payload = {
+        "event": f"job.{outcome}",
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": outcome,
+        "output_uri": result.get("result_uri") if result else None,
+        "result": result,
+        "error": {
+            "message": str(error),
+            "stderr": getattr(error, "stderr", None),
+        } if error else None,
+    }
+    webhook_dispatcher.enqueue(callback_url, payload)
+
+# Tasks executing stored jobs in this process, by job id, so DELETE /jobs/{id} can cancel them
+active_jobs = {}
+
+async def watch_for_cancellation(job_id: str, task: asyncio.Task):
+    """Cancels task once its job is marked cancelled in the store, i.e. by another worker process."""
+    while True:
+        await asyncio.sleep(JOB_CANCEL_POLL_SECONDS)
+        if await asyncio.to_thread(job_store.is_cancelled, job_id):
+            print(f"[JOBS] Job {job_id} was cancelled by another worker, stopping it")
+            task.cancel()
+            return
+
+async def run_job(job: Job, token_provider: Callable[[], str]) -> dict:
+    """
+    Runs a stored job to completion, records the outcome and sends its callback (if any).
+    The job first waits for a worker slot in the fair scheduler, under the API key that submitted it
+    and ranked by its estimated cost (shorter jobs first).
+    If the worker goes away mid-run the job stays 'running' and is resumed from its
+    checkpoints on next startup. Cancelled at any other time (DELETE /jobs/{id}, or every
+    client waiting on it disconnected), it is recorded as cancelled and raises JobCancelled.
+    A job cancelled through another worker is stopped within JOB_CANCEL_POLL_SECONDS.
+    """
+    active_jobs[job.id] = asyncio.current_task()
+    watcher = asyncio.create_task(watch_for_cancellation(job.id, asyncio.current_task()))
+    try:
+        cost = await estimate_job_cost(job.kind, job.request, token_provider)
+        print(f"[JOBS] Estimated cost of {job.kind} job {job.id}: {cost:.1f}s")
+        async with fair_scheduler.slot(tenant_registry.get(job.request.get("tenant")), cost):
+            if not await asyncio.to_thread(job_store.mark_running, job.id):
+                raise asyncio.CancelledError()
+            if token_provider:
+                # The job may have queued for a while: refresh a token about to expire before it starts
+                await asyncio.to_thread(token_provider)
+            result = await JOB_RUNNERS[job.kind](job.request, token_provider, job)
+    except asyncio.CancelledError:
+        if workspace_manager.shutting_down:
+            raise
+        await asyncio.to_thread(job_store.cancel, job.id)
+        notify_job_outcome(job, error=JobCancelled("Cancelled"), cancelled=True)
+        print(f"[JOBS] Job {job.id} cancelled")
+        raise JobCancelled(f"Job {job.id} was cancelled")
+    except Exception as e:
+        await asyncio.to_thread(job_store.fail, job.id, str(e))
+        notify_job_outcome(job, error=e)
+        raise
     finally:
-        # Cleanup temp files
-        print(f"[FFMPEG] Cleaning up temporary files...")
+        watcher.cancel()
+        active_jobs.pop(job.id, None)
+    if not await asyncio.to_thread(job_store.finish, job.id, result):
+        # Cancelled by another worker after the last poll; the store keeps saying cancelled
+        notify_job_outcome(job, error=JobCancelled("Cancelled"), cancelled=True)
+        raise JobCancelled(f"Job {job.id} was cancelled")
+    notify_job_outcome(job, result=result)
+    return {**result, "job_id": job.id}
+
+async def create_and_run_job(kind: str, job_request: dict, token_provider: Callable[[], str]) -> dict:
+    """Stores a job for a request and runs it (see run_job)."""
+    creating = asyncio.ensure_future(asyncio.to_thread(job_store.create, kind, job_request))
+    try:
+        job = await asyncio.shield(creating)
+    except asyncio.CancelledError:
+        # The record is written anyway; it must not be resumed for a client that went away
+        job = await creating
+        await asyncio.to_thread(job_store.cancel, job.id)
+        raise
+    return await run_job(job, token_provider)
+
+async def run_background_job(job: Job, token_provider: Callable[[], str] = None):
+    """Runs a job nobody is waiting on (callback requests, resumed jobs); failures are only logged."""
+    # Nobody is waiting, so its processes yield CPU and disk to requests that have a client
+    current_job_class.set("batch")
+    if token_provider is None:
         try:
-            os.unlink(temp_video.name)
-            os.unlink(temp_output.name)
-            print(f"[FFMPEG] Temporary files cleaned up successfully")
-        except OSError as e:
-            print(f"[FFMPEG] Warning: Could not clean up temporary files: {e}")
+            token_provider = await storage_token_provider(job.request["bucket_name"])
+        except Exception as e:
+            # run_job records its own failures; this one happens before it starts
+            await asyncio.to_thread(job_store.fail, job.id, str(e))
+            notify_job_outcome(job, error=e)
+            print(f"[JOBS] Background job {job.id} failed: {str(e)}")
+            return
+    try:
+        result = await run_job(job, token_provider)
+        print(f"[JOBS] Background job {job.id} completed. Output URI: {result['result_uri']}")
+    except asyncio.CancelledError:
+        raise
+    except JobCancelled:
+        print(f"[JOBS] Background job {job.id} cancelled")
+    except Exception as e:
+        print(f"[JOBS] Background job {job.id} failed: {str(e)}")
+
+background_jobs = set()
+
+def start_background_job(job: Job, token_provider: Callable[[], str] = None):
+    task = asyncio.create_task(run_background_job(job, token_provider))
+    background_jobs.add(task)
+    task.add_done_callback(background_jobs.discard)
+
+async def submit_background_job(kind: str, job_request: dict, token_provider: Callable[[], str]) -> dict:
+    """Creates a job and runs it in the background; the result goes to the job's callback_url."""
+    job = await asyncio.to_thread(job_store.create, kind, job_request)
+    start_background_job(job, token_provider)
+    return {"job_id": job.id}
+
+def accepted_response(job_id: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={
+            'success': True,
+            'job_id': job_id,
+            'status': 'accepted',
+            'message': 'Job accepted; the result will be POSTed to callback_url'
+        }
+    )
+
+def inline_response(result: dict, output_extension: str, keep: bool = False) -> Response:
+    """
+    Streams an output held back by execute_ffmpeg_on_gcs_video (delivery "inline") as the response
+    body. The held file is removed once sent, unless keep (an Idempotency-Key replay may ask for it
+    again; purge_inline removes it later). Identical requests sharing the execution resume together
+    and open the file before the first of them has finished sending it.
+    """
+    try:
+        output = open(result["inline_path"], "rb")
+    except FileNotFoundError:
+        # Replayed after INLINE_RETENTION_SECONDS
+        return JSONResponse(
+            status_code=status.HTTP_410_GONE,
+            content={'error': 'Inline output expired', 'job_id': result["job_id"]}
+        )
+
+    def chunks():
+        with output:
+            while chunk := output.read(INLINE_CHUNK_BYTES):
+                yield chunk
+
+    filename = f"output.{output_extension}"
+    return StreamingResponse(
+        chunks(),
+        media_type=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        headers={
+            "Content-Length": str(result["size"]),
+            "Content-Disposition": f'inline; filename="{filename}"',
+            "X-Job-Id": result["job_id"],
+        },
+        background=None if keep else BackgroundTask(workspace_manager.release_inline, result["inline_path"])
+    )
+
+class ClientDisconnected(Exception):
+    """Raised when the client went away before the work it asked for finished."""
+
+async def cancel_on_disconnect(raw_request: Request, awaitable):
+    """
+    Awaits awaitable, cancelling it as soon as the client disconnects. Coalesced jobs keep
+    running while any other request still waits on them.
+    """
+    work = asyncio.ensure_future(awaitable)
+
+    async def disconnected():
+        # The body has been read already, so the next message only arrives on disconnect
+        while (await raw_request.receive())["type"] != "http.disconnect":
             pass
 
-app = FastAPI()
+    watcher = asyncio.create_task(disconnected())
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not work.done():
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+    if work.cancelled():
+        raise ClientDisconnected("Client disconnected before the job finished")
+    return work.result()
+
+async def run_request_job(kind: str, job_request: dict, token_provider: Callable[[], str], raw_request: Request,
+                          tenant: Tenant, idempotency_key: str, activity: str):
+    """
+    Runs the job of a request to a processing endpoint, shared with identical concurrent
+    requests (or retries carrying the same Idempotency-Key). With a callback_url the job runs in
+    the background and a 202 response is returned; otherwise the job's result, once it finished
+    (the job is cancelled if the client disconnects first). Failures are raised as HTTP errors;
+    activity names the work in their messages (e.g. "Pipeline" gives "Pipeline failed").
+    """
+    fingerprint = request_fingerprint(f"/{kind}", job_request)
+    scoped_key = scoped_idempotency_key(tenant, idempotency_key)
+    try:
+        if job_request.get("callback_url"):
+            submitted = await request_coalescer.run(
+                fingerprint, lambda: submit_background_job(kind, job_request, token_provider), scoped_key
+            )
+            print(f"[API] Accepted job {submitted['job_id']}; result will be sent to {job_request['callback_url']}")
+            return accepted_response(submitted["job_id"])
+        
+        return await cancel_on_disconnect(raw_request, request_coalescer.run(
+            fingerprint, lambda: create_and_run_job(kind, job_request, token_provider), scoped_key
+        ))
+        
+    except IdempotencyKeyConflict as e:
+        print(f"[API] Idempotency key conflict: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={
+                'error': 'Idempotency-Key reused',
+                'details': str(e)
+            }
+        )
+        
+    except JobCancelled as e:
+        print(f"[API] {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={
+                'error': 'Job cancelled',
+                'details': str(e)
+            }
+        )
+        
+    except ClientDisconnected as e:
+        print(f"[API] {str(e)}")
+        # Nobody is listening any more; the status is only for the access log
+        raise HTTPException(status_code=499, detail=str(e))
+        
+    except FFmpegCommandError as e:
+        print(f"[API] Invalid FFmpeg command: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={
+                'error': 'Invalid FFmpeg command',
+                'details': str(e)
+            }
+        )
+        
+    except InsufficientScratchSpace as e:
+        print(f"[API] Job rejected: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_507_INSUFFICIENT_STORAGE,
+            detail={
+                'error': 'Insufficient scratch space',
+                'details': str(e)
+            }
+        )
+        
+    except subprocess.CalledProcessError as e:
+        print(f"[API] {activity} FFmpeg command failed: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail={
+                'error': 'FFmpeg command failed',
+                'details': str(e),
+                'stderr': e.stderr if hasattr(e, 'stderr') else None,
+                'resource_usage': getattr(e, 'usage', None)
+            }
+        )
+        
+    except Exception as e:
+        print(f"[API] {activity} failed with error: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail={
+                'error': f'{activity} failed',
+                'details': str(e)
+            }
+        )
+
+async def check_callback_url(callback_url: str):
+    if callback_url:
+        try:
+            await asyncio.to_thread(validate_callback_url, callback_url)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+def check_encode_profile(encode_profile: str):
+    if encode_profile:
+        try:
+            EncodeProfile.parse(encode_profile)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+def check_bucket(bucket_name: str, video_uri: str):
+    """Rejects file:// buckets outside LOCAL_STORAGE_ROOTS and videos outside their file:// bucket."""
+    if is_local_bucket(bucket_name):
+        try:
+            LocalStorage(bucket_name).blob_name(video_uri)
+        except InvalidBucket as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+async def storage_token_provider(bucket_name: str) -> Union[Callable[[], str], None]:
+    """
+    Access token provider for a bucket's storage driver (local file:// buckets need none).
+    A token is resolved right away, so authentication problems fail the request instead of the job.
+    """
+    if is_local_bucket(bucket_name):
+        return None
+    await asyncio.to_thread(authenticate_gcp)
+    return authenticate_gcp
+
+async def warm_up_clients():
+    """
+    Heavy client libraries (google.cloud.storage, google.cloud.speech with its gRPC stack) are
+    imported lazily so the port is bound quickly; this loads them, and caches a token, right after.
+    """
+    started_at = asyncio.get_running_loop().time()
+    try:
+        await asyncio.to_thread(importlib.import_module, "google.cloud.storage")
+        await asyncio.to_thread(speech_api)
+        await asyncio.to_thread(authenticate_gcp)
+    except Exception as e:
+        # Not fatal: whatever failed is retried by the first request that needs it
+        print(f"[STARTUP] Warm-up failed: {e}")
+        return
+    print(f"[STARTUP] Warm-up finished in {asyncio.get_running_loop().time() - started_at:.2f}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    webhook_dispatcher.start()
+    warm_up_task = asyncio.create_task(warm_up_clients()) if WARM_UP_ON_STARTUP else None
+    if shared_state:
+        await asyncio.to_thread(shared_state.start)
+    # Unfinished jobs from a previous run keep their scratch directories and are resumed (each
+    # by the worker that claims it); everything else left behind by dead workers is removed
+    resumable = await asyncio.to_thread(job_store.resumable_jobs)
+    await asyncio.to_thread(workspace_manager.cleanup_orphans, await asyncio.to_thread(job_store.unfinished_job_ids))
+    await asyncio.to_thread(workspace_manager.purge_inline)
+    await asyncio.to_thread(job_store.purge_finished)
+    for job in resumable:
+        print(f"[JOBS] Resuming {job.kind} job {job.id} (checkpoints: {list(job.checkpoints)})")
+        start_background_job(job)
+    yield
+    # Interrupted jobs stay resumable: their checkpoints and workspaces are kept
+    workspace_manager.shutting_down = True
+    if warm_up_task:
+        warm_up_task.cancel()
+    for task in list(background_jobs):
+        task.cancel()
+    await webhook_dispatcher.stop()
 
-# Get the bearer key from environment variable
-BEARER_KEY = os.getenv("BEARER_KEY")
+app = FastAPI(lifespan=lifespan)
 
 # Security scheme for receiving the bearer token
 security = HTTPBearer()
 
-# Dependency to enforce Bearer token auth
-def verify_bearer_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# Dependency to enforce Bearer token auth; resolves the API key to its tenant
+async def verify_bearer_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Tenant:
     if credentials.scheme.lower() != "bearer":
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication scheme."
         )
-    token = credentials.credentials
-    if token != BEARER_KEY:
+    tenant = tenant_registry.authenticate(credentials.credentials)
+    if tenant is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or missing token."
         )
     # Authorized
-    return token
+    return tenant
+
+# Dependency for endpoints that start work: also applies the key's rate limit
+async def rate_limited_tenant(tenant: Tenant = Depends(verify_bearer_token)) -> Tenant:
+    if not tenant.admit_request():
+        retry_after = tenant.bucket.retry_after()
+        print(f"[API] Rate limit exceeded for '{tenant.name}', retry in {retry_after}s")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Rate limit of {tenant.requests_per_minute:g} requests per minute exceeded",
+            headers={"Retry-After": str(retry_after)}
+        )
+    return tenant
+
+def scoped_idempotency_key(tenant: Tenant, idempotency_key: str) -> str:
+    """Idempotency keys are per API key, so two tenants can never collide on one."""
+    return f"{tenant.name}:{idempotency_key}" if idempotency_key else None
 
 @app.get("/")
-def read_root(token: str = Depends(verify_bearer_token)):
+async def read_root(tenant: Tenant = Depends(verify_bearer_token)):
     return {"message": "Hello World"}
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Unauthenticated liveness check: the process is up and its event loop is responsive.
+    """
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Unauthenticated readiness check for load balancers. Reports free worker slots, queue depth,
+    free scratch disk and the access token cache, and answers 503 while this instance is
+    saturated (all slots busy with READY_MAX_QUEUED_JOBS waiting), out of scratch disk or
+    shutting down.
+    """
+    scheduler_stats = await fair_scheduler.stats()
+    busy_slots = scheduler_stats["running_on_machine"]
+    free_slots = max(0, fair_scheduler.slots - busy_slots)
+    free_scratch_bytes = await asyncio.to_thread(workspace_manager.free_bytes)
+
+    reasons = []
+    if workspace_manager.shutting_down:
+        reasons.append("shutting down")
+    if free_slots == 0 and scheduler_stats["waiting"] >= READY_MAX_QUEUED_JOBS:
+        reasons.append("all worker slots busy")
+    if free_scratch_bytes < workspace_manager.reserve_bytes:
+        reasons.append("scratch disk full")
+
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE if reasons else status.HTTP_200_OK,
+        content={
+            "ready": not reasons,
+            "reasons": reasons,
+            "slots": {
+                "total": fair_scheduler.slots,
+                "busy": busy_slots,
+                "free": free_slots,
+            },
+            "queue": {
+                "waiting": scheduler_stats["waiting"],
+                "waiting_cost_seconds": scheduler_stats["waiting_cost_seconds"],
+            },
+            "scratch": {
+                "free_bytes": free_scratch_bytes,
+                "reserve_bytes": workspace_manager.reserve_bytes,
+                "active_jobs": workspace_manager.active_jobs,
+                "inline_bytes": workspace_manager.inline_bytes,
+            },
+            "token_cache": token_cache.status(),
+        }
+    )
+
 @app.get("/items/{item_id}")
-def read_item(item_id: int, q: Union[str, None] = None, token: str = Depends(verify_bearer_token)):
+async def read_item(item_id: int, q: Union[str, None] = None, tenant: Tenant = Depends(verify_bearer_token)):
     return {"item_id": item_id, "q": q}
 
 @app.post("/process-video")
-def process_video(request: ProcessVideoRequest, token: str = Depends(verify_bearer_token)):
+async def process_video(request: ProcessVideoRequest, raw_request: Request, idempotency_key: Union[str, None] = Header(default=None), tenant: Tenant = Depends(rate_limited_tenant)):
     """
-    POST endpoint to process video with ffmpeg
+    POST endpoint to process video with ffmpeg.
+    Identical concurrent requests (or retries carrying the same Idempotency-Key) share one execution.
     """
     print(f"[API] Received video processing request for URI: {request.video_uri}")
     print(f"[API] FFmpeg command: {request.ffmpeg_command}")
     print(f"[API] Output extension: {request.output_extension}, Return raw output: {request.return_raw_output}")
+    await check_callback_url(request.callback_url)
+    check_encode_profile(request.encode_profile)
+    if request.delivery == "inline" and request.callback_url:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="delivery 'inline' returns the output in the response, so it cannot be combined with callback_url"
+        )
     
     # Use default bucket if none provided
     bucket_name = request.bucket_name or os.getenv("GCP_BUCKET_NAME")
@@ -217,10 +828,12 @@ def process_video(request: ProcessVideoRequest, token: str = Depends(verify_bear
     
     print(f"[API] Using bucket: {bucket_name}")
     
-    # Generate GCP access token internally
+    check_bucket(bucket_name, request.video_uri)
+    
+    # Generate GCP access token internally (file:// buckets need none)
     try:
         print(f"[API] Generating GCP access token...")
-        gcp_token = authenticate_gcp()
+        token_provider = await storage_token_provider(bucket_name)
         print(f"[API] GCP token generated successfully")
     except Exception as e:
         print(f"[API] Failed to generate GCP token: {str(e)}")
@@ -232,67 +845,194 @@ def process_video(request: ProcessVideoRequest, token: str = Depends(verify_bear
             }
         )
     
+    # Process video
+    print(f"[API] Calling execute_ffmpeg_on_gcs_video function...")
+    job_request = {**request.model_dump(), "bucket_name": bucket_name, "tenant": tenant.name}
+    result = await run_request_job(
+        "process-video", job_request, token_provider, raw_request, tenant, idempotency_key, "Processing"
+    )
+    if isinstance(result, Response):
+        return result
+    
+    if result.get("delivery") == "inline":
+        print(f"[API] Video processing completed successfully. Returning {result['size']} byte output inline")
+        return inline_response(result, request.output_extension, keep=idempotency_key is not None)
+    
+    print(f"[API] Video processing completed successfully. Output URI: {result['result_uri']}")
+    
+    response = {
+        'success': True,
+        'output_uri': result["result_uri"],
+        'delivery': result.get("delivery", "upload"),
+        'job_id': result["job_id"],
+        'message': 'Video processed successfully'
+    }
+    
+    # Add raw output if requested
+    if request.return_raw_output:
+        response.update({
+            'raw_output': {
+                'stdout': result.get("stdout"),
+                'stderr': result.get("stderr"),
+                'resource_usage': result.get("resource_usage"),
+                'command': result.get("command"),
+                'original_command': result.get("original_command"),
+                'optimizations': result.get("optimizations"),
+                'encode_tuning': result.get("encode_tuning")
+            }
+        })
+        print(f"[API] Including raw FFmpeg output in response")
+    
+    return response
+
+@app.post("/pipeline")
+async def pipeline(request: PipelineRequest, raw_request: Request, idempotency_key: Union[str, None] = Header(default=None), tenant: Tenant = Depends(rate_limited_tenant)):
+    """
+    POST endpoint to run several processing steps on a video with a single download and upload
+    """
+    print(f"[API] Received pipeline request for URI: {request.video_uri}")
+    print(f"[API] Steps: {[step.type for step in request.steps]}")
+    await check_callback_url(request.callback_url)
+    
+    if not request.steps:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="steps must contain at least one step"
+        )
+    
+    # Use default bucket if none provided
+    bucket_name = request.bucket_name or os.getenv("GCP_BUCKET_NAME")
+    if not bucket_name:
+        print(f"[API] Error: No bucket name provided and GCP_BUCKET_NAME not set")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="bucket_name is required or set GCP_BUCKET_NAME environment variable"
+        )
+    
+    check_bucket(bucket_name, request.video_uri)
+    
+    # Generate GCP access token internally (file:// buckets need none)
+    try:
+        token_provider = await storage_token_provider(bucket_name)
+    except Exception as e:
+        print(f"[API] Failed to generate GCP token: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail={
+                'error': 'GCP authentication failed',
+                'details': str(e)
+            }
+        )
+    
+    job_request = {**request.model_dump(), "bucket_name": bucket_name, "tenant": tenant.name}
+    result = await run_request_job(
+        "pipeline", job_request, token_provider, raw_request, tenant, idempotency_key, "Pipeline"
+    )
+    if isinstance(result, Response):
+        return result
+    
+    print(f"[API] Pipeline completed successfully. Output URI: {result['result_uri']}")
+    
+    response = {
+        'success': True,
+        'output_uri': result["result_uri"],
+        'job_id': result["job_id"],
+        'message': f'Pipeline of {len(request.steps)} steps completed in {result["stages"]} stages'
+    }
+    if request.return_raw_output:
+        response['raw_output'] = {
+            'stages': result.get("stage_outputs"),
+            'optimizations': result.get("optimizations")
+        }
+    
+    return response
+
+@app.post("/probe")
+async def probe(request: ProbeRequest, tenant: Tenant = Depends(rate_limited_tenant)):
+    """
+    POST endpoint returning ffprobe metadata for a video without downloading it
+    """
+    print(f"[API] Received probe request for URI: {request.video_uri}")
+    
+    # Use default bucket if none provided
+    bucket_name = request.bucket_name or os.getenv("GCP_BUCKET_NAME")
+    if not bucket_name:
+        print(f"[API] Error: No bucket name provided and GCP_BUCKET_NAME not set")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="bucket_name is required or set GCP_BUCKET_NAME environment variable"
+        )
+    
+    check_bucket(bucket_name, request.video_uri)
+    
+    # Generate GCP access token internally (file:// buckets need none)
     try:
-        # Process video
-        print(f"[API] Calling execute_ffmpeg_on_gcs_video function...")
-        result = execute_ffmpeg_on_gcs_video(
-            video_uri=request.video_uri,
-            ffmpeg_command=request.ffmpeg_command,
-            bucket_name=bucket_name,
-            token=gcp_token,  # Use the internally generated token
-            output_extension=request.output_extension,
-            return_raw_output=request.return_raw_output
+        token_provider = await storage_token_provider(bucket_name)
+    except Exception as e:
+        print(f"[API] Failed to generate GCP token: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail={
+                'error': 'GCP authentication failed',
+                'details': str(e)
+            }
         )
-        
-        print(f"[API] Video processing completed successfully. Output URI: {result['result_uri']}")
+    
+    try:
+        bucket_manager = storage_for(bucket_name, token_provider)
+        media_info = await get_media_info(bucket_manager, request.video_uri)
+        index = media_info["index"]
+        keyframes = index.keyframe_times() if index else None
         
         response = {
             'success': True,
-            'output_uri': result["result_uri"],
-            'message': 'Video processed successfully'
+            'video_uri': request.video_uri,
+            'generation': media_info["metadata"]["generation"],
+            'size': media_info["metadata"]["size"],
+            'format': media_info["probe"].get("format"),
+            'streams': media_info["probe"].get("streams", []),
+            'keyframe_count': len(keyframes) if keyframes is not None else None
         }
-        
-        # Add raw output if requested
-        if request.return_raw_output:
-            response.update({
-                'raw_output': {
-                    'stdout': result.get("stdout"),
-                    'stderr': result.get("stderr"),
-                    'command': result.get("command")
-                }
-            })
-            print(f"[API] Including raw FFmpeg output in response")
+        if request.include_keyframes:
+            response['keyframes'] = keyframes
         
         return response
         
-    except subprocess.CalledProcessError as e:
-        print(f"[API] FFmpeg command failed: {str(e)}")
+    except FileNotFoundError as e:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            status_code=status.HTTP_404_NOT_FOUND,
             detail={
-                'error': 'FFmpeg command failed',
-                'details': str(e),
-                'stderr': e.stderr if hasattr(e, 'stderr') else None
+                'error': 'Video not found',
+                'details': str(e)
             }
         )
         
     except Exception as e:
-        print(f"[API] Video processing failed with error: {str(e)}")
+        print(f"[API] Probe failed with error: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={
-                'error': 'Processing failed',
+                'error': 'Probe failed',
                 'details': str(e)
             }
         )
 
 @app.post("/add-captions")
-def add_captions(request: AddCaptionsRequest, token: str = Depends(verify_bearer_token)):
+async def add_captions(request: AddCaptionsRequest, raw_request: Request, idempotency_key: Union[str, None] = Header(default=None), tenant: Tenant = Depends(rate_limited_tenant)):
     """
-    POST endpoint to add captions to video using speech-to-text
+    POST endpoint to add captions to video using speech-to-text.
+    Identical concurrent requests (or retries carrying the same Idempotency-Key) share one execution.
     """
     print(f"[API] Received caption request for URI: {request.video_uri}")
-    print(f"[API] Output extension: {request.output_extension}")
+    print(f"[API] Output extension: {request.output_extension}, Caption mode: {request.caption_mode}")
+    
+    if request.caption_mode == "soft":
+        try:
+            soft_subtitle_codec(f"output.{request.output_extension}")
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    await check_callback_url(request.callback_url)
+    check_encode_profile(request.encode_profile)
     
     # Use default bucket if none provided
     bucket_name = request.bucket_name or os.getenv("GCP_BUCKET_NAME")
@@ -305,10 +1045,12 @@ def add_captions(request: AddCaptionsRequest, token: str = Depends(verify_bearer
     
     print(f"[API] Using bucket: {bucket_name}")
     
-    # Generate GCP access token internally
+    check_bucket(bucket_name, request.video_uri)
+    
+    # Generate GCP access token internally (file:// buckets need none)
     try:
         print(f"[API] Generating GCP access token...")
-        gcp_token = authenticate_gcp()
+        token_provider = await storage_token_provider(bucket_name)
         print(f"[API] GCP token generated successfully")
     except Exception as e:
         print(f"[API] Failed to generate GCP token: {str(e)}")
@@ -320,40 +1062,235 @@ def add_captions(request: AddCaptionsRequest, token: str = Depends(verify_bearer
             }
         )
     
+    # Add captions to video
+    print(f"[API] Calling add_captions_to_video_from_uri function...")
+    if request.target_lang:
+        print(f"[API] Translation requested to: {request.target_lang}")
+    
+    job_request = {**request.model_dump(), "bucket_name": bucket_name, "tenant": tenant.name}
+    result = await run_request_job(
+        "add-captions", job_request, token_provider, raw_request, tenant, idempotency_key, "Caption addition"
+    )
+    if isinstance(result, Response):
+        return result
+    
+    print(f"[API] Caption addition completed successfully. Output URI: {result['result_uri']}")
+    
+    message = 'Captions added successfully'
+    if request.target_lang:
+        message += f' (translated to {request.target_lang})'
+    
+    response = {
+        'success': True,
+        'output_uri': result["result_uri"],
+        'job_id': result["job_id"],
+        'message': message
+    }
+    
+    return response
+
+@app.post("/previews")
+async def previews(request: PreviewsRequest, raw_request: Request, idempotency_key: Union[str, None] = Header(default=None), tenant: Tenant = Depends(rate_limited_tenant)):
+    """
+    POST endpoint rendering a poster frame, seek-bar sprite sheets and a short preview clip
+    from one download and one decode of the video.
+    """
+    print(f"[API] Received previews request for URI: {request.video_uri}")
+    await check_callback_url(request.callback_url)
+    
+    if request.sprite_interval <= 0 or request.clip_duration <= 0 or min(
+        request.poster_width, request.sprite_width, request.sprite_columns, request.sprite_rows, request.clip_width
+    ) <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="sprite_interval, clip_duration, widths, sprite_columns and sprite_rows must be positive"
+        )
+    
+    # Use default bucket if none provided
+    bucket_name = request.bucket_name or os.getenv("GCP_BUCKET_NAME")
+    if not bucket_name:
+        print(f"[API] Error: No bucket name provided and GCP_BUCKET_NAME not set")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="bucket_name is required or set GCP_BUCKET_NAME environment variable"
+        )
+    
+    check_bucket(bucket_name, request.video_uri)
+    
+    # Generate GCP access token internally (file:// buckets need none)
     try:
-        # Add captions to video
-        print(f"[API] Calling add_captions_to_video_from_uri function...")
-        if request.target_lang:
-            print(f"[API] Translation requested to: {request.target_lang}")
-        
-        result = add_captions_to_video_from_uri(
-            video_uri=request.video_uri,
-            bucket_name=bucket_name,
-            token=gcp_token,
-            output_extension=request.output_extension,
-            target_lang=request.target_lang
+        token_provider = await storage_token_provider(bucket_name)
+    except Exception as e:
+        print(f"[API] Failed to generate GCP token: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail={
+                'error': 'GCP authentication failed',
+                'details': str(e)
+            }
         )
-        
-        print(f"[API] Caption addition completed successfully. Output URI: {result['result_uri']}")
-        
-        message = 'Captions added successfully'
-        if request.target_lang:
-            message += f' (translated to {request.target_lang})'
-        
-        response = {
-            'success': True,
-            'output_uri': result["result_uri"],
-            'message': message
+    
+    job_request = {**request.model_dump(), "bucket_name": bucket_name, "tenant": tenant.name}
+    result = await run_request_job(
+        "previews", job_request, token_provider, raw_request, tenant, idempotency_key, "Previews"
+    )
+    if isinstance(result, Response):
+        return result
+    
+    print(f"[API] Previews completed successfully. Output prefix: {result['result_uri']}")
+    
+    response = {
+        'success': True,
+        'output_uri': result["result_uri"],
+        'poster_uri': result["poster_uri"],
+        'preview_uri': result["preview_uri"],
+        'sprite_uris': result["sprite_uris"],
+        'sprite': result["sprite"],
+        'duration': result["duration"],
+        'job_id': result["job_id"],
+        'message': 'Previews generated successfully'
+    }
+    if request.return_raw_output:
+        response['raw_output'] = {
+            'command': result.get("command"),
+            'stderr': result.get("stderr"),
+            'resource_usage': result.get("resource_usage")
         }
-        
-        return response
-        
+    
+    return response
+
+@app.post("/package")
+async def package(request: PackageRequest, raw_request: Request, idempotency_key: Union[str, None] = Header(default=None), tenant: Tenant = Depends(rate_limited_tenant)):
+    """
+    POST endpoint encoding an adaptive-bitrate ladder (HLS with fMP4 segments) from one decode
+    of the video. Segments are uploaded while the ladder encodes; use callback_url to learn
+    the master playlist URI without waiting for the whole encode.
+    """
+    print(f"[API] Received package request for URI: {request.video_uri}")
+    print(f"[API] Renditions: {[rendition.height for rendition in request.renditions]}")
+    await check_callback_url(request.callback_url)
+    
+    if not request.renditions:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="renditions must contain at least one rendition"
+        )
+    if request.segment_duration <= 0 or any(
+        min(rendition.height, rendition.video_kbps, rendition.audio_kbps) <= 0 for rendition in request.renditions
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="segment_duration and rendition heights and bitrates must be positive"
+        )
+    
+    # Use default bucket if none provided
+    bucket_name = request.bucket_name or os.getenv("GCP_BUCKET_NAME")
+    if not bucket_name:
+        print(f"[API] Error: No bucket name provided and GCP_BUCKET_NAME not set")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="bucket_name is required or set GCP_BUCKET_NAME environment variable"
+        )
+    
+    check_bucket(bucket_name, request.video_uri)
+    
+    # Generate GCP access token internally (file:// buckets need none)
+    try:
+        token_provider = await storage_token_provider(bucket_name)
     except Exception as e:
-        print(f"[API] Caption addition failed with error: {str(e)}")
+        print(f"[API] Failed to generate GCP token: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={
-                'error': 'Caption addition failed',
+                'error': 'GCP authentication failed',
                 'details': str(e)
             }
         )
+    
+    job_request = {**request.model_dump(), "bucket_name": bucket_name, "tenant": tenant.name}
+    result = await run_request_job(
+        "package", job_request, token_provider, raw_request, tenant, idempotency_key, "Packaging"
+    )
+    if isinstance(result, Response):
+        return result
+    
+    print(f"[API] Packaging completed successfully. Master playlist: {result['result_uri']}")
+    
+    response = {
+        'success': True,
+        'output_uri': result["result_uri"],
+        'renditions': result["renditions"],
+        'segments': result["segments"],
+        'job_id': result["job_id"],
+        'message': f'Packaged {len(result["renditions"])} renditions'
+    }
+    if request.return_raw_output:
+        response['raw_output'] = {
+            'command': result.get("command"),
+            'stderr': result.get("stderr"),
+            'resource_usage': result.get("resource_usage")
+        }
+    
+    return response
+
+async def get_tenant_job(job_id: str, tenant: Tenant) -> dict:
+    """
+    Public view of a job submitted with tenant's API key. Other keys' jobs are reported as not
+    found, so job ids cannot be used to read or cancel them. Jobs stored before API keys
+    existed belong to "default".
+    """
+    stored = await asyncio.to_thread(job_store.load, job_id)
+    if stored is None or (stored.request.get("tenant") or "default") != tenant.name:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job not found: {job_id}")
+    return await asyncio.to_thread(job_store.get, job_id)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, tenant: Tenant = Depends(verify_bearer_token)):
+    """
+    GET endpoint returning a job's status, the checkpoints it has reached and its result.
+    Jobs interrupted by a restart or redeploy are resumed on startup, so clients can poll here
+    instead of resubmitting. Only jobs submitted with the same API key are visible.
+    """
+    return await get_tenant_job(job_id, tenant)
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, tenant: Tenant = Depends(verify_bearer_token)):
+    """
+    DELETE endpoint cancelling a pending or running job: its ffmpeg processes are terminated,
+    its Speech-to-Text operation and upload are aborted and its scratch space is released.
+    Requests waiting on the job receive 409. Only jobs submitted with the same API key can be cancelled.
+    """
+    job = await get_tenant_job(job_id, tenant)
+    if job["status"] in FINISHED_STATUSES:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job {job_id} already finished with status '{job['status']}'"
+        )
+    
+    task = active_jobs.get(job_id)
+    if task is not None:
+        task.cancel()
+        # Wait for the job to wind down so its resources are free when we answer
+        await asyncio.wait({task}, timeout=10)
+    else:
+        # Not running in this worker: a worker running it stops it within JOB_CANCEL_POLL_SECONDS,
+        # and a job waiting to be resumed never runs
+        await asyncio.to_thread(job_store.cancel, job_id)
+    print(f"[API] Cancelled job {job_id}")
+    return await asyncio.to_thread(job_store.get, job_id)
+
+@app.get("/metrics")
+async def metrics(tenant: Tenant = Depends(verify_bearer_token)):
+    """
+    GET endpoint with scheduler, per-API-key usage and callback delivery counters
+    """
+    return {
+        'scheduler': await fair_scheduler.stats(),
+        'tenants': tenant_registry.usage(),
+        'webhooks': {
+            'queued': webhook_dispatcher.queue.qsize() if webhook_dispatcher.queue is not None else 0,
+            'delivered': webhook_dispatcher.delivered,
+            'failed': webhook_dispatcher.failed,
+            'dropped': webhook_dispatcher.dropped
+        }
+    }
@@ -0,0 +1,652 @@
+import os
+import sys
+import json
+import struct
+import asyncio
+import secrets
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+from process_runner import run_process
+from shared_state import shared_state
+
+load_dotenv()
+
+# Number of probed objects kept in memory (keyed by bucket, object name and generation)
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "256"))
+# Extra media kept on either side of a trim window when staging byte ranges
+RANGE_MARGIN_SECONDS = float(os.getenv("RANGE_MARGIN_SECONDS", "2"))
+# Media at the start of every track that is always staged, for ffmpeg's stream probing
+RANGE_HEAD_SECONDS = float(os.getenv("RANGE_HEAD_SECONDS", "1"))
+# Byte ranges closer together than this are fetched as one request
+RANGE_MERGE_GAP_BYTES = int(os.getenv("RANGE_MERGE_GAP_BYTES", str(1024 * 1024)))
+
+# Minimum size of each range read while walking the top-level MP4 boxes
+_READ_AHEAD_BYTES = 64 * 1024
+_CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+# Size of each range read while serving an object to ffprobe through the loopback proxy
+_PROXY_CHUNK_BYTES = 256 * 1024
+
+
+def parse_ffmpeg_time(value: str) -> float:
+    """
+    Parses an ffmpeg time duration ("90", "1.5", "01:30", "00:01:30.5", "1500ms") to seconds.
+    """
+    value = value.strip()
+    sign = -1.0 if value.startswith("-") else 1.0
+    value = value.lstrip("-")
+    for suffix, scale in (("ms", 1e-3), ("us", 1e-6), ("s", 1.0)):
+        if value.endswith(suffix) and ":" not in value:
+            return sign * float(value[:-len(suffix)]) * scale
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return sign * seconds
+
+
+class _RangeReader:
+    """Reads byte ranges through a blocking read_range(start, end_exclusive) callable, with read-ahead."""
+
+    def __init__(self, read_range, size: int):
+        self.read_range = read_range
+        self.size = size
+        self._buffer_start = 0
+        self._buffer = b""
+
+    def read(self, start: int, length: int) -> bytes:
+        end = min(start + length, self.size)
+        if start < self._buffer_start or end > self._buffer_start + len(self._buffer):
+            fetch_end = min(max(end, start + _READ_AHEAD_BYTES), self.size)
+            self._buffer = self.read_range(start, fetch_end)
+            self._buffer_start = start
+        offset = start - self._buffer_start
+        return self._buffer[offset:offset + (end - start)]
+
+
+def _u32_array(data: bytes, offset: int, count: int) -> array:
+    values = array("I")
+    values.frombytes(data[offset:offset + 4 * count])
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+
+def _u64_array(data: bytes, offset: int, count: int) -> array:
+    values = array("Q")
+    values.frombytes(data[offset:offset + 8 * count])
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+
+def _iter_boxes(data: bytes, start: int, end: int):
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            break
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+class TrackIndex:
+    """Sample table of one track: decode times (seconds), byte offsets, sizes and sync samples."""
+
+    def __init__(self, handler: str, timescale: int, times: array, offsets: array, sizes: array, keyframes: list,
+                 width: int = None, height: int = None, codec: str = None, avc_profile: int = None, avc_level: int = None):
+        self.handler = handler
+        self.timescale = timescale
+        self.times = times
+        self.offsets = offsets
+        self.sizes = sizes
+        # Sample numbers (0-based) that are sync samples; None means every sample is a sync sample
+        self.keyframes = keyframes
+        # Presentation size from the track header (video tracks)
+        self.width = width
+        self.height = height
+        # Sample entry format ("avc1", "hvc1", "mp4a", ...) and, for H.264, profile_idc and level_idc from avcC
+        self.codec = codec
+        self.avc_profile = avc_profile
+        self.avc_level = avc_level
+
+    def keyframe_times(self) -> list:
+        if self.keyframes is None:
+            return list(self.times)
+        return [self.times[i] for i in self.keyframes]
+
+
+def _parse_sample_entry(data: bytes, start: int, end: int) -> dict:
+    """Format of the first sample description, plus profile and level for H.264 (from its avcC box)."""
+    if start + 8 > end:
+        return {}
+    entry_size, entry_format = struct.unpack_from(">I4s", data, start)
+    entry = {"codec": entry_format.decode("latin-1")}
+    if entry_format in (b"avc1", b"avc3"):
+        # Child boxes follow the 8-byte box header and the 78-byte visual sample entry fields
+        for box_type, body, box_end in _iter_boxes(data, start + 86, min(start + entry_size, end)):
+            if box_type == b"avcC" and box_end - body >= 4:
+                entry["avc_profile"] = data[body + 1]
+                entry["avc_level"] = data[body + 3]
+    return entry
+
+
+def _parse_track(trak: bytes):
+    handler = None
+    timescale = None
+    size = (None, None)
+    codec = {}
+    tables = {}
+
+    def walk(start, end):
+        nonlocal handler, timescale, size
+        for box_type, body, box_end in _iter_boxes(trak, start, end):
+            if box_type in _CONTAINER_BOXES:
+                walk(body, box_end)
+            elif box_type == b"tkhd":
+                # 16.16 fixed-point width and height close the box
+                width, height = struct.unpack_from(">II", trak, box_end - 8)
+                size = (width >> 16, height >> 16)
+            elif box_type == b"hdlr":
+                handler = trak[body + 8:body + 12].decode("latin-1")
+            elif box_type == b"mdhd":
+                version = trak[body]
+                timescale = struct.unpack_from(">I", trak, body + (20 if version == 1 else 12))[0]
+            elif box_type == b"stsd":
+                codec.update(_parse_sample_entry(trak, body + 8, box_end))
+            elif box_type in (b"stts", b"stss", b"stsz", b"stsc", b"stco", b"co64"):
+                tables[box_type] = (body, box_end)
+
+    walk(0, len(trak))
+    if not timescale or not all(name in tables for name in (b"stts", b"stsz", b"stsc")):
+        return None
+    if b"stco" not in tables and b"co64" not in tables:
+        return None
+
+    # Sample sizes
+    body, _ = tables[b"stsz"]
+    sample_size, sample_count = struct.unpack_from(">II", trak, body + 4)
+    if sample_count == 0:
+        # Fragmented MP4: samples live in moof boxes, not in the sample table
+        return None
+    sizes = _u32_array(trak, body + 12, sample_count) if sample_size == 0 else array("I", [sample_size]) * sample_count
+
+    # Decode times
+    body, _ = tables[b"stts"]
+    entry_count = struct.unpack_from(">I", trak, body + 4)[0]
+    stts = _u32_array(trak, body + 8, 2 * entry_count)
+    times = array("d")
+    dts = 0
+    for i in range(0, len(stts), 2):
+        count, delta = stts[i], stts[i + 1]
+        for _ in range(count):
+            times.append(dts / timescale)
+            dts += delta
+    del times[sample_count:]
+
+    # Chunk offsets and sample-to-chunk map
+    if b"co64" in tables:
+        body, _ = tables[b"co64"]
+        chunk_offsets = _u64_array(trak, body + 8, struct.unpack_from(">I", trak, body + 4)[0])
+    else:
+        body, _ = tables[b"stco"]
+        chunk_offsets = _u32_array(trak, body + 8, struct.unpack_from(">I", trak, body + 4)[0])
+    body, _ = tables[b"stsc"]
+    entry_count = struct.unpack_from(">I", trak, body + 4)[0]
+    stsc = _u32_array(trak, body + 8, 3 * entry_count)
+
+    offsets = array("Q")
+    sample = 0
+    for entry in range(entry_count):
+        first_chunk = stsc[3 * entry]
+        samples_per_chunk = stsc[3 * entry + 1]
+        last_chunk = stsc[3 * (entry + 1)] - 1 if entry + 1 < entry_count else len(chunk_offsets)
+        for chunk in range(first_chunk, last_chunk + 1):
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(samples_per_chunk):
+                if sample >= sample_count:
+                    break
+                offsets.append(offset)
+                offset += sizes[sample]
+                sample += 1
+
+    keyframes = None
+    if b"stss" in tables:
+        body, _ = tables[b"stss"]
+        keyframes = [n - 1 for n in _u32_array(trak, body + 8, struct.unpack_from(">I", trak, body + 4)[0])]
+
+    return TrackIndex(handler, timescale, times, offsets, sizes[:len(offsets)], keyframes, *size, **codec)
+
+
+class MediaIndex:
+    """
+    Packet index of an MP4/MOV file built from its moov box, plus the byte ranges
+    of the top-level boxes a demuxer needs to open the file.
+    """
+
+    def __init__(self, file_size: int, tracks: list, container_ranges: list):
+        self.file_size = file_size
+        self.tracks = tracks
+        self.container_ranges = container_ranges
+
+    @classmethod
+    def from_reader(cls, read_range, file_size: int):
+        """
+        Builds the index with a handful of range reads: the top-level box headers and the moov box.
+        read_range(start, end_exclusive) must return those bytes. Returns None for files
+        that are not (non-fragmented) MP4/MOV.
+        """
+        reader = _RangeReader(read_range, file_size)
+        container_ranges = []
+        moov = None
+        offset = 0
+        while offset + 8 <= file_size:
+            header = reader.read(offset, 16)
+            size, box_type = struct.unpack_from(">I4s", header, 0)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from(">Q", header, 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - offset
+            if size < header_size or not box_type.isalnum():
+                return None
+            if box_type == b"mdat":
+                container_ranges.append((offset, offset + header_size))
+            else:
+                container_ranges.append((offset, offset + size))
+            if box_type == b"moov":
+                moov = read_range(offset + header_size, offset + size)
+            offset += size
+        if moov is None:
+            return None
+
+        tracks = []
+        for box_type, body, box_end in _iter_boxes(moov, 0, len(moov)):
+            if box_type == b"trak":
+                track = _parse_track(moov[body:box_end])
+                if track is not None:
+                    tracks.append(track)
+        if not tracks:
+            return None
+        return cls(file_size, tracks, container_ranges)
+
+    @classmethod
+    def from_file(cls, path: str):
+        with open(path, "rb") as f:
+            def read_range(start, end):
+                f.seek(start)
+                return f.read(end - start)
+            return cls.from_reader(read_range, os.path.getsize(path))
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialization for the shared media cache: a length-prefixed JSON header with the scalar
+        fields, followed by the raw sample tables in native byte order (the shared store is a
+        local file, so it is only read on this machine).
+        """
+        header = {"file_size": self.file_size, "container_ranges": self.container_ranges, "tracks": []}
+        tables = []
+        for track in self.tracks:
+            track_tables = [track.times, track.offsets, track.sizes]
+            if track.keyframes is not None:
+                track_tables.append(array("I", track.keyframes))
+            header["tracks"].append({
+                "handler": track.handler, "timescale": track.timescale, "width": track.width, "height": track.height,
+                "codec": track.codec, "avc_profile": track.avc_profile, "avc_level": track.avc_level,
+                "tables": [[table.typecode, len(table)] for table in track_tables],
+            })
+            tables += track_tables
+        header_bytes = json.dumps(header).encode()
+        return struct.pack(">I", len(header_bytes)) + header_bytes + b"".join(table.tobytes() for table in tables)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        header_size = struct.unpack_from(">I", data, 0)[0]
+        header = json.loads(data[4:4 + header_size])
+        offset = 4 + header_size
+        tracks = []
+        for fields in header["tracks"]:
+            tables = []
+            for typecode, count in fields.pop("tables"):
+                table = array(typecode)
+                table.frombytes(data[offset:offset + table.itemsize * count])
+                offset += table.itemsize * count
+                tables.append(table)
+            times, offsets, sizes = tables[:3]
+            keyframes = list(tables[3]) if len(tables) > 3 else None
+            tracks.append(TrackIndex(fields.pop("handler"), fields.pop("timescale"), times, offsets, sizes, keyframes, **fields))
+        return cls(header["file_size"], tracks, [tuple(byte_range) for byte_range in header["container_ranges"]])
+
+    def video_track(self):
+        for track in self.tracks:
+            if track.handler == "vide":
+                return track
+        return None
+
+    def keyframe_times(self) -> list:
+        track = self.video_track()
+        return track.keyframe_times() if track else []
+
+    def byte_ranges_for_window(self, start: float, end: float = None) -> list:
+        """
+        Byte ranges (start, end_exclusive) needed to decode [start, end] seconds, with an input-side
+        seek to the keyframe at or before start. Includes the container boxes. end=None means to the end.
+        """
+        window_start = max(start - RANGE_MARGIN_SECONDS, 0.0)
+        video = self.video_track()
+        if video is not None:
+            previous_keyframes = [t for t in video.keyframe_times() if t <= start]
+            if previous_keyframes:
+                window_start = min(window_start, previous_keyframes[-1])
+        window_end = None if end is None else end + RANGE_MARGIN_SECONDS
+
+        ranges = list(self.container_ranges)
+        for track in self.tracks:
+            # ffmpeg reads the first packets of every stream while probing, before it seeks
+            for run_start, run_end in ((0.0, RANGE_HEAD_SECONDS), (window_start, window_end)):
+                first = bisect_left(track.times, run_start)
+                last = len(track.times) if run_end is None else bisect_right(track.times, run_end)
+                if first >= last:
+                    continue
+                # Samples are not always stored in time order, so take the extent of the whole run
+                run_offsets = track.offsets[first:last]
+                ranges.append((min(run_offsets), max(o + s for o, s in zip(run_offsets, track.sizes[first:last]))))
+        return merge_ranges(ranges)
+
+
+def merge_ranges(ranges: list, gap: int = RANGE_MERGE_GAP_BYTES) -> list:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def trim_window_from_command(command_parts: list):
+    """
+    Returns the (start, end) seconds an ffmpeg command reads from its input when it seeks on the
+    input side (-ss before -i), or None when the whole input may be decoded. end is None when
+    the read is not bounded.
+    """
+    if "-i" not in command_parts:
+        return None
+    input_index = command_parts.index("-i")
+    filtered = any(part in ("-vf", "-af", "-filter", "-filter:v", "-filter:a", "-filter_complex", "-lavfi")
+                   for part in command_parts)
+    start = None
+    input_end = None
+    output_end = None
+    for i, part in enumerate(command_parts[:-1]):
+        value = command_parts[i + 1]
+        input_side = i < input_index
+        try:
+            if part == "-ss":
+                if not input_side:
+                    # Output-side seek decodes from the beginning of the file
+                    return None
+                start = parse_ffmpeg_time(value)
+            elif part in ("-t", "-to"):
+                limit = (part, parse_ffmpeg_time(value))
+                if input_side:
+                    input_end = limit
+                else:
+                    output_end = limit
+        except ValueError:
+            return None
+    if start is None:
+        return None
+    # Output-side limits count output time, which filters (setpts, ...) can stretch
+    limit = input_end or (None if filtered else output_end)
+    if limit is None:
+        return start, None
+    flag, value = limit
+    if flag == "-to" and limit is input_end:
+        return start, value
+    # -t is a duration; an output -to also is, since timestamps restart at zero after an input seek
+    return start, start + value
+
+
+class MediaIndexCache:
+    """
+    In-memory LRU of probe results and packet indexes. Entries are keyed by object generation,
+    so an overwritten object is never served stale metadata. With shared state, new and
+    updated entries are also written to the shared store (on a worker thread, since another
+    worker may hold its lock) and looked up there on a miss.
+    """
+
+    def __init__(self, max_entries: int = MEDIA_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def _encode(entry: dict) -> bytes:
+        header = json.dumps({name: entry[name] for name in ("metadata", "probe", "index_built")}).encode()
+        index = entry["index"].to_bytes() if entry["index"] is not None else b""
+        return struct.pack(">I", len(header)) + header + index
+
+    @staticmethod
+    def _decode(data: bytes) -> dict:
+        header_size = struct.unpack_from(">I", data, 0)[0]
+        entry = json.loads(data[4:4 + header_size])
+        entry["index"] = MediaIndex.from_bytes(data[4 + header_size:]) if len(data) > 4 + header_size else None
+        return entry
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None and shared_state:
+            # Another worker may have probed and indexed the object already
+            data = await asyncio.to_thread(shared_state.get_media, json.dumps(key))
+            if data is not None:
+                entry = self.entries[key] = self._decode(data)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    async def put(self, key, entry: dict):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if shared_state:
+            await asyncio.to_thread(shared_state.put_media, json.dumps(key), self._encode(entry), self.max_entries)
+
+
+media_index_cache = MediaIndexCache()
+
+
+class RangeProxy:
+    """
+    Serves objects to ffprobe over HTTP on 127.0.0.1 through a blocking read_range(start,
+    end_exclusive) callable, such as a storage driver's. The storage credentials stay in this
+    process instead of on ffprobe's command line, where any local user could read them from
+    /proc. Each object is exposed under an unguessable path only while it is being probed.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.server = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self._serve(send_body=False)
+
+            def do_GET(self):
+                self._serve(send_body=True)
+
+            def _serve(self, send_body: bool):
+                exposed = proxy.objects.get(self.path)
+                if exposed is None:
+                    self.send_error(404)
+                    return
+                read_range, size = exposed
+                start, end = 0, size
+                requested = self.headers.get("Range", "")
+                if requested.startswith("bytes=") and "," not in requested:
+                    first, _, last = requested[len("bytes="):].partition("-")
+                    if first:
+                        start, end = int(first), min(int(last) + 1, size) if last else size
+                    elif last:
+                        start = max(0, size - int(last))
+                    if start >= size:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+                else:
+                    self.send_response(200)
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(end - start))
+                self.end_headers()
+                if not send_body:
+                    return
+                try:
+                    # ffprobe drops the connection once it has what it needs, or to seek elsewhere
+                    for offset in range(start, end, _PROXY_CHUNK_BYTES):
+                        self.wfile.write(read_range(offset, min(offset + _PROXY_CHUNK_BYTES, end)))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                except Exception as e:
+                    print(f"[PROBE] Serving bytes {start}-{end - 1} to ffprobe failed: {e}")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @contextmanager
+    def expose(self, read_range, size: int):
+        """Yields the URL the object can be read from until the block ends."""
+        with self.lock:
+            if self.server is None:
+                self._start()
+        path = f"/{secrets.token_urlsafe(24)}"
+        self.objects[path] = (read_range, size)
+        try:
+            yield f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+        finally:
+            self.objects.pop(path, None)
+
+
+range_proxy = RangeProxy()
+
+
+async def ffprobe_url(url: str) -> dict:
+    """
+    Runs ffprobe against a URL. Over HTTP ffprobe only issues range requests for the
+    container headers, so this does not download the media.
+    """
+    command = ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", url]
+    result = await run_process(command, job_class="interactive")
+    return json.loads(result.stdout)
+
+
+async def ffprobe_object(bucket_manager, uri: str, size: int) -> dict:
+    """
+    ffprobe results for a stored object: read directly where the driver offers a path-like
+    media_url (local files), otherwise through range_proxy, which reads it with read_range.
+    """
+    if hasattr(bucket_manager, "media_url"):
+        return await ffprobe_url(bucket_manager.media_url(uri))
+    with range_proxy.expose(lambda start, end: bucket_manager.read_range(uri, start, end), size) as url:
+        return await ffprobe_url(url)
+
+
+async def get_media_info(bucket_manager, uri: str, metadata: dict = None, with_probe: bool = True, with_index: bool = True) -> dict:
+    """
+    Probe results and, for MP4/MOV, the packet index of a GCS object, from cache when the
+    object generation has been seen before.
+
+    Returns a dict with "metadata", "probe" (ffprobe JSON or None) and "index" (MediaIndex or None).
+    """
+    if metadata is None:
+        metadata = await asyncio.to_thread(bucket_manager.get_metadata, uri)
+    key = (bucket_manager.bucket_name, bucket_manager.blob_name(uri), metadata["generation"])
+    entry = await media_index_cache.get(key)
+    changed = entry is None
+    if entry is None:
+        entry = {"metadata": metadata, "probe": None, "index": None, "index_built": False}
+
+    if with_probe and entry["probe"] is None:
+        print(f"[PROBE] Running ffprobe against {uri}")
+        entry["probe"] = await ffprobe_object(bucket_manager, uri, metadata["size"])
+        changed = True
+    if with_index and not entry["index_built"]:
+        print(f"[PROBE] Building packet index for {uri}")
+        entry["index"] = await asyncio.to_thread(
+            MediaIndex.from_reader,
+            lambda start, end: bucket_manager.read_range(uri, start, end),
+            metadata["size"],
+        )
+        entry["index_built"] = True
+        changed = True
+    if changed:
+        await media_index_cache.put(key, entry)
+    return entry
+
+
+async def describe_media(bucket_manager, uri: str, metadata: dict = None) -> dict:
+    """
+    Duration (seconds), video frame size and whether the object has an audio track, from the
+    packet index for MP4/MOV and from ffprobe otherwise. Values that cannot be determined are None.
+    """
+    description = {"duration": None, "width": None, "height": None, "has_audio": None}
+    try:
+        index = (await get_media_info(bucket_manager, uri, metadata, with_probe=False))["index"]
+        if index is not None:
+            track = index.video_track()
+            if track is not None:
+                description["duration"] = track.times[-1] if len(track.times) else None
+                description["width"] = track.width or None
+                description["height"] = track.height or None
+            description["has_audio"] = any(track.handler == "soun" for track in index.tracks)
+            return description
+        probe = (await get_media_info(bucket_manager, uri, metadata, with_index=False))["probe"]
+        description["duration"] = float(probe["format"]["duration"]) if "duration" in probe.get("format", {}) else None
+        video = next((stream for stream in probe.get("streams", []) if stream.get("codec_type") == "video"), {})
+        description["width"] = video.get("width")
+        description["height"] = video.get("height")
+        description["has_audio"] = any(stream.get("codec_type") == "audio" for stream in probe.get("streams", []))
+    except Exception as e:
+        print(f"[PROBE] Warning: could not describe {uri}: {e}")
+    return description
+
+
+async def source_ranges_for_command(bucket_manager, uri: str, metadata: dict, command_parts: list):
+    """
+    Byte ranges of the source an ffmpeg command actually reads, or None when it needs the
+    whole object (no input-side seek, not an indexable MP4/MOV, or indexing failed).
+    """
+    trim_window = trim_window_from_command(command_parts)
+    if not trim_window:
+        return None
+    try:
+        media_info = await get_media_info(bucket_manager, uri, metadata, with_probe=False)
+    except Exception as e:
+        print(f"[PROBE] Warning: could not index {uri}, downloading it in full: {e}")
+        return None
+    if media_info["index"] is None:
+        return None
+    ranges = media_info["index"].byte_ranges_for_window(*trim_window)
+    print(f"[PROBE] Trim window {trim_window} needs {len(ranges)} byte ranges")
+    return ranges
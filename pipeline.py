@@ -0,0 +1,160 @@
+import os
+import shlex
+import asyncio
+from typing import Callable
+from uuid import uuid4
+from dotenv import load_dotenv
+
+from add_captions import caption_video_file, get_speech_client
+from storage import storage_for, upload_cancellable
+from ffmpeg_planner import parse_ffmpeg_command, optimize_plan, fuse_plans, FFmpegCommandError
+from media_index import source_ranges_for_command
+from process_runner import run_process
+from workspace import workspace_manager
+from job_store import checkpoint_reached, record_checkpoint
+
+load_dotenv()
+
+FFMPEG_STEP = "ffmpeg"
+CAPTIONS_STEP = "captions"
+
+
+class PipelineStage:
+    """One local processing pass: an ffmpeg plan (possibly fused from several steps) or a captioning pass."""
+
+    def __init__(self, kind: str, step_numbers: list, plan=None, target_lang: str = None, caption_mode: str = "burn"):
+        self.kind = kind
+        self.step_numbers = step_numbers
+        self.plan = plan
+        self.target_lang = target_lang
+        self.caption_mode = caption_mode
+
+
+def build_stages(steps: list, fuse: bool = True) -> list:
+    """
+    Turns the request's steps into stages. Consecutive ffmpeg steps are fused into a single
+    ffmpeg invocation whenever fuse_plans can combine their filter chains.
+    """
+    stages = []
+    for number, step in enumerate(steps, start=1):
+        if step.type == CAPTIONS_STEP:
+            stages.append(PipelineStage(CAPTIONS_STEP, [number], target_lang=step.target_lang, caption_mode=step.caption_mode))
+            continue
+        if not step.ffmpeg_command:
+            raise FFmpegCommandError(f"Step {number}: ffmpeg steps need an ffmpeg_command")
+        plan = parse_ffmpeg_command(step.ffmpeg_command)
+        previous = stages[-1] if stages else None
+        if fuse and previous is not None and previous.kind == FFMPEG_STEP:
+            fused = fuse_plans(previous.plan, plan)
+            if fused is not None:
+                previous.plan = fused
+                previous.step_numbers.append(number)
+                continue
+        stages.append(PipelineStage(FFMPEG_STEP, [number], plan=plan))
+    return stages
+
+
+async def execute_pipeline_on_gcs_video(video_uri: str, steps: list, bucket_name: str, token_provider: Callable[[], str], output_extension: str = "mp4", return_raw_output: bool = False, optimize: bool = True, job=None) -> dict:
+    """
+    Run an ordered list of steps (ffmpeg commands and built-ins such as captioning) on one video.
+
+    The source is downloaded once, intermediates stay in the job workspace and only the final
+    result is uploaded. Adjacent ffmpeg steps are fused into one filter chain where possible,
+    which also saves their intermediate encode passes.
+    With a stored job, each stage's output is checkpointed and a resumed run continues
+    from the last stage that finished.
+    """
+    if checkpoint_reached(job, "output_uploaded"):
+        return job.checkpoints["output_uploaded"]
+
+    print(f"[PIPELINE] Starting {len(steps)}-step pipeline")
+    print(f"[PIPELINE] Input video URI: {video_uri}")
+
+    stages = build_stages(steps, fuse=optimize)
+    print(f"[PIPELINE] Running {len(steps)} steps as {len(stages)} stages")
+
+    bucket_manager = storage_for(bucket_name, token_provider)
+    metadata = await asyncio.to_thread(bucket_manager.get_metadata, video_uri)
+    source_extension = os.path.splitext(bucket_manager.blob_name(video_uri))[1]
+    if job:
+        await job.reset_if_source_changed(metadata["generation"])
+
+    # Optimize stage by stage; each stage reads the previous stage's output container
+    stage_extensions = []
+    optimizations = []
+    for index, stage in enumerate(stages):
+        extension = output_extension if index == len(stages) - 1 else "mp4"
+        if stage.kind == FFMPEG_STEP and optimize:
+            input_extension = source_extension if index == 0 else f".{stage_extensions[-1]}"
+            for note in optimize_plan(stage.plan, extension, input_extension):
+                optimizations.append(f"stage {index + 1}: {note}")
+                print(f"[PIPELINE] Optimization (stage {index + 1}): {note}")
+        stage_extensions.append(extension)
+
+    # A leading trim only needs part of the source
+    ranges = None
+    if stages[0].kind == FFMPEG_STEP:
+        ranges = await source_ranges_for_command(bucket_manager, video_uri, metadata, stages[0].plan.to_args())
+    expected_bytes = sum(end - start for start, end in ranges) if ranges else metadata["size"]
+
+    speech_client = None
+    if any(stage.kind == CAPTIONS_STEP for stage in stages):
+        speech_client = await asyncio.to_thread(get_speech_client)
+
+    async with workspace_manager.job(expected_bytes, job_id=job and job.id, keep_on_cancel=job is not None) as workspace:
+        stage_paths = [workspace.file(f"stage{index + 1}.{extension}") for index, extension in enumerate(stage_extensions)]
+        # A resumed job continues after the last stage whose output survived
+        first_stage = 0
+        for index in reversed(range(len(stages))):
+            if checkpoint_reached(job, f"stage{index + 1}_ready", stage_paths[index]):
+                first_stage = index + 1
+                print(f"[PIPELINE] Resuming after stage {first_stage} from an earlier attempt")
+                break
+
+        if first_stage:
+            current_path = stage_paths[first_stage - 1]
+        else:
+            current_path = workspace.file("input" + source_extension)
+            if checkpoint_reached(job, "source_downloaded", current_path):
+                print(f"[PIPELINE] Reusing source downloaded by an earlier attempt")
+            else:
+                if ranges:
+                    await asyncio.to_thread(bucket_manager.download_ranges, video_uri, current_path, metadata["size"], ranges)
+                else:
+                    await asyncio.to_thread(bucket_manager.download, video_uri, current_path)
+                await record_checkpoint(job, "source_downloaded", path=current_path, generation=metadata["generation"])
+
+        stage_reports = [{"steps": stage.step_numbers, "type": stage.kind, "resumed": True} for stage in stages[:first_stage]]
+        for index, stage in enumerate(stages[first_stage:], start=first_stage):
+            stage_output = stage_paths[index]
+            print(f"[PIPELINE] Stage {index + 1}/{len(stages)} ({stage.kind}, steps {stage.step_numbers})")
+            report = {"steps": stage.step_numbers, "type": stage.kind}
+
+            if stage.kind == CAPTIONS_STEP:
+                await caption_video_file(
+                    current_path, stage_output, workspace, speech_client, stage.target_lang,
+                    artifact_prefix=f"stage{index + 1}_", caption_mode=stage.caption_mode, job=job
+                )
+            else:
+                command_parts = stage.plan.to_args(current_path, stage_output)
+                print(f"[PIPELINE] Executing command: {shlex.join(command_parts)}")
+                result = await run_process(command_parts)
+                report.update({"command": shlex.join(command_parts), "stderr": result.stderr, "resource_usage": result.usage})
+            await record_checkpoint(job, f"stage{index + 1}_ready", path=stage_output)
+
+            # Intermediates are dropped as soon as the next stage has consumed them
+            if index > 0:
+                os.unlink(current_path)
+            current_path = stage_output
+            stage_reports.append(report)
+
+        output_path = f"ffmpeg_processed/{uuid4()}.{output_extension}"
+        print(f"[PIPELINE] Uploading final result to GCS path: {output_path}")
+        result_uri = await upload_cancellable(bucket_manager, current_path, output_path)
+        print(f"[PIPELINE] Upload completed. Result URI: {result_uri}")
+
+        response = {"result_uri": result_uri, "stages": len(stages)}
+        if return_raw_output:
+            response.update({"stage_outputs": stage_reports, "optimizations": optimizations})
+        await record_checkpoint(job, "output_uploaded", **response)
+        return response
@@ -0,0 +1,148 @@
+import os
+import math
+import shlex
+import asyncio
+from typing import Callable
+from uuid import uuid4
+from dotenv import load_dotenv
+
+from storage import storage_for, upload_cancellable
+from media_index import describe_media
+from process_runner import run_process
+from workspace import workspace_manager
+from job_store import checkpoint_reached, record_checkpoint
+
+load_dotenv()
+
+# Encoding settings for the preview clip; it is small and short, so speed matters more than size
+PREVIEW_CLIP_PRESET = os.getenv("PREVIEW_CLIP_PRESET", "veryfast")
+PREVIEW_CLIP_CRF = os.getenv("PREVIEW_CLIP_CRF", "28")
+
+
+class PreviewSettings:
+    """What to render: a poster frame, seek-bar sprite sheets and a short preview clip."""
+
+    def __init__(self, poster_time: float = None, poster_width: int = 1280, sprite_interval: float = 10,
+                 sprite_width: int = 160, sprite_columns: int = 10, sprite_rows: int = 10,
+                 sprite_keyframes_only: bool = False, clip_start: float = None, clip_duration: float = 6,
+                 clip_width: int = 480):
+        self.poster_time = poster_time
+        self.poster_width = poster_width
+        self.sprite_interval = sprite_interval
+        self.sprite_width = sprite_width
+        self.sprite_columns = sprite_columns
+        self.sprite_rows = sprite_rows
+        self.sprite_keyframes_only = sprite_keyframes_only
+        self.clip_start = clip_start
+        self.clip_duration = clip_duration
+        self.clip_width = clip_width
+
+    def resolve(self, duration: float = None) -> tuple:
+        """
+        Poster time and clip start in seconds. Both default to 10% into the video and are
+        kept inside it when the duration is known, so the trims never come out empty.
+        """
+        poster_time = self.poster_time
+        clip_start = self.clip_start
+        if duration:
+            default = duration * 0.1
+            poster_time = min(default if poster_time is None else poster_time, duration * 0.95)
+            clip_start = min(default if clip_start is None else clip_start, max(duration - self.clip_duration, 0))
+        return poster_time or 0, clip_start or 0
+
+
+def build_previews_command(input_path: str, output_dir: str, settings: PreviewSettings, duration: float = None) -> list:
+    """
+    One ffmpeg invocation producing every preview output from a single decode of the source:
+    the video is split into a poster, a sprite and a clip branch with the split filter.
+    With sprite_keyframes_only the sprite branch instead reads a second, keyframe-only
+    decode of the same file, which is much cheaper than decoding every frame.
+    """
+    poster_time, clip_start = settings.resolve(duration)
+    command = ["ffmpeg", "-y", "-i", input_path]
+    if settings.sprite_keyframes_only:
+        command += ["-skip_frame", "nokey", "-i", input_path]
+        graph = ["[0:v]split=2[poster_in][clip_in]"]
+        sprite_in = "[1:v]"
+    else:
+        graph = ["[0:v]split=3[poster_in][clip_in][sprite_in]"]
+        sprite_in = "[sprite_in]"
+    graph += [
+        f"[poster_in]trim=start={poster_time:.3f},setpts=PTS-STARTPTS,scale={settings.poster_width}:-2[poster]",
+        f"{sprite_in}fps=1/{settings.sprite_interval},scale={settings.sprite_width}:-2,"
+        f"tile={settings.sprite_columns}x{settings.sprite_rows}[sprite]",
+        f"[clip_in]trim=start={clip_start:.3f}:duration={settings.clip_duration},setpts=PTS-STARTPTS,"
+        f"scale={settings.clip_width}:-2[clip]",
+    ]
+    command += [
+        "-filter_complex", ";".join(graph),
+        "-map", "[poster]", "-frames:v", "1", "-q:v", "2", os.path.join(output_dir, "poster.jpg"),
+        # tile emits one image per full sheet and flushes the last, partial sheet at the end
+        "-map", "[sprite]", "-q:v", "4", os.path.join(output_dir, "sprite_%03d.jpg"),
+        "-map", "[clip]", "-an", "-c:v", "libx264", "-preset", PREVIEW_CLIP_PRESET, "-crf", PREVIEW_CLIP_CRF,
+        "-pix_fmt", "yuv420p", "-movflags", "+faststart", os.path.join(output_dir, "preview.mp4"),
+    ]
+    return command
+
+
+async def generate_previews_on_gcs_video(video_uri: str, bucket_name: str, token_provider: Callable[[], str], settings: PreviewSettings, return_raw_output: bool = False, job=None) -> dict:
+    """
+    Download a video once, render its poster, sprite sheets and preview clip with one
+    ffmpeg pass and upload all of them concurrently under previews/<id>/.
+    """
+    if checkpoint_reached(job, "output_uploaded"):
+        return job.checkpoints["output_uploaded"]
+
+    print(f"[PREVIEWS] Generating previews for {video_uri}")
+    bucket_manager = storage_for(bucket_name, token_provider)
+    metadata = await asyncio.to_thread(bucket_manager.get_metadata, video_uri)
+    source_extension = os.path.splitext(bucket_manager.blob_name(video_uri))[1]
+    if job:
+        await job.reset_if_source_changed(metadata["generation"])
+    duration = (await describe_media(bucket_manager, video_uri, metadata))["duration"]
+
+    async with workspace_manager.job(metadata["size"], job_id=job and job.id, keep_on_cancel=job is not None) as workspace:
+        input_path = workspace.file("input" + source_extension)
+        if checkpoint_reached(job, "source_downloaded", input_path):
+            print(f"[PREVIEWS] Reusing video downloaded by an earlier attempt")
+        else:
+            await asyncio.to_thread(bucket_manager.download, video_uri, input_path)
+            await record_checkpoint(job, "source_downloaded", path=input_path, generation=metadata["generation"])
+
+        output_dir = workspace.file("previews")
+        os.makedirs(output_dir, exist_ok=True)
+        command_parts = build_previews_command(input_path, output_dir, settings, duration)
+        print(f"[PREVIEWS] Executing command: {shlex.join(command_parts)}")
+        result = await run_process(command_parts)
+
+        sprite_files = sorted(name for name in os.listdir(output_dir) if name.startswith("sprite_"))
+        prefix = f"previews/{uuid4()}"
+        names = ["poster.jpg", "preview.mp4"] + sprite_files
+        print(f"[PREVIEWS] Uploading {len(names)} files to {bucket_manager.uri(prefix)}/")
+        uris = await asyncio.gather(*(
+            upload_cancellable(bucket_manager, os.path.join(output_dir, name), f"{prefix}/{name}")
+            for name in names
+        ))
+        uploaded = dict(zip(names, uris))
+
+        sheet_size = settings.sprite_columns * settings.sprite_rows
+        response = {
+            "result_uri": bucket_manager.uri(f"{prefix}/"),
+            "poster_uri": uploaded["poster.jpg"],
+            "preview_uri": uploaded["preview.mp4"],
+            "sprite_uris": [uploaded[name] for name in sprite_files],
+            "sprite": {
+                "interval": settings.sprite_interval,
+                "columns": settings.sprite_columns,
+                "rows": settings.sprite_rows,
+                "thumbnail_width": settings.sprite_width,
+                "thumbnails": math.ceil(duration / settings.sprite_interval) if duration else None,
+                "thumbnails_per_sheet": sheet_size,
+                "keyframes_only": settings.sprite_keyframes_only,
+            },
+            "duration": duration,
+        }
+        if return_raw_output:
+            response.update({"command": shlex.join(command_parts), "stderr": result.stderr, "resource_usage": result.usage})
+        await record_checkpoint(job, "output_uploaded", **response)
+        return response
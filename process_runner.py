@@ -0,0 +1,304 @@
+import os
+import time
+import shutil
+import signal
+import asyncio
+import resource
+import subprocess
+import contextvars
+from uuid import uuid4
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# After SIGTERM, how long a cancelled process group gets to exit before it is killed
+PROCESS_KILL_GRACE_SECONDS = float(os.getenv("PROCESS_KILL_GRACE_SECONDS", "2"))
+# Limits for every ffmpeg/ffprobe process (0 = unlimited). The address-space limit counts
+# virtual memory, which for a threaded encoder is well above its resident size.
+PROCESS_MAX_ADDRESS_SPACE_BYTES = int(os.getenv("PROCESS_MAX_ADDRESS_SPACE_BYTES", "0"))
+PROCESS_MAX_CPU_SECONDS = int(os.getenv("PROCESS_MAX_CPU_SECONDS", "0"))
+PROCESS_TIMEOUT_SECONDS = float(os.getenv("PROCESS_TIMEOUT_SECONDS", "0"))
+# Scheduling priority per job class, as "<nice>" or "<nice>:<ionice class>[:<ionice level>]"
+# (ionice classes: realtime, best-effort, idle). "interactive" is media probing, "standard"
+# is work a client is waiting on and "batch" is work nobody is waiting on (callbacks, resumed jobs).
+PROCESS_PRIORITIES = {
+    "interactive": os.getenv("PROCESS_PRIORITY_INTERACTIVE", "0:best-effort:2"),
+    "standard": os.getenv("PROCESS_PRIORITY_STANDARD", "5:best-effort:4"),
+    "batch": os.getenv("PROCESS_PRIORITY_BATCH", "10:idle"),
+}
+# cgroup v2 directory delegated to this service (e.g. /sys/fs/cgroup/coolifyeasyapi). When set,
+# every process runs in its own child cgroup with the limits below (empty/0 = unlimited), and its
+# peak memory and CPU time are read from there instead of being sampled from /proc.
+PROCESS_CGROUP_ROOT = os.getenv("PROCESS_CGROUP_ROOT", "")
+PROCESS_CGROUP_MEMORY_MAX = int(os.getenv("PROCESS_CGROUP_MEMORY_MAX", "0"))
+PROCESS_CGROUP_CPUS = float(os.getenv("PROCESS_CGROUP_CPUS", "0"))
+# How often peak RSS and CPU time are sampled from /proc when no cgroup is used; the last interval
+# before a process exits is not seen, so short processes are under-reported
+PROCESS_SAMPLE_SECONDS = float(os.getenv("PROCESS_SAMPLE_SECONDS", "0.5"))
+
+IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+NICE = shutil.which("nice")
+IONICE = shutil.which("ionice")
+PRLIMIT = shutil.which("prlimit")
+
+# Job class of the processes started from the current task; set per job by main.run_job
+current_job_class = contextvars.ContextVar("current_job_class", default="standard")
+
+
+class ProcessTimeout(subprocess.CalledProcessError):
+    """Raised when a process ran longer than PROCESS_TIMEOUT_SECONDS and was killed."""
+
+    def __init__(self, timeout: float, cmd, output=None, stderr=None):
+        super().__init__(-signal.SIGKILL, cmd, output, stderr)
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"Command '{self.cmd}' timed out after {self.timeout:g} seconds"
+
+
+class ProcessResult(subprocess.CompletedProcess):
+    """A CompletedProcess that also carries the process's resource usage."""
+
+    def __init__(self, args, returncode, stdout=None, stderr=None, usage: dict = None):
+        super().__init__(args, returncode, stdout, stderr)
+        self.usage = usage or {}
+
+
+def priority_prefix(name: str) -> list:
+    """nice/ionice wrapper for a job class. Both are per thread, so they are set before exec, not after."""
+    setting = PROCESS_PRIORITIES.get(name) or PROCESS_PRIORITIES["standard"]
+    nice, _, ionice = setting.partition(":")
+    prefix = []
+    if NICE and int(nice or 0):
+        prefix += [NICE, "-n", nice]
+    if IONICE and ionice:
+        io_class, _, io_level = ionice.partition(":")
+        # -t: run the command anyway where the I/O scheduler or container does not allow it
+        prefix += [IONICE, "-t", "-c", IONICE_CLASSES.get(io_class, io_class)]
+        if io_level and io_class not in ("idle", "3"):
+            prefix += ["-n", io_level]
+    return prefix
+
+
+def configured_rlimits() -> list:
+    """(resource, prlimit option, value) of the configured rlimits, capped at this process's hard limits."""
+    limits = []
+    for limit, option, value in ((resource.RLIMIT_AS, "--as", PROCESS_MAX_ADDRESS_SPACE_BYTES),
+                                 (resource.RLIMIT_CPU, "--cpu", PROCESS_MAX_CPU_SECONDS)):
+        if value:
+            _, hard = resource.getrlimit(limit)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            limits.append((limit, option, value))
+    return limits
+
+
+def rlimit_prefix() -> list:
+    """
+    prlimit wrapper setting the rlimits before the command execs, so no part of it runs (or
+    forks children) without them. A preexec_fn would do the same, but is not safe in a process
+    running threads (asyncio.to_thread, storage transfers): the child can deadlock before exec.
+    """
+    limits = configured_rlimits()
+    if not PRLIMIT or not limits:
+        return []
+    return [PRLIMIT, *(f"{option}={value}" for _, option, value in limits), "--"]
+
+
+def apply_rlimits(pid: int):
+    """Without prlimit(1): sets the rlimits on the process right after it was started."""
+    for limit, _, value in configured_rlimits():
+        try:
+            resource.prlimit(pid, limit, (value, value))
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+class ProcessCgroup:
+    """A cgroup v2 child of PROCESS_CGROUP_ROOT holding one process (and everything it spawns)."""
+
+    available = None
+
+    def __init__(self):
+        self.path = os.path.join(PROCESS_CGROUP_ROOT, f"job-{uuid4().hex[:12]}")
+
+    @classmethod
+    def supported(cls) -> bool:
+        if cls.available is None:
+            cls.available = False
+            if PROCESS_CGROUP_ROOT:
+                try:
+                    with open(os.path.join(PROCESS_CGROUP_ROOT, "cgroup.subtree_control"), "w") as f:
+                        f.write("+memory +cpu")
+                    cls.available = True
+                except OSError as e:
+                    print(f"[PROCESS] cgroup v2 not usable at {PROCESS_CGROUP_ROOT}, running without: {e}")
+        return cls.available
+
+    def _write(self, name: str, value: str):
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(value)
+
+    def _read(self, name: str) -> str:
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except OSError:
+            return ""
+
+    def create(self):
+        os.mkdir(self.path)
+        if PROCESS_CGROUP_MEMORY_MAX:
+            self._write("memory.max", str(PROCESS_CGROUP_MEMORY_MAX))
+        if PROCESS_CGROUP_CPUS:
+            period = 100000
+            self._write("cpu.max", f"{int(PROCESS_CGROUP_CPUS * period)} {period}")
+
+    def add(self, pid: int):
+        self._write("cgroup.procs", str(pid))
+
+    def usage(self) -> dict:
+        cpu_usec = next((int(line.split()[1]) for line in self._read("cpu.stat").splitlines() if line.startswith("usage_usec ")), None)
+        peak = self._read("memory.peak").strip()
+        return {
+            "cpu_seconds": round(cpu_usec / 1e6, 3) if cpu_usec is not None else None,
+            "peak_rss_bytes": int(peak) if peak.isdigit() else None,
+            "source": "cgroup",
+        }
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+
+class ProcSampler:
+    """Peak RSS (VmHWM) and CPU time (utime + stime) of a running process, sampled from /proc."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_rss_bytes = None
+        self.cpu_seconds = None
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        self.peak_rss_bytes = max(self.peak_rss_bytes or 0, int(line.split()[1]) * 1024)
+            with open(f"/proc/{self.pid}/stat") as f:
+                # Fields after the parenthesised command name; utime and stime are the 12th and 13th
+                fields = f.read().rsplit(")", 1)[1].split()
+            self.cpu_seconds = round((int(fields[11]) + int(fields[12])) / CLOCK_TICKS, 3)
+        except (OSError, IndexError, ValueError):
+            pass
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(PROCESS_SAMPLE_SECONDS)
+
+    def usage(self) -> dict:
+        return {"cpu_seconds": self.cpu_seconds, "peak_rss_bytes": self.peak_rss_bytes, "source": "proc"}
+
+
+def _signal_group(process: asyncio.subprocess.Process, sig: int):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def terminate_process_group(process: asyncio.subprocess.Process):
+    """SIGTERM the process and everything it spawned, then SIGKILL whatever is left after the grace period."""
+    _signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), PROCESS_KILL_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        pass
+    # Children may outlive the leader, so the group is killed either way
+    _signal_group(process, signal.SIGKILL)
+    await process.wait()
+
+
+def format_usage(usage: dict) -> str:
+    cpu = f"{usage['cpu_seconds']:.1f}s CPU" if usage.get("cpu_seconds") is not None else "CPU unknown"
+    rss = f"peak RSS {usage['peak_rss_bytes'] / 1024 ** 2:.0f} MiB" if usage.get("peak_rss_bytes") else "peak RSS unknown"
+    return f"{usage['wall_seconds']:.1f}s wall, {cpu}, {rss}"
+
+
+async def run_process(command_parts: list, job_class: str = None) -> ProcessResult:
+    """
+    Run a command (ffmpeg, ffprobe, ...) without blocking the event loop.
+
+    Mirrors subprocess.run(command_parts, check=True, capture_output=True, text=True):
+    returns a CompletedProcess on success and raises CalledProcessError on a
+    non-zero exit code, so callers can keep their existing error handling.
+    The command runs in its own process group, which is terminated as a whole if the
+    caller is cancelled.
+
+    Every process gets the configured rlimits, wall-clock timeout (ProcessTimeout), the
+    nice/ionice priority of its job class (job_class, or the current job's class) and,
+    with PROCESS_CGROUP_ROOT, its own cgroup. Its peak RSS and CPU time are returned in
+    result.usage, and attached as .usage to a CalledProcessError.
+    """
+    prefix = rlimit_prefix() + priority_prefix(job_class or current_job_class.get())
+    cgroup = ProcessCgroup() if ProcessCgroup.supported() else None
+    if cgroup:
+        try:
+            cgroup.create()
+        except OSError as e:
+            print(f"[PROCESS] Could not create cgroup {cgroup.path}, running without it: {e}")
+            cgroup.remove()
+            cgroup = None
+    started_at = time.monotonic()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *prefix, *command_parts,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        if not PRLIMIT:
+            apply_rlimits(process.pid)
+        if cgroup:
+            cgroup.add(process.pid)
+            sampler = None
+        else:
+            sampler = ProcSampler(process.pid)
+            sampling = asyncio.create_task(sampler.run())
+
+        def measure_usage() -> dict:
+            return {**(cgroup.usage() if cgroup else sampler.usage()), "wall_seconds": round(time.monotonic() - started_at, 3)}
+
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), PROCESS_TIMEOUT_SECONDS or None)
+        except asyncio.TimeoutError:
+            await asyncio.shield(terminate_process_group(process))
+            error = ProcessTimeout(PROCESS_TIMEOUT_SECONDS, command_parts)
+            error.usage = measure_usage()
+            print(f"[PROCESS] {os.path.basename(command_parts[0])} killed after {PROCESS_TIMEOUT_SECONDS:g}s: {format_usage(error.usage)}")
+            raise error
+        except asyncio.CancelledError:
+            # Don't leave ffmpeg running after the request that started it is gone
+            if process.returncode is None:
+                await asyncio.shield(terminate_process_group(process))
+            raise
+        finally:
+            if sampler:
+                sampling.cancel()
+        usage = measure_usage()
+    finally:
+        if cgroup:
+            cgroup.remove()
+    print(f"[PROCESS] {os.path.basename(command_parts[0])} exited with {process.returncode}: {format_usage(usage)}")
+
+    stdout = stdout.decode(errors="replace")
+    stderr = stderr.decode(errors="replace")
+    if process.returncode != 0:
+        error = subprocess.CalledProcessError(process.returncode, command_parts, output=stdout, stderr=stderr)
+        error.usage = usage
+        raise error
+    return ProcessResult(command_parts, process.returncode, stdout, stderr, usage)
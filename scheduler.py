@@ -0,0 +1,245 @@
+import os
+import time
+import asyncio
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+from tenants import Tenant
+from shared_state import shared_state, SHARED_STATE_POLL_SECONDS
+
+load_dotenv()
+
+# Jobs processed at the same time (each runs ffmpeg and/or Speech-to-Text); the rest wait in the queue
+WORKER_SLOTS = int(os.getenv("WORKER_SLOTS", "4"))
+# Queue waits kept per tenant for the latency percentiles in /metrics
+SCHEDULER_WAIT_SAMPLES = int(os.getenv("SCHEDULER_WAIT_SAMPLES", "1000"))
+# How fast waiting raises a job's priority: a job that waited its own estimated cost divided by
+# SCHEDULER_AGING_FACTOR ranks like a job twice as short that just arrived
+SCHEDULER_AGING_FACTOR = float(os.getenv("SCHEDULER_AGING_FACTOR", "1"))
+# Estimates below this are rounded up, so near-free jobs do not rank infinitely high
+SCHEDULER_MIN_COST_SECONDS = float(os.getenv("SCHEDULER_MIN_COST_SECONDS", "1"))
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))], 3)
+
+
+class Ticket:
+    """A job waiting for, or holding, a worker slot."""
+
+    def __init__(self, tenant: Tenant, cost: float, sequence: int):
+        self.tenant = tenant
+        # Estimated processing seconds
+        self.cost = max(cost, SCHEDULER_MIN_COST_SECONDS)
+        self.sequence = sequence
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        # Machine-wide slot held while running (shared state only)
+        self.lease = None
+
+
+class FairScheduler:
+    """
+    Schedules jobs onto a fixed number of worker slots.
+
+    Between tenants it is weighted fair queuing (start-time fair queuing): a tenant's start tag
+    is max(virtual time, finish tag of its previous job), and every dispatched job advances
+    its tenant's finish tag by estimated cost / weight. A free slot goes to the tenant with the
+    lowest start tag that is under its concurrency cap, so a tenant with a deep backlog cannot
+    delay another tenant's next job by more than about one job per slot, and tenants share
+    processing time in proportion to their weights.
+
+    Within a tenant it is shortest-job-first with aging: the job with the highest response
+    ratio per estimated second, (aging x wait + cost) / cost², goes first. Of jobs that just
+    arrived the shortest wins, so short jobs overtake long ones, but a long job's priority keeps
+    growing until it runs. (The response ratio alone is 1 for every job that just arrived, so
+    it would dequeue in arrival order whenever the queue is short-lived.)
+
+    With shared state, the slots (and each tenant's max_concurrent) are machine-wide: a job
+    also needs a lease in the shared store, and while the other workers hold all of them the
+    queue is re-checked every SHARED_STATE_POLL_SECONDS.
+    """
+
+    def __init__(self, slots: int = WORKER_SLOTS):
+        self.slots = slots
+        self.running = 0
+        self.virtual_time = 0.0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.waits = {}
+        self.retry = None
+        # Shared state only: the running dispatcher task, whether it must make another pass,
+        # and leases of finished jobs it has yet to return
+        self.dispatcher = None
+        self.redispatch = False
+        self.releasing = deque()
+
+    def _eligible(self, ticket: Ticket) -> bool:
+        tenant = ticket.tenant
+        return not tenant.max_concurrent or tenant.running < tenant.max_concurrent
+
+    def _start_tag(self, tenant: Tenant) -> float:
+        return max(self.virtual_time, tenant.last_finish_tag)
+
+    @staticmethod
+    def _priority(ticket: Ticket, now: float) -> float:
+        return (SCHEDULER_AGING_FACTOR * (now - ticket.enqueued_at) + ticket.cost) / ticket.cost ** 2
+
+    def _retry_later(self):
+        if self.retry is None:
+            def retry():
+                self.retry = None
+                self._dispatch()
+            self.retry = asyncio.get_running_loop().call_later(SHARED_STATE_POLL_SECONDS, retry)
+
+    def _next_ticket(self, capped: set):
+        """The ticket to start next, skipping tenants in capped, or None."""
+        candidates = {}
+        for ticket in self.waiting:
+            if self._eligible(ticket) and ticket.tenant not in capped and not ticket.future.done():
+                candidates.setdefault(ticket.tenant, []).append(ticket)
+        if not candidates:
+            return None
+        tenant = min(candidates, key=lambda tenant: (self._start_tag(tenant), candidates[tenant][0].sequence))
+        now = time.monotonic()
+        return max(candidates[tenant], key=lambda ticket: (self._priority(ticket, now), -ticket.sequence))
+
+    def _start(self, ticket: Ticket):
+        tenant = ticket.tenant
+        start_tag = self._start_tag(tenant)
+        tenant.last_finish_tag = start_tag + ticket.cost / tenant.weight
+        self.virtual_time = start_tag
+        self.waiting.remove(ticket)
+        self.running += 1
+        tenant.running += 1
+        tenant.jobs_started += 1
+        ticket.started_at = time.monotonic()
+        self.waits.setdefault(tenant.name, deque(maxlen=SCHEDULER_WAIT_SAMPLES)).append(
+            ticket.started_at - ticket.enqueued_at
+        )
+        ticket.future.set_result(None)
+
+    def _dispatch(self):
+        if shared_state:
+            # Leases live in SQLite, which can block while another worker holds its lock, so
+            # they are taken and returned by one dispatcher task on worker threads
+            if self.dispatcher is None:
+                self.dispatcher = asyncio.get_running_loop().create_task(self._dispatch_shared())
+            else:
+                self.redispatch = True
+            return
+        while self.running < self.slots:
+            ticket = self._next_ticket(set())
+            if ticket is None:
+                return
+            self._start(ticket)
+
+    async def _dispatch_shared(self):
+        retry = False
+        try:
+            while True:
+                self.redispatch = False
+                while self.releasing:
+                    await asyncio.to_thread(shared_state.release_slot, self.releasing.popleft())
+                # Tenants at their max_concurrent across all workers, for this pass
+                capped = set()
+                retry = False
+                while self.running < self.slots:
+                    ticket = self._next_ticket(capped)
+                    if ticket is None:
+                        retry = bool(capped)
+                        break
+                    tenant = ticket.tenant
+                    lease, refused = await asyncio.to_thread(
+                        shared_state.acquire_slot, tenant.name, tenant.max_concurrent, self.slots
+                    )
+                    if refused == "tenant":
+                        capped.add(tenant)
+                        continue
+                    if refused:
+                        retry = True
+                        break
+                    if ticket not in self.waiting or ticket.future.done():
+                        # Cancelled while the lease was being taken
+                        await asyncio.to_thread(shared_state.release_slot, lease)
+                        continue
+                    ticket.lease = lease
+                    self._start(ticket)
+                if not self.redispatch:
+                    break
+        except Exception as e:
+            print(f"[SCHEDULER] Dispatching from shared state failed: {e}")
+            retry = True
+        finally:
+            self.dispatcher = None
+        if retry:
+            self._retry_later()
+
+    def _release(self, ticket: Ticket):
+        if ticket.lease is not None:
+            self.releasing.append(ticket.lease)
+        self.running -= 1
+        ticket.tenant.running -= 1
+        ticket.tenant.jobs_completed += 1
+        ticket.tenant.busy_seconds += time.monotonic() - ticket.started_at
+        self._dispatch()
+
+    async def acquire(self, tenant: Tenant, cost: float = SCHEDULER_MIN_COST_SECONDS) -> Ticket:
+        ticket = Ticket(tenant, cost, next(self.sequence))
+        self.waiting.append(ticket)
+        self._dispatch()
+        if not ticket.future.done():
+            print(f"[SCHEDULER] Job of '{tenant.name}' (~{ticket.cost:.0f}s) queued "
+                  f"({len(self.waiting)} waiting, {self.running}/{self.slots} slots busy)")
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+            elif ticket.started_at is not None:
+                self._release(ticket)
+            raise
+        return ticket
+
+    @asynccontextmanager
+    async def slot(self, tenant: Tenant, cost: float = SCHEDULER_MIN_COST_SECONDS):
+        ticket = await self.acquire(tenant, cost)
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    async def busy(self) -> int:
+        """Running jobs: on this machine with shared state, else in this worker."""
+        return await asyncio.to_thread(shared_state.slots_in_use) if shared_state else self.running
+
+    async def stats(self) -> dict:
+        waiting_by_tenant = {}
+        for ticket in self.waiting:
+            waiting_by_tenant[ticket.tenant.name] = waiting_by_tenant.get(ticket.tenant.name, 0) + 1
+        return {
+            "slots": self.slots,
+            "running": self.running,
+            "running_on_machine": await self.busy(),
+            "waiting": len(self.waiting),
+            "waiting_by_tenant": waiting_by_tenant,
+            "waiting_cost_seconds": round(sum(ticket.cost for ticket in self.waiting), 1),
+            "queue_wait_seconds": {
+                name: {
+                    "p50": percentile(list(waits), 0.5),
+                    "p95": percentile(list(waits), 0.95),
+                    "p99": percentile(list(waits), 0.99),
+                    "max": round(max(waits), 3) if waits else None,
+                }
+                for name, waits in self.waits.items()
+            },
+        }
+
+
+fair_scheduler = FairScheduler()
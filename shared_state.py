@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from workspace import SCRATCH_DIR, pid_is_alive
+
+load_dotenv()
+
+# Worker processes serving the app (uvicorn/fastapi run --workers also reads WEB_CONCURRENCY)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Share the access token, worker slots, Idempotency-Key results, the media cache and encode calibrations between worker
+# processes on this machine. On by default with more than one worker.
+SHARED_STATE = os.getenv("SHARED_STATE", "true" if WEB_CONCURRENCY > 1 else "false").lower() == "true"
+# SQLite database the workers share; must be on a local filesystem that every worker sees
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", os.path.join(SCRATCH_DIR, "shared.sqlite3"))
+# How often a worker re-checks state another worker owns (a free slot, a keyed result)
+SHARED_STATE_POLL_SECONDS = float(os.getenv("SHARED_STATE_POLL_SECONDS", "0.5"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    name TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slot_leases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL,
+    tenant TEXT NOT NULL,
+    acquired_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS idempotency (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    owner_pid INTEGER NOT NULL,
+    result TEXT,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS tuning (
+    key TEXT PRIMARY KEY,
+    entry TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS media_cache (
+    key TEXT PRIMARY KEY,
+    entry BLOB NOT NULL,
+    used_at REAL NOT NULL
+);
+"""
+
+
+class SharedState:
+    """
+    State the worker processes of one machine share, on SQLite in WAL mode. Every operation is
+    a short local transaction, but one can wait up to busy_timeout for another worker's lock,
+    so, like the job store, it is called through asyncio.to_thread from the event loop.
+
+    - tokens: the current GCP access token, so N workers do not each mint one;
+    - slot_leases: one row per running job, which caps running jobs at WORKER_SLOTS (and each
+      API key at its max_concurrent) machine-wide instead of per worker. Rows of dead workers
+      are reclaimed;
+    - idempotency: which worker runs a keyed request, and its result for replays;
+    - media_cache: probe results and packet indexes, shared like the in-memory LRU;
+    - tuning: encode_profile calibrations, so a resolution class is calibrated once per machine.
+    """
+
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.executescript(SCHEMA)
+            self.connection = connection
+        return self.connection
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> list:
+        with self.lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction: committed when the block completes, rolled back if it (or the commit) raises."""
+        with self.lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+                connection.execute("COMMIT")
+            except BaseException:
+                # SQLite may already have rolled back on its own (e.g. disk full)
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+
+    def start(self):
+        """Drops leases and keyed runs recorded under this pid by a worker that died before it was reused."""
+        self._execute("DELETE FROM slot_leases WHERE pid = ?", (os.getpid(),))
+        self._execute("DELETE FROM idempotency WHERE owner_pid = ? AND result IS NULL", (os.getpid(),))
+
+    # Access token
+
+    def get_token(self, name: str):
+        """(token, expires_at) stored by any worker, or None."""
+        rows = self._execute("SELECT token, expires_at FROM tokens WHERE name = ?", (name,))
+        return rows[0] if rows else None
+
+    def put_token(self, name: str, token: str, expires_at: float):
+        self._execute("INSERT OR REPLACE INTO tokens (name, token, expires_at) VALUES (?, ?, ?)", (name, token, expires_at))
+
+    # Worker slots
+
+    def acquire_slot(self, tenant: str, max_concurrent: int, slots: int) -> tuple:
+        """
+        Leases a machine-wide worker slot for a job of tenant. Returns (lease id, None), or
+        (None, reason) with reason "machine" when all slots are leased and "tenant" when the
+        tenant is at its max_concurrent.
+        """
+        with self._transaction() as connection:
+            dead = [pid for (pid,) in connection.execute("SELECT DISTINCT pid FROM slot_leases") if not pid_is_alive(pid)]
+            for pid in dead:
+                connection.execute("DELETE FROM slot_leases WHERE pid = ?", (pid,))
+            busy, = connection.execute("SELECT COUNT(*) FROM slot_leases").fetchone()
+            if busy >= slots:
+                return None, "machine"
+            if max_concurrent:
+                tenant_busy, = connection.execute("SELECT COUNT(*) FROM slot_leases WHERE tenant = ?", (tenant,)).fetchone()
+                if tenant_busy >= max_concurrent:
+                    return None, "tenant"
+            cursor = connection.execute(
+                "INSERT INTO slot_leases (pid, tenant, acquired_at) VALUES (?, ?, ?)", (os.getpid(), tenant, time.time())
+            )
+            return cursor.lastrowid, None
+
+    def release_slot(self, lease_id: int):
+        self._execute("DELETE FROM slot_leases WHERE id = ?", (lease_id,))
+
+    def slots_in_use(self) -> int:
+        return self._execute("SELECT COUNT(*) FROM slot_leases")[0][0]
+
+    # Idempotency keys
+
+    def claim_key(self, key: str, fingerprint: str):
+        """
+        Records this worker as the one running the keyed request, unless a live worker already
+        does or its result is still retained. Returns None when claimed, else the existing
+        (fingerprint, owner_pid, result) row.
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT fingerprint, owner_pid, result, expires_at FROM idempotency WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                fingerprint_held, owner_pid, result, expires_at = row
+                expired = expires_at is not None and expires_at <= time.time()
+                abandoned = result is None and owner_pid != os.getpid() and not pid_is_alive(owner_pid)
+                if not expired and not abandoned:
+                    return fingerprint_held, owner_pid, json.loads(result) if result else None
+            connection.execute(
+                "INSERT OR REPLACE INTO idempotency (key, fingerprint, owner_pid, result, expires_at) VALUES (?, ?, ?, NULL, NULL)",
+                (key, fingerprint, os.getpid())
+            )
+            return None
+
+    def finish_key(self, key: str, result: dict, ttl_seconds: float):
+        self._execute(
+            "UPDATE idempotency SET result = ?, expires_at = ? WHERE key = ? AND owner_pid = ?",
+            (json.dumps(result), time.time() + ttl_seconds, key, os.getpid())
+        )
+
+    def forget_key(self, key: str):
+        """Drops a keyed run that failed, so a retry (in any worker) executes again."""
+        self._execute("DELETE FROM idempotency WHERE key = ? AND owner_pid = ? AND result IS NULL", (key, os.getpid()))
+
+    def purge_keys(self):
+        self._execute("DELETE FROM idempotency WHERE expires_at <= ?", (time.time(),))
+
+    # Encoder calibrations
+
+    def get_tuning(self, key: str):
+        rows = self._execute("SELECT entry FROM tuning WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def put_tuning(self, key: str, entry: dict):
+        self._execute("INSERT OR REPLACE INTO tuning (key, entry) VALUES (?, ?)", (key, json.dumps(entry)))
+
+    # Media cache
+
+    def get_media(self, key: str):
+        """The serialized entry (see MediaIndexCache) stored by any worker, or None."""
+        rows = self._execute("SELECT entry FROM media_cache WHERE key = ?", (key,))
+        if not rows:
+            return None
+        self._execute("UPDATE media_cache SET used_at = ? WHERE key = ?", (time.time(), key))
+        return rows[0][0]
+
+    def put_media(self, key: str, entry: bytes, max_entries: int):
+        self._execute(
+            "INSERT OR REPLACE INTO media_cache (key, entry, used_at) VALUES (?, ?, ?)",
+            (key, entry, time.time())
+        )
+        self._execute(
+            "DELETE FROM media_cache WHERE key NOT IN (SELECT key FROM media_cache ORDER BY used_at DESC LIMIT ?)",
+            (max_entries,)
+        )
+
+
+shared_state = SharedState() if SHARED_STATE else None
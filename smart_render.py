@@ -0,0 +1,252 @@
+import os
+import re
+import shlex
+import subprocess
+from bisect import bisect_right
+from dotenv import load_dotenv
+
+from media_index import MediaIndex
+from process_runner import run_process
+
+load_dotenv()
+
+# Above this share of the video inside captioned GOPs, smart rendering saves too little and the
+# whole video is burned in one pass instead
+SMART_BURN_MAX_COVERAGE = float(os.getenv("SMART_BURN_MAX_COVERAGE", "0.8"))
+
+# H.264 profiles libx264 can re-encode into, by profile_idc. Other profiles (High 10, 4:2:2, ...)
+# and other codecs fall back to a full re-encode.
+X264_PROFILES = {66: "baseline", 77: "main", 100: "high"}
+# Output containers the final concatenation can stream-copy H.264 into
+SMART_BURN_CONTAINERS = {"mp4", "m4v", "mov", "mkv"}
+# CRF for re-encoded chunks when the source was not encoded by x264 in CRF mode (otherwise its CRF is reused)
+SMART_BURN_DEFAULT_CRF = float(os.getenv("SMART_BURN_DEFAULT_CRF", "18"))
+
+# Settings x264 writes into the first frame of every stream it encodes
+X264_SETTINGS = re.compile(rb"x264 - core \d+.*? rc=(\w+) .*?crf=([0-9.]+)", re.DOTALL)
+# First video stream as ffmpeg describes an input, e.g.
+# "Video: h264 (High) (avc1 / 0x31637661), yuvj420p(pc, bt709, progressive), 640x360 [SAR 1:1 DAR 16:9]"
+VIDEO_STREAM = re.compile(
+    r"Video: (?P<codec>\w+)(?: \((?P<profile>[^)]*)\))?(?: \([^)]*\))*, (?P<pix_fmt>\w+)(?:\((?P<color>[^)]*)\))?, "
+    r"(?P<size>\d+x\d+)(?: \[SAR (?P<sar>\d+:\d+))?"
+)
+SRT_TIMING = re.compile(r"(\d+):(\d\d):(\d\d)[,.](\d{3})\s*-->\s*(\d+):(\d\d):(\d\d)[,.](\d{3})")
+
+
+def read_srt_cues(srt_path: str) -> list:
+    """(start, end) seconds of every cue in an SRT file."""
+    with open(srt_path, encoding="utf-8") as f:
+        cues = []
+        for match in SRT_TIMING.finditer(f.read()):
+            h1, m1, s1, ms1, h2, m2, s2, ms2 = (int(group) for group in match.groups())
+            cues.append((h1 * 3600 + m1 * 60 + s1 + ms1 / 1000, h2 * 3600 + m2 * 60 + s2 + ms2 / 1000))
+    return cues
+
+
+def captioned_spans(cues: list, keyframes: list, duration: float) -> list:
+    """
+    Merged keyframe-aligned (start, end) spans covering every cue: each runs from the keyframe
+    at or before a cue's start to the first keyframe after its end (or the end of the video).
+    """
+    spans = []
+    for cue_start, cue_end in sorted(cues):
+        if cue_start >= duration:
+            continue
+        start = keyframes[max(bisect_right(keyframes, cue_start) - 1, 0)]
+        following = bisect_right(keyframes, cue_end)
+        end = keyframes[following] if following < len(keyframes) else duration
+        if spans and start <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+        else:
+            spans.append((start, end))
+    return spans
+
+
+class SmartBurnPlan:
+    """The source cut at keyframes into chunks; chunks with captions are re-encoded, the rest copied."""
+
+    def __init__(self, spans: list, keyframes: list, duration: float, profile: str, level: int, crf: float):
+        self.spans = spans
+        self.keyframes = keyframes
+        self.duration = duration
+        self.profile = profile
+        self.level = level
+        self.crf = crf
+        self.boundaries = sorted({time for span in spans for time in span if 0 < time < duration})
+        edges = [0.0] + self.boundaries + [duration]
+        self.chunks = [
+            (start, end, any(span_start <= start and end <= span_end for span_start, span_end in spans))
+            for start, end in zip(edges, edges[1:])
+        ]
+
+    @property
+    def reencoded_seconds(self) -> float:
+        return sum(end - start for start, end, captioned in self.chunks if captioned)
+
+    @property
+    def coverage(self) -> float:
+        return self.reencoded_seconds / self.duration if self.duration else 1.0
+
+    def segment_times(self) -> list:
+        """
+        Split times for the segment muxer, which cuts at the first keyframe at or after each time.
+        Halfway back to the previous keyframe, so a B-frame delay between the index's decode
+        times and the muxer's presentation times still lands on the intended keyframe.
+        """
+        times = []
+        for boundary in self.boundaries:
+            position = self.keyframes.index(boundary)
+            previous = self.keyframes[position - 1] if position > 0 else 0.0
+            times.append((previous + boundary) / 2)
+        return times
+
+
+def source_crf(video_path: str, video) -> float:
+    """The CRF x264 encoded the source with (from the settings it writes into the first frame), else SMART_BURN_DEFAULT_CRF."""
+    if len(video.offsets) and len(video.sizes):
+        with open(video_path, "rb") as f:
+            f.seek(video.offsets[0])
+            match = X264_SETTINGS.search(f.read(video.sizes[0]))
+        if match and match.group(1) == b"crf":
+            return float(match.group(2))
+    return SMART_BURN_DEFAULT_CRF
+
+
+async def video_stream_format(path: str):
+    """Codec, profile, pixel format (with colour range and space), size and SAR of a file's video, or None."""
+    try:
+        report = (await run_process(["ffmpeg", "-hide_banner", "-i", path])).stderr
+    except subprocess.CalledProcessError as e:
+        # Without an output ffmpeg exits with an error after describing the input
+        report = e.stderr or ""
+    match = VIDEO_STREAM.search(report)
+    return match.groupdict() if match else None
+
+
+def plan_smart_burn(video_path: str, srt_path: str, output_path: str):
+    """A SmartBurnPlan, or None (with the reason logged) when the video should be burned in one pass."""
+    extension = os.path.splitext(output_path)[1].lstrip(".").lower()
+    if extension not in SMART_BURN_CONTAINERS:
+        print(f"[SMART-BURN] .{extension} outputs are not supported, re-encoding everything")
+        return None
+    index = MediaIndex.from_file(video_path)
+    video = index.video_track() if index else None
+    if video is None or video.codec not in ("avc1", "avc3") or video.avc_profile not in X264_PROFILES:
+        print(f"[SMART-BURN] Source is not 8-bit 4:2:0 H.264 in MP4/MOV, re-encoding everything")
+        return None
+    keyframes = video.keyframe_times()
+    if len(keyframes) < 2 or len(video.times) < 2:
+        print(f"[SMART-BURN] Source has a single keyframe, re-encoding everything")
+        return None
+
+    duration = video.times[-1] + (video.times[-1] - video.times[-2])
+    plan = SmartBurnPlan(
+        captioned_spans(read_srt_cues(srt_path), keyframes, duration),
+        keyframes, duration, X264_PROFILES[video.avc_profile], video.avc_level, source_crf(video_path, video),
+    )
+    if plan.coverage > SMART_BURN_MAX_COVERAGE:
+        print(f"[SMART-BURN] Captions cover {plan.coverage:.0%} of the video, re-encoding everything")
+        return None
+    return plan
+
+
+def concat_quote(path: str) -> str:
+    """Quotes a path for a concat demuxer list."""
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+def read_segment_list(path: str) -> list:
+    with open(path) as f:
+        return [line.split(",")[0] for line in f.read().splitlines() if line.strip()]
+
+
+async def smart_burn_captions(video_path: str, srt_path: str, output_path: str, work_dir: str, subtitle_filter: str,
+                              encoder_options: list = None) -> dict:
+    """
+    Burns captions into only the GOPs that contain cues:
+
+    1. the video stream is cut at keyframes into chunks with -c copy (segment muxer), with
+       SPS/PPS repeated in-band so every chunk decodes on its own;
+    2. chunks containing cues are re-encoded with the subtitles filter, shifted to their
+       position in the source so the cue timings line up, using the source's profile, level,
+       pixel format (and so colour range) and CRF, again with SPS/PPS in every keyframe. Of
+       encoder_options (an encode_profile's libx264 settings), only -preset and -threads are
+       used: a different CRF would make the captioned chunks stand out from the copied ones;
+    3. all chunks are concatenated with -c copy and the source audio is muxed back in untouched.
+
+    Returns what was re-encoded and copied, or None when the video should be burned in one
+    pass instead (unsupported source or output, captions covering most of the video, or a
+    re-encoded chunk whose format differs from the copied ones, which would not decode cleanly
+    after them).
+    """
+    plan = plan_smart_burn(video_path, srt_path, output_path)
+    if plan is None:
+        return None
+
+    os.makedirs(work_dir, exist_ok=True)
+    segment_list = os.path.join(work_dir, "chunks.csv")
+    command = [
+        "ffmpeg", "-y", "-i", video_path, "-map", "0:v:0", "-c", "copy", "-bsf:v", "h264_mp4toannexb",
+        "-f", "segment", "-segment_format", "matroska", "-segment_list", segment_list, "-segment_list_type", "csv",
+    ]
+    if plan.boundaries:
+        command += ["-segment_times", ",".join(f"{time:.3f}" for time in plan.segment_times())]
+    command.append(os.path.join(work_dir, "chunk_%05d.mkv"))
+    print(f"[SMART-BURN] Splitting into {len(plan.chunks)} chunks: {shlex.join(command)}")
+    await run_process(command)
+
+    chunk_files = [os.path.join(work_dir, name) for name in read_segment_list(segment_list)]
+    if len(chunk_files) != len(plan.chunks):
+        print(f"[SMART-BURN] Expected {len(plan.chunks)} chunks but got {len(chunk_files)}, re-encoding everything")
+        return None
+
+    copied_format = await video_stream_format(chunk_files[0])
+    if copied_format is None:
+        print(f"[SMART-BURN] Could not read the format of the copied chunks, re-encoding everything")
+        return None
+
+    # Speed settings only; see the docstring
+    speed_options = [part for flag, value in zip((encoder_options or [])[::2], (encoder_options or [])[1::2])
+                     if flag in ("-preset", "-threads") for part in (flag, value)]
+    concat_entries = []
+    for number, (chunk_file, (start, end, captioned)) in enumerate(zip(chunk_files, plan.chunks)):
+        if captioned:
+            encoded_file = os.path.join(work_dir, f"captioned_{number:05d}.mkv")
+            command = [
+                "ffmpeg", "-y", "-i", chunk_file,
+                "-vf", f"setpts=PTS+{start:.6f}/TB,{subtitle_filter},setpts=PTS-{start:.6f}/TB",
+                "-c:v", "libx264", "-profile:v", plan.profile, "-level", f"{plan.level / 10:g}",
+                "-pix_fmt", copied_format["pix_fmt"], "-crf", f"{plan.crf:g}", *speed_options,
+                "-x264-params", "repeat-headers=1", "-fps_mode", "passthrough",
+                encoded_file,
+            ]
+            print(f"[SMART-BURN] Re-encoding {start:.2f}s-{end:.2f}s: {shlex.join(command)}")
+            await run_process(command)
+            encoded_format = await video_stream_format(encoded_file)
+            if encoded_format != copied_format:
+                print(f"[SMART-BURN] Re-encoded chunk is {encoded_format} but the copied ones are {copied_format}, "
+                      f"re-encoding everything")
+                return None
+            chunk_file = encoded_file
+        concat_entries.append(f"file {concat_quote(chunk_file)}\nduration {end - start:.6f}\n")
+
+    concat_list = os.path.join(work_dir, "concat.txt")
+    with open(concat_list, "w") as f:
+        f.writelines(concat_entries)
+    command = [
+        "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_list, "-i", video_path,
+        "-map", "0:v:0", "-map", "1:a?", "-c", "copy",
+    ]
+    if not output_path.lower().endswith(".mkv"):
+        command += ["-movflags", "+faststart"]
+    command.append(output_path)
+    print(f"[SMART-BURN] Concatenating: {shlex.join(command)}")
+    await run_process(command)
+
+    stats = {
+        "chunks": len(plan.chunks),
+        "reencoded_seconds": round(plan.reencoded_seconds, 3),
+        "copied_seconds": round(plan.duration - plan.reencoded_seconds, 3),
+    }
+    print(f"[SMART-BURN] Re-encoded {stats['reencoded_seconds']:.1f}s of {plan.duration:.1f}s, copied the rest")
+    return stats
@@ -0,0 +1,180 @@
+import os
+import errno
+import fcntl
+import base64
+import shutil
+import asyncio
+import mimetypes
+import tempfile
+import threading
+from typing import Callable
+from uuid import uuid4
+from dotenv import load_dotenv
+
+from gcs_storage import GCSStorageManagerJWT, UploadCancelled
+
+load_dotenv()
+
+# Directories (separated by ":") that file:// buckets may point into, e.g. volumes mounted from the
+# Coolify host. Empty disables the local driver, so requests cannot read or write arbitrary paths.
+LOCAL_STORAGE_ROOTS = [os.path.realpath(root) for root in os.getenv("LOCAL_STORAGE_ROOTS", "").split(os.pathsep) if root]
+
+# ioctl that makes a file share another file's extents (copy-on-write), on btrfs, XFS and others
+FICLONE = 0x40049409
+
+
+class InvalidBucket(ValueError):
+    """Raised when a bucket is a file:// path outside LOCAL_STORAGE_ROOTS (or the local driver is disabled)."""
+
+
+def is_local_bucket(bucket_name: str) -> bool:
+    return bucket_name.startswith("file://")
+
+
+def local_root(bucket_name: str) -> str:
+    """The directory a file:// bucket points to, checked against LOCAL_STORAGE_ROOTS."""
+    root = os.path.realpath(bucket_name[len("file://"):])
+    if not any(root == allowed or root.startswith(allowed + os.sep) for allowed in LOCAL_STORAGE_ROOTS):
+        raise InvalidBucket(f"{bucket_name} is not inside LOCAL_STORAGE_ROOTS")
+    return root
+
+
+def clone_file(source: str, destination: str, hardlink: bool = True):
+    """
+    Makes destination a copy of source without copying bytes where the filesystem allows it:
+    a hardlink (if allowed), else a reflink, else an in-kernel copy (copy_file_range/sendfile).
+    A hardlink is the same file, so it is only safe when neither side is written to again.
+    """
+    if hardlink:
+        try:
+            os.link(source, destination)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+
+class LocalStorage:
+    """
+    Storage driver for file:// buckets: directories on the same host, such as mounted volumes.
+
+    Same interface as GCSStorageManagerJWT. Inputs are staged into the job workspace with a
+    hardlink (or reflink) instead of a download; ffmpeg only ever reads them. Outputs are
+    reflinked (or copied in-kernel) next to their destination under a temporary name and
+    renamed into place, so readers never see a partial file. They are not hardlinked, because
+    some are rewritten in place after publishing (HLS playlists while the encode runs).
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+        self.root = local_root(bucket_name)
+
+    def uri(self, remote_path: str) -> str:
+        return f"file://{self.root}/{remote_path}"
+
+    def blob_name(self, uri: str) -> str:
+        if not is_local_bucket(uri):
+            raise InvalidBucket(f"{uri} is not a file:// URI")
+        path = os.path.realpath(uri[len("file://"):])
+        if not path.startswith(self.root + os.sep):
+            raise InvalidBucket(f"{uri} is not inside {self.bucket_name}")
+        return os.path.relpath(path, self.root)
+
+    def path(self, uri: str) -> str:
+        return os.path.join(self.root, self.blob_name(uri))
+
+    def get_metadata(self, uri: str) -> dict:
+        path = self.path(uri)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Object not found: {uri}")
+        return {
+            "size": stat.st_size,
+            # Changes whenever the file is rewritten or replaced, like a GCS generation
+            "generation": stat.st_mtime_ns,
+            "content_type": mimetypes.guess_type(path)[0],
+        }
+
+    def media_url(self, uri: str) -> str:
+        """Where ffprobe reads the object directly (GCS objects are probed through read_range instead)."""
+        # file: keeps ffprobe from reading a ':' in the name as a protocol
+        return "file:" + self.path(uri)
+
+    def read_range(self, uri: str, start: int, end: int) -> bytes:
+        with open(self.path(uri), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def download_ranges(self, uri: str, local_path: str, total_size: int, ranges: list):
+        # Staging the whole file costs no more than staging parts of it
+        self.download(uri, local_path)
+
+    def download(self, uri: str, local_path: str):
+        print(f"[LOCAL] Staging {uri} -> {local_path}")
+        if os.path.lexists(local_path):
+            os.remove(local_path)
+        clone_file(self.path(uri), local_path)
+
+    def download_to_b64(self, uri: str) -> str:
+        with open(self.path(uri), "rb") as f:
+            return base64.b64encode(f.read()).decode('utf-8')
+
+    def download_to_tempfile(self, uri: str):
+        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        temp_file.close()
+        self.download(uri, temp_file.name)
+        return temp_file
+
+    def upload(self, local_path: str, remote_path: str, content_type: str = None, cache_control: str = None,
+               cancel_event: threading.Event = None):
+        destination = os.path.join(self.root, remote_path)
+        if not os.path.realpath(destination).startswith(self.root + os.sep):
+            raise InvalidBucket(f"{remote_path} is not inside {self.bucket_name}")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        staging = os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.{uuid4().hex[:8]}.tmp")
+        try:
+            clone_file(local_path, staging, hardlink=False)
+            if cancel_event is not None and cancel_event.is_set():
+                raise UploadCancelled(f"Upload of {local_path} was cancelled")
+            os.replace(staging, destination)
+        finally:
+            if os.path.lexists(staging):
+                os.remove(staging)
+        print(f"[LOCAL] Published {local_path} -> {destination}")
+        return self.uri(remote_path)
+
+
+def storage_for(bucket_name: str, token_provider: Callable[[], str] = None):
+    """
+    The storage driver for a bucket: a local directory for file://<path>, else a GCS bucket
+    authorized with the access tokens token_provider returns (e.g. authenticate_gcp).
+    """
+    if is_local_bucket(bucket_name):
+        return LocalStorage(bucket_name)
+    return GCSStorageManagerJWT(bucket_name, token_provider)
+
+
+async def upload_cancellable(bucket_manager, local_path: str, remote_path: str,
+                             content_type: str = None, cache_control: str = None) -> str:
+    """
+    bucket_manager.upload on a worker thread that stops at the next chunk boundary if the caller
+    is cancelled. Waits for the thread to stop before re-raising, so the local file can be removed.
+    """
+    cancel_event = threading.Event()
+    upload = asyncio.ensure_future(asyncio.to_thread(
+        bucket_manager.upload, local_path, remote_path, content_type, cache_control, cancel_event
+    ))
+    try:
+        return await asyncio.shield(upload)
+    except asyncio.CancelledError:
+        cancel_event.set()
+        await asyncio.gather(upload, return_exceptions=True)
+        raise
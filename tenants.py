@@ -0,0 +1,130 @@
+import os
+import json
+import math
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# API keys as JSON: {"<key>": {"name": "web", "weight": 4, "requests_per_minute": 60, "burst": 20, "max_concurrent": 2}, ...}
+# Omitted fields fall back to the TENANT_DEFAULT_* values. BEARER_KEY, if set, is one more key named "default".
+API_KEYS = os.getenv("API_KEYS", "")
+BEARER_KEY = os.getenv("BEARER_KEY")
+# Share of worker slots relative to other keys when they compete
+TENANT_DEFAULT_WEIGHT = float(os.getenv("TENANT_DEFAULT_WEIGHT", "1"))
+# Sustained request rate per key (0 = unlimited) and how many requests may arrive at once on top of it
+TENANT_DEFAULT_REQUESTS_PER_MINUTE = float(os.getenv("TENANT_DEFAULT_REQUESTS_PER_MINUTE", "0"))
+TENANT_DEFAULT_BURST = int(os.getenv("TENANT_DEFAULT_BURST", "10"))
+# Jobs of one key running at the same time; further jobs wait in the scheduler queue (0 = no cap)
+TENANT_DEFAULT_MAX_CONCURRENT = int(os.getenv("TENANT_DEFAULT_MAX_CONCURRENT", "0"))
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `capacity`; every request takes one token."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self) -> bool:
+        if not self.rate:
+            return True
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        """Whole seconds until the next token is available."""
+        if not self.rate:
+            return 0
+        self._refill()
+        return max(1, math.ceil((1 - self.tokens) / self.rate))
+
+
+class Tenant:
+    """One API key: its limits, its state in the fair scheduler and its usage counters."""
+
+    def __init__(self, name: str, weight: float = TENANT_DEFAULT_WEIGHT,
+                 requests_per_minute: float = TENANT_DEFAULT_REQUESTS_PER_MINUTE,
+                 burst: int = TENANT_DEFAULT_BURST, max_concurrent: int = TENANT_DEFAULT_MAX_CONCURRENT):
+        if weight <= 0:
+            raise ValueError(f"API key '{name}': weight must be positive")
+        self.name = name
+        self.weight = weight
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrent = max_concurrent
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        # Fair scheduler state
+        self.running = 0
+        self.last_finish_tag = 0.0
+        # Usage
+        self.requests = 0
+        self.throttled = 0
+        self.jobs_started = 0
+        self.jobs_completed = 0
+        self.busy_seconds = 0.0
+
+    def admit_request(self) -> bool:
+        """Counts a request and applies the rate limit; False means it should be rejected (429)."""
+        self.requests += 1
+        if self.bucket.take():
+            return True
+        self.throttled += 1
+        return False
+
+    def usage(self) -> dict:
+        return {
+            "weight": self.weight,
+            "requests_per_minute": self.requests_per_minute or None,
+            "max_concurrent": self.max_concurrent or None,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "jobs_running": self.running,
+            "jobs_started": self.jobs_started,
+            "jobs_completed": self.jobs_completed,
+            "busy_seconds": round(self.busy_seconds, 3),
+        }
+
+
+class TenantRegistry:
+    def __init__(self, api_keys: str = API_KEYS, bearer_key: str = BEARER_KEY):
+        self.by_key = {}
+        self.by_name = {}
+        keys = json.loads(api_keys) if api_keys.strip() else {}
+        if bearer_key:
+            keys.setdefault(bearer_key, {"name": "default"})
+        for key, settings in keys.items():
+            tenant = Tenant(**settings)
+            if tenant.name in self.by_name:
+                raise ValueError(f"API_KEYS: duplicate key name '{tenant.name}'")
+            self.by_key[key] = tenant
+            self.by_name[tenant.name] = tenant
+
+    def authenticate(self, key: str) -> Tenant:
+        return self.by_key.get(key)
+
+    def get(self, name: str) -> Tenant:
+        """
+        Tenant by name, for jobs resumed after a restart. Jobs stored before API keys existed
+        belong to "default"; names of keys that were since removed get default limits.
+        """
+        name = name or "default"
+        tenant = self.by_name.get(name)
+        if tenant is None:
+            tenant = self.by_name[name] = Tenant(name)
+        return tenant
+
+    def usage(self) -> dict:
+        return {name: tenant.usage() for name, tenant in self.by_name.items()}
+
+
+tenant_registry = TenantRegistry()
@@ -0,0 +1,158 @@
+import os
+import hmac
+import json
+import time
+import asyncio
+import socket
+import hashlib
+import ipaddress
+import requests
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Shared secret for signing callback payloads (X-Webhook-Signature: t=<unix time>,v1=<hex HMAC-SHA256 of "<t>.<body>">)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Deliveries waiting to be sent (including retries); beyond this new deliveries are dropped
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "10"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+# Retry delays double from WEBHOOK_BACKOFF_SECONDS up to WEBHOOK_MAX_BACKOFF_SECONDS
+WEBHOOK_BACKOFF_SECONDS = float(os.getenv("WEBHOOK_BACKOFF_SECONDS", "2"))
+WEBHOOK_MAX_BACKOFF_SECONDS = float(os.getenv("WEBHOOK_MAX_BACKOFF_SECONDS", "300"))
+# Callback hosts must resolve to public addresses; set to true when receivers run on a private network
+WEBHOOK_ALLOW_PRIVATE_ADDRESSES = os.getenv("WEBHOOK_ALLOW_PRIVATE_ADDRESSES", "false").lower() == "true"
+
+# Client errors worth retrying; any other 4xx means the receiver rejected the payload for good
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429}
+
+
+def sign_payload(body: bytes, timestamp: int, secret: str = WEBHOOK_SECRET) -> str:
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def validate_callback_url(url: str):
+    """
+    Raises ValueError unless callbacks can be signed and url is an absolute http(s) URL whose
+    host resolves only to public addresses (not loopback, private, link-local such as the
+    cloud metadata server, or reserved), unless WEBHOOK_ALLOW_PRIVATE_ADDRESSES is set.
+    Resolves the host, so it blocks: call it from a thread.
+    """
+    if not WEBHOOK_SECRET:
+        raise ValueError("callback_url needs WEBHOOK_SECRET to be configured, so callbacks can be signed")
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError(f"callback_url must be an absolute http(s) URL, got '{url}'")
+    if WEBHOOK_ALLOW_PRIVATE_ADDRESSES:
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, parsed.port or 443, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError, ValueError) as e:
+        raise ValueError(f"callback_url host '{parsed.hostname}' does not resolve: {e}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if getattr(ip, "ipv4_mapped", None):
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"callback_url host '{parsed.hostname}' resolves to non-public address {ip}")
+
+
+class Delivery:
+    def __init__(self, url: str, payload: dict):
+        self.url = url
+        self.body = json.dumps(payload).encode()
+        self.event = payload.get("event")
+        self.attempts = 0
+
+
+class WebhookDispatcher:
+    """
+    Delivers job callbacks from a bounded in-memory queue with a few workers.
+    Failed deliveries are re-queued with exponential backoff; the job outcome itself is
+    durable in the job store, so a dropped callback can still be recovered via GET /jobs/{id}.
+    """
+
+    def __init__(self, queue_size: int = WEBHOOK_QUEUE_SIZE, workers: int = WEBHOOK_WORKERS):
+        self.queue_size = queue_size
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if not WEBHOOK_SECRET:
+            print("[WEBHOOK] WEBHOOK_SECRET is not set, requests with a callback_url will be refused")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.queue is not None and self.queue.qsize():
+            print(f"[WEBHOOK] Shutting down with {self.queue.qsize()} undelivered callbacks")
+
+    def enqueue(self, url: str, payload: dict) -> bool:
+        return self._put(Delivery(url, payload))
+
+    def _put(self, delivery: Delivery) -> bool:
+        try:
+            self.queue.put_nowait(delivery)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"[WEBHOOK] Queue full, dropping {delivery.event} callback to {delivery.url}")
+            return False
+
+    def _send(self, delivery: Delivery) -> requests.Response:
+        timestamp = int(time.time())
+        headers = {"Content-Type": "application/json", "User-Agent": "coolifyeasyapi-webhooks"}
+        if WEBHOOK_SECRET:
+            headers["X-Webhook-Signature"] = sign_payload(delivery.body, timestamp)
+        # Checked again at delivery, as the host may resolve differently than when the job was accepted
+        validate_callback_url(delivery.url)
+        return requests.post(
+            delivery.url, data=delivery.body, headers=headers, timeout=WEBHOOK_TIMEOUT_SECONDS, allow_redirects=False
+        )
+
+    async def _worker(self):
+        while True:
+            delivery = await self.queue.get()
+            try:
+                await self._attempt(delivery)
+            finally:
+                self.queue.task_done()
+
+    async def _attempt(self, delivery: Delivery):
+        delivery.attempts += 1
+        try:
+            response = await asyncio.to_thread(self._send, delivery)
+            if response.status_code < 300:
+                self.delivered += 1
+                print(f"[WEBHOOK] Delivered {delivery.event} to {delivery.url} (attempt {delivery.attempts})")
+                return
+            error = f"HTTP {response.status_code}"
+            retryable = response.status_code >= 500 or response.status_code in RETRYABLE_STATUS_CODES
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+            retryable = True
+        except ValueError as e:
+            error = str(e)
+            retryable = False
+
+        if not retryable or delivery.attempts >= WEBHOOK_MAX_ATTEMPTS:
+            self.failed += 1
+            print(f"[WEBHOOK] Giving up on {delivery.event} callback to {delivery.url} after {delivery.attempts} attempts: {error}")
+            return
+        delay = min(WEBHOOK_BACKOFF_SECONDS * 2 ** (delivery.attempts - 1), WEBHOOK_MAX_BACKOFF_SECONDS)
+        print(f"[WEBHOOK] Callback to {delivery.url} failed ({error}), retrying in {delay:.0f}s")
+        # Waiting happens off the workers so one slow receiver does not hold up the others
+        asyncio.get_running_loop().call_later(delay, self._put, delivery)
+
+
+webhook_dispatcher = WebhookDispatcher()
@@ -0,0 +1,299 @@
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
+from uuid import uuid4
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Large artifacts (source video, encoded output) live under SCRATCH_DIR
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", os.path.join(tempfile.gettempdir(), "coolifyeasyapi"))
+# Small artifacts (WAV, SRT) go to RAM-backed storage when available
+SCRATCH_TMPFS_DIR = os.getenv(
+    "SCRATCH_TMPFS_DIR",
+    "/dev/shm/coolifyeasyapi" if os.path.isdir("/dev/shm") else ""
+)
+# Disk space that must stay free after all admitted jobs have written their files
+SCRATCH_RESERVE_BYTES = int(os.getenv("SCRATCH_RESERVE_BYTES", str(1024 ** 3)))
+# Scratch needed per job, as a multiple of the source object size (input + output + margin)
+SCRATCH_SIZE_MULTIPLIER = float(os.getenv("SCRATCH_SIZE_MULTIPLIER", "3"))
+# How long a job's measured disk usage is reused before its directories are walked again
+SCRATCH_USAGE_CACHE_SECONDS = float(os.getenv("SCRATCH_USAGE_CACHE_SECONDS", "2"))
+# Below this much free tmpfs space, small artifacts fall back to SCRATCH_DIR
+SCRATCH_TMPFS_MIN_FREE_BYTES = int(os.getenv("SCRATCH_TMPFS_MIN_FREE_BYTES", str(256 * 1024 ** 2)))
+# How long an output delivered inline stays on disk after its job finished, so coalesced duplicates
+# and Idempotency-Key replays can still be streamed it
+INLINE_RETENTION_SECONDS = float(os.getenv("INLINE_RETENTION_SECONDS", "300"))
+
+JOB_DIR_PREFIX = "job-"
+INLINE_DIR = "inline"
+
+
+class InsufficientScratchSpace(Exception):
+    """Raised when a job cannot be admitted without exceeding the scratch disk budget."""
+
+
+class JobWorkspace:
+    """
+    Per-job scratch directories. Everything a job writes goes in here so the whole
+    job can be removed in one go, and leftovers can be found after a crash.
+    """
+
+    def __init__(self, job_id: str, path: str, small_path: str, reserved_bytes: int):
+        self.job_id = job_id
+        self.path = path
+        self.small_path = small_path
+        self.reserved_bytes = reserved_bytes
+        # (bytes, monotonic time) of the last walk of the job's directories
+        self.usage = None
+
+    def file(self, name: str) -> str:
+        """Path for a large artifact (video input/output)."""
+        return os.path.join(self.path, name)
+
+    def small_file(self, name: str) -> str:
+        """Path for a small artifact (WAV, SRT), on tmpfs when available."""
+        return os.path.join(self.small_path, name)
+
+    def used_bytes(self, root: str) -> int:
+        """
+        Disk space taken by the job's files on root's filesystem (hardlinked inputs take none).
+        Measured at most every SCRATCH_USAGE_CACHE_SECONDS: a job with thousands of segments
+        is slow to walk, and files written since the last walk are still counted as reserved.
+        """
+        now = time.monotonic()
+        if self.usage is not None and now - self.usage[1] < SCRATCH_USAGE_CACHE_SECONDS:
+            return self.usage[0]
+        used = 0
+        for path in {self.path, self.small_path}:
+            if os.path.commonpath([root, os.path.abspath(path)]) == root:
+                used += directory_bytes(path)
+        self.usage = (used, now)
+        return used
+
+    def outstanding_bytes(self, root: str) -> int:
+        """The part of the reservation the job has not written to disk yet."""
+        return max(0, self.reserved_bytes - self.used_bytes(root))
+
+
+def directory_bytes(path: str) -> int:
+    """Allocated size of the files under path, skipping files with other hardlinks."""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_bytes(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_nlink == 1:
+                    total += stat.st_blocks * 512
+        except OSError:
+            pass
+    return total
+
+
+def pid_is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WorkspaceManager:
+    def __init__(self, root: str = SCRATCH_DIR, tmpfs_root: str = SCRATCH_TMPFS_DIR,
+                 reserve_bytes: int = SCRATCH_RESERVE_BYTES, size_multiplier: float = SCRATCH_SIZE_MULTIPLIER):
+        self.root = root
+        self.tmpfs_root = tmpfs_root
+        self.reserve_bytes = reserve_bytes
+        self.size_multiplier = size_multiplier
+        self.reserved_bytes = 0
+        self.active_jobs = 0
+        self.workspaces = set()
+        # Outputs held for inline delivery by this worker, by path, with their sizes
+        self.inline = {}
+        # Set while the app shuts down: jobs interrupted then are resumed later, so they keep their files
+        self.shutting_down = False
+
+    def free_bytes(self) -> int:
+        """
+        Free disk space under the scratch root, minus what admitted jobs have reserved but not
+        written yet (files they already wrote are no longer free on disk).
+        """
+        os.makedirs(self.root, exist_ok=True)
+        root = os.path.abspath(self.root)
+        # Copied first: readyz calls this from a worker thread
+        workspaces = list(self.workspaces)
+        return shutil.disk_usage(self.root).free - sum(workspace.outstanding_bytes(root) for workspace in workspaces)
+
+    def _small_root(self) -> str:
+        if not self.tmpfs_root:
+            return self.root
+        try:
+            os.makedirs(self.tmpfs_root, exist_ok=True)
+            if shutil.disk_usage(self.tmpfs_root).free >= SCRATCH_TMPFS_MIN_FREE_BYTES:
+                return self.tmpfs_root
+        except OSError as e:
+            print(f"[WORKSPACE] Warning: tmpfs staging unavailable ({e}), using disk")
+        return self.root
+
+    def _adopt(self, root: str, job_id: str, path: str):
+        """Take over a resumed job's directory left behind by an earlier worker."""
+        if not root or not os.path.isdir(root):
+            return
+        for name in os.listdir(root):
+            if name.startswith(JOB_DIR_PREFIX) and name.endswith(f"-{job_id}") and os.path.join(root, name) != path:
+                os.rename(os.path.join(root, name), path)
+                print(f"[WORKSPACE] Resuming job {job_id} in its previous directory {name}")
+                return
+
+    def admit(self, expected_input_bytes: int, job_id: str = None) -> JobWorkspace:
+        """
+        Reserve scratch space for a job and create its directories.
+        Raises InsufficientScratchSpace if the job would push free space below the reserve.
+        A resumed job (same job_id) gets back the directories of its earlier attempt.
+        """
+        needed = int((expected_input_bytes or 0) * self.size_multiplier)
+        available = self.free_bytes() - self.reserve_bytes
+        if needed > available:
+            raise InsufficientScratchSpace(
+                f"Job needs ~{needed} bytes of scratch space but only {max(available, 0)} bytes are available"
+            )
+
+        job_id = job_id or uuid4().hex
+        dir_name = f"{JOB_DIR_PREFIX}{os.getpid()}-{job_id}"
+        path = os.path.join(self.root, dir_name)
+        small_path = os.path.join(self._small_root(), dir_name)
+        self._adopt(self.root, job_id, path)
+        if self.tmpfs_root and small_path != os.path.join(self.root, dir_name):
+            self._adopt(self.tmpfs_root, job_id, small_path)
+        os.makedirs(path, exist_ok=True)
+        os.makedirs(small_path, exist_ok=True)
+
+        workspace = JobWorkspace(job_id, path, small_path, needed)
+        self.workspaces.add(workspace)
+        self.reserved_bytes += needed
+        self.active_jobs += 1
+        print(f"[WORKSPACE] Admitted job {job_id}: reserved {needed} bytes in {path}")
+        return workspace
+
+    @staticmethod
+    def remove_directories(workspace: JobWorkspace):
+        for path in {workspace.path, workspace.small_path}:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def release(self, workspace: JobWorkspace):
+        """Return a job's reservation; call after its directories have been removed."""
+        self.workspaces.discard(workspace)
+        self.reserved_bytes -= workspace.reserved_bytes
+        self.active_jobs -= 1
+        print(f"[WORKSPACE] Released job {workspace.job_id}")
+
+    @asynccontextmanager
+    async def job(self, expected_input_bytes: int, job_id: str = None, keep_on_cancel: bool = False):
+        """
+        Async context manager yielding a JobWorkspace; its directories are removed on exit.
+        With keep_on_cancel, a job interrupted by shutdown keeps its files so it can be resumed;
+        jobs cancelled while the app keeps running are cleaned up like any other.
+        """
+        workspace = self.admit(expected_input_bytes, job_id)
+        keep = False
+        try:
+            yield workspace
+        except asyncio.CancelledError:
+            keep = keep_on_cancel and self.shutting_down
+            raise
+        finally:
+            if not keep:
+                await asyncio.to_thread(self.remove_directories, workspace)
+            self.release(workspace)
+
+    @property
+    def inline_bytes(self) -> int:
+        # Copied first: files are held and released from worker threads
+        return sum(list(self.inline.values()))
+
+    def hold_inline(self, path: str):
+        """
+        Moves a finished output out of its job workspace, which is removed when the job ends,
+        into the directory where outputs wait to be streamed back to the client. Held files
+        stay on the scratch disk without a reservation, so none are held (None is returned and
+        the output should be uploaded) while free scratch space is already below the reserve.
+        Held files are removed once sent (release_inline), or INLINE_RETENTION_SECONDS after
+        they were created when they are kept for replays.
+        """
+        self.purge_inline()
+        if self.free_bytes() < self.reserve_bytes:
+            print(f"[WORKSPACE] Scratch space is below the reserve, not holding {os.path.basename(path)} for inline delivery")
+            return None
+        inline_dir = os.path.join(self.root, INLINE_DIR)
+        os.makedirs(inline_dir, exist_ok=True)
+        held_path = os.path.join(inline_dir, f"{uuid4().hex}{os.path.splitext(path)[1]}")
+        os.replace(path, held_path)
+        self.inline[held_path] = os.path.getsize(held_path)
+        return held_path
+
+    def release_inline(self, path: str):
+        """Removes a held output that has been sent and is not needed for replays."""
+        self.inline.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def purge_inline(self, max_age: float = INLINE_RETENTION_SECONDS) -> int:
+        inline_dir = os.path.join(self.root, INLINE_DIR)
+        if not os.path.isdir(inline_dir):
+            return 0
+        removed = 0
+        cutoff = time.time() - max_age
+        for name in os.listdir(inline_dir):
+            path = os.path.join(inline_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    self.inline.pop(path, None)
+                    removed += 1
+            except FileNotFoundError:
+                self.inline.pop(path, None)
+        return removed
+
+    def cleanup_orphans(self, keep_job_ids=()):
+        """
+        Remove job directories left behind by crashed or killed workers.
+        Directory names carry the owning pid, so live workers' jobs are left alone,
+        as are the directories of jobs about to be resumed (keep_job_ids).
+        """
+        removed = 0
+        for root in {self.root, self.tmpfs_root}:
+            if not root or not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                if not name.startswith(JOB_DIR_PREFIX):
+                    continue
+                try:
+                    pid, job_id = name[len(JOB_DIR_PREFIX):].split("-", 1)
+                    pid = int(pid)
+                except ValueError:
+                    continue
+                if job_id in keep_job_ids:
+                    continue
+                # Our own pid can only show up here if it was reused after a restart
+                if pid != os.getpid() and pid_is_alive(pid):
+                    continue
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+                removed += 1
+        print(f"[WORKSPACE] Startup cleanup removed {removed} orphaned job directories")
+        return removed
+
+
+workspace_manager = WorkspaceManager()